@@ -1,6 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from typing import Optional
 from app.utils.utils import get_current_user
 from app.core.database import database_client
+from app.core import storage
+from app.utils.pagination import decode_cursor, next_cursor, page_size, NEXT_CURSOR_HEADER
+from app.utils.metrics import metrics
 from app.utils.logging_config import logging_config  # Import the configuration file
 import logging.config
 logging.config.dictConfig(logging_config)
@@ -24,11 +28,37 @@ async def add_admin(email: str, dependencies = [Depends(get_current_user)]) -> s
     """
     return await database_client.add_admin(email)
 
+@router.get("/admin/metrics",dependencies = [Depends(get_current_user)],tags=["Admin"], summary="Returns the process metrics", description="Returns the counters and timings of this API process, e.g. expired reservations and sweep duration. ")
+async def admin_metrics():
+    """
+    Returns the counters and timings collected by this process since it started.
+
+    Returns:
+    dict:
+        - uptime_seconds (float): Seconds since the process started.
+        - counters (dict): e.g. reservations_expired, reservations_released_trs.
+        - timings (dict): count, total, max and last seconds, e.g. for reservations_sweep_seconds.
+    """
+    return metrics.snapshot()
+
 @router.get("/admin/creation_requests",dependencies = [Depends(get_current_user)],tags=["Admin"], summary="For getting the TRS creation requests", description="Returns the list of TRS creation requests currently pending for admins to approve. ")
-async def admin_creation_requests():
+async def admin_creation_requests(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """
+    Returns the pending TRS creation requests, oldest first. With a limit or a cursor they are returned
+    one page at a time, and the cursor of the next page, if any, is returned in the X-Next-Cursor header.
+
+    Parameters:
+    limit (int, optional): The number of requests per page; all of them if neither limit nor cursor is given.
+    cursor (str, optional): The X-Next-Cursor value of the previous page.
+    """
     try:
-        data = await database_client.get_trs_creation_requests('pending')
+        limit = page_size(limit, cursor)
+        after = int(decode_cursor(cursor, 1)[0]) if cursor else None
+        data = await database_client.get_trs_creation_requests('pending', limit, after)
         logger.debug(data)
+        cursor = next_cursor(data, limit, lambda request: (request['id'],))
+        if cursor:
+            response.headers[NEXT_CURSOR_HEADER] = cursor
         return data
     except Exception as e: 
         return HTTPException(status_code= 500, content= e)
@@ -47,7 +77,9 @@ async def admin_approve(id: int):
             raise HTTPException(status_code= 409, detail = "Collection already exists.")   
         #mint_address = await mint.mint(trs_creation_data['title'],trs_creation_data['description'],number,trs_creation_data['creator_email'])
         #token_account_address = await transaction_module.get_token_account_address(Pubkey.from_string(mint_address))
-        await database_client.approve_trs_creation_request(id,trs_creation_data['creator_email'],number,"e",trs_creation_data['title'],"e")
+        # Resolved before the approval transaction, so no connection is held during storage I/O.
+        image_uri = await storage.get_image_uri(trs_creation_data['file_url_header'])
+        await database_client.approve_trs_creation_request(id,trs_creation_data['creator_email'],number,"e",trs_creation_data['title'],"e",image_uri)
         return {"message":"TRS Succesfully created. "}
     except Exception as e: 
         logger.error(f"Error {e}")
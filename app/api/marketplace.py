@@ -1,8 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from typing import Optional
 
 from app.utils.utils import get_current_user
 from app.core.database import database_client
+from app.core.orderbook import order_book
 from app.utils.models import User
+from app.utils.pagination import decode_cursor, next_cursor, page_size, NEXT_CURSOR_HEADER
 
 from app.utils.logging_config import logging_config  # Import the configuration file
 import logging.config
@@ -13,9 +16,14 @@ router = APIRouter()
 
 
 @router.get('/marketplace',tags=["Marketplace"],summary="Fetches the marketplace",description="Fetches all the martketplace entries, along with the respective data. ")
-async def marketplace():
+async def marketplace(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None):
     """
-    Retrieves all TRS currently listed on the marketplace.
+    Retrieves all TRS currently listed on the marketplace. With a limit or a cursor it is returned
+    one page at a time, and the cursor of the next page, if any, is returned in the X-Next-Cursor header.
+
+    Parameters:
+    limit (int, optional): The number of price levels per page; all of them if neither limit nor cursor is given.
+    cursor (str, optional): The X-Next-Cursor value of the previous page.
 
     Returns:
     list: A list of dictionaries, where each dictionary represents a TRS on the marketplace.
@@ -27,8 +35,15 @@ async def marketplace():
 
     """
     try:
-        trs_on_marketplace = await database_client.get_marketplace_all()
+        limit = page_size(limit, cursor)
+        after = decode_cursor(cursor, 2) if cursor else None
+        trs_on_marketplace = await order_book.get_all(limit, after)
+        cursor = next_cursor(trs_on_marketplace, limit, lambda level: (level['collection_name'], level['bid_price']))
+        if cursor:
+            response.headers[NEXT_CURSOR_HEADER] = cursor
         return trs_on_marketplace
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching marketplace: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -42,7 +57,7 @@ async def marketplace_collection(collection_name: str):
     collection_name (str): The name of the collection.
     """
     try:
-        trs_on_marketplace = await database_client.get_marketplace_collection(collection_name)
+        trs_on_marketplace = order_book.get_collection(collection_name)
         
         return trs_on_marketplace
     except Exception as e:
@@ -50,13 +65,13 @@ async def marketplace_collection(collection_name: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post('/marketplace/place',dependencies=[Depends(get_current_user)],tags=["Marketplace"],summary="Adds TRS to the marketplace",description="Adds TRS to the martketplace from a users wallet.  ")
-async def marketplace_add(collection_name: str, number: int,price:int, user: User = Depends(get_current_user)) -> dict:
+async def marketplace_add(collection_name: str, price:int, number: int = Query(..., gt=0), user: User = Depends(get_current_user)) -> dict:
     """
-    This function adds TRS of a specific collection to the marketplace.
+    This function adds TRS of a specific collection to the marketplace, as a single listing.
 
     Parameters:
     collection_name (str): The name of the collection.
-    number (int): The number of TRS to be added to the marketplace.
+    number (int): The number of TRS to be added to the marketplace; must be positive.
     price (int): The bid price for the TRS in the marketplace.
     user (User): The user making the request. This parameter is obtained from the 'get_current_user' function.
 
@@ -65,38 +80,22 @@ async def marketplace_add(collection_name: str, number: int,price:int, user: Use
         - message (str): "TRS added to marketplace successfully."
     """
     try:
-        wallet = await database_client.get_wallet_formatted(user.id)
-        req_wallet = []
-        
-        for i in wallet['trs']: 
-            
-            if i['collection_name'] == collection_name and i['marketplace'] == 0 and i['artisan'] == 0:
-                req_wallet.append(i)
-
-        if len(req_wallet) >= number:   
-            values = []
-            values2 = []
-            for i in req_wallet[:number]:
-        
-                values.append((i['trs_id'],collection_name,'sell', user.id,price))
-                values2.append((i['trs_id'],))
-            await database_client.add_trs_to_marketplace(user.id,values,values2,i['collection_name'])
-
-            return {"message": "TRS added to marketplace successfully."}
-        else:
+        result = await database_client.add_trs_to_marketplace(user.id, collection_name, price, number)
+        if result is None:
             return {"message": F"Insufficient TRS of {collection_name} in wallet."}
+        return {"message": "TRS added to marketplace successfully."}
     except Exception as e:
         logger.error("Error in adding trs to marketplace", e)
         raise HTTPException(status_code = 500, detail = e)
 
 @router.post('/marketplace/remove',dependencies=[Depends(get_current_user)],tags=["Marketplace"],summary="Removes TRS from the marketplace",description="Removes TRS from the martketplace from a users wallet.  ")
-async def marketplace_remove(collection_name: str, number: int, user: User = Depends(get_current_user)) -> dict:
+async def marketplace_remove(collection_name: str, number: int = Query(..., gt=0), user: User = Depends(get_current_user)) -> dict:
     """
-    This function removes TRS of a specific collection from the marketplace.
+    This function removes TRS of a specific collection from the marketplace, newest listings first.
 
     Parameters:
     collection_name (str): The name of the collection.
-    number (int): The number of TRS to be removed from the marketplace.
+    number (int): The number of TRS to be removed from the marketplace; must be positive.
     user (User): The user making the request. This parameter is obtained from the 'get_current_user' function.
 
     Returns:
@@ -106,21 +105,10 @@ async def marketplace_remove(collection_name: str, number: int, user: User = Dep
         - message (str): "Insufficient TRS of {collection_name} in wallet."
     """
     try:
-        wallet = await database_client.get_wallet_formatted(user.id)
-        req_wallet = []
-        for i in wallet['trs']: 
-            if i['collection_name'] == collection_name and i['marketplace'] == 1 and i['artisan'] == 0:
-                req_wallet.append(i)
-
-        if len(req_wallet) >= number:
-            values = []
-            for i in req_wallet[:number]:
-                values.append((i['trs_id'],))
-            await database_client.remove_trs_from_marketplace(values,user.id)
-
-            return {"message": "TRS removed from marketplace successfully."}
-        else:
+        result = await database_client.remove_trs_from_marketplace(user.id, collection_name, number)
+        if result is None:
             return {"message": F"Insufficient TRS of {collection_name} in wallet."}
+        return {"message": "TRS removed from marketplace successfully."}
     except Exception as e:
         logger.error("Error in removing trs from marketplace", e)
         raise HTTPException(status_code = 500, detail = e)
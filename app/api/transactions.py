@@ -1,10 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException,Query
+from fastapi import APIRouter, Depends, HTTPException,Query,Header
 from typing import Optional
 from app.utils.utils import get_current_user
 from app.utils.utils import SERVER_URL
 from app.core.database import database_client
+from app.core.orderbook import order_book, price_key
 from app.utils.models import User,TradeCreateData
 from app.fintech import paypal
+from app.fintech.payouts import payout_worker
+from app.core import idempotency
+from app.utils.metrics import metrics
 import uuid
 from decimal import Decimal
 from app.utils.logging_config import logging_config  # Import the configuration file
@@ -20,38 +24,67 @@ ROYALTY  = 2.5
 FEES = 2.5
 
 @router.post('/trade/create',dependencies=[Depends(get_current_user)],tags=['Transactions'],summary="Creates a trade.",description="Creates a trade, adds it to the pending trades database, creates a paypal transaction")
-async def trade_create(data : TradeCreateData,buyer : User = Depends(get_current_user)):
+async def trade_create(data : TradeCreateData,buyer : User = Depends(get_current_user),idempotency_key : Optional[str] = Header(None, alias="Idempotency-Key")):
+    """
+    Creates a trade. A client that may retry sends an Idempotency-Key header; a retry with the same key
+    returns the response of the first request instead of reserving TRS again.
+    """
+    if idempotency_key:
+        stored = await idempotency.begin('trade_create', idempotency_key, buyer.id, data.model_dump())
+        if stored is not None:
+            return stored
+    try:
+        return await create_trade(data, buyer, idempotency_key)
+    except Exception:
+        if idempotency_key:
+            await idempotency.release('trade_create', idempotency_key)
+        raise
 
-    mrktplace_collection = await database_client.get_marketplace_collection(data.collection_name)
-    number_of_trs = 0
-    for i in mrktplace_collection:
-        if i['collection_name'] == data.collection_name and i['bid_price']  == data.cost:
-            number_of_trs = i['number_of_trs']
+
+async def create_trade(data, buyer, idempotency_key=None):
+    if data.order_type == 'market':
+        # Walk the price levels from the cheapest upward; the buyer pays for all levels in one payment.
+        fills = order_book.fill(data.collection_name, data.number, data.max_price)
+    elif data.cost is None:
+        raise HTTPException(status_code=400, detail="A limit order needs a cost. ")
+    else:
+        fills = [(price_key(data.cost), data.number)] if order_book.available(data.collection_name, data.cost) >= data.number else []
+    number_of_trs = sum(number for price, number in fills)
     if number_of_trs < data.number:
         logger.info("Not enough TRS being offered by the sellers at the given price. ")
         raise HTTPException(status_code=400, detail="Not enough TRS being offered by the sellers at the given price. ")
     else: 
         try:
-            description = f"Buy order for {data.number} TRS of {data.collection_name}. Price per TRS = {data.number}, Total Amount = {(data.number*data.cost)}"
+            amount = sum(price * number for price, number in fills).quantize(Decimal('0.01'))
+            if data.order_type == 'market':
+                description = f"Market buy order for {data.number} TRS of {data.collection_name} at {len(fills)} price levels, Total Amount = {amount}"
+            else:
+                description = f"Buy order for {data.number} TRS of {data.collection_name}. Price per TRS = {data.cost}, Total Amount = {amount}"
             data_transac = {
                 'collection_name':data.collection_name,
                 'cancel_url' : "https://example.com",
                 "description": description,
                 "return_url": SERVER_URL + "/trade/execute_payment",
-                'amount' :   (data.number)*(data.cost)
+                'amount' :   str(amount)
             }
             try:
                 resp = await paypal.create_payment(data_transac)
-                
-                amount = data.number*data.cost
-                await database_client.add_paypal_transaction(resp['id'],buyer.id,whiplano_id,amount)
-                logger.info(f"Payment created succesfully with id {resp['id']}")
-                trade_create_data = await database_client.trade_create(resp['id'], data.cost,data.number,data.collection_name,buyer.id)
 
-                        
+                async def record_trade():
+                    async with database_client.transaction():
+                        await database_client.add_paypal_transaction(resp['id'],buyer.id,whiplano_id,amount)
+                        logger.info(f"Payment created succesfully with id {resp['id']}")
+                        trade_create_data = await database_client.trade_create_levels(resp['id'], fills, data.collection_name, buyer.id)
+                        response = {"message": "Payment created successfully.",
+                                    'approval_url': resp['links'][1]['href'],
+                                    'amount': str(amount),
+                                    'fills': [{'price': str(price), 'number': number} for price, number in fills]}
+                        if idempotency_key:
+                            await idempotency.complete('trade_create', idempotency_key, response)
+                    return response
 
-                return {"message": "Payment created successfully.",
-                        'approval_url': resp['links'][1]['href']}
+                # The reservation can be picked as a deadlock victim, which rolls back the whole unit of work.
+                return await database_client.retry_on_deadlock(record_trade)
                 
             except Exception as e:
                 raise HTTPException(status_code=501, detail=str(e))
@@ -76,10 +109,9 @@ async def execute_payment(
 ):
     """
     This function executes a PayPal payment with the given payment ID and Payer ID.
-    It retrieves the payment details, modifies the payment status in the database,
-    approves initiated transactions, retrieves approved transactions, and processes
-    the transactions by executing payouts, updating the transaction records, and
-    transferring assets between users.
+    It marks the payment executed, settles the trade and queues the seller and royalty payouts,
+    all in one database transaction, and returns as soon as that commits. The payouts are sent
+    in batches by the payout worker (see app/fintech/payouts.py).
 
     Parameters:
     paymentId (str, optional): The ID of the PayPal payment.
@@ -92,60 +124,150 @@ async def execute_payment(
     Raises:
     HTTPException: If an error occurs during the payment execution.
     """
+    # PayPal redirects and client retries can call this more than once for a payment; a repeated call
+    # returns the stored response instead of settling the trade again.
+    if paymentId:
+        stored = await idempotency.begin('execute_payment', paymentId)
+        if stored is not None:
+            return stored
     try:
-        resp = await paypal.execute_payment(paymentId,PayerID)
-        logger.info(f"Executed payment with id {paymentId}")
-        await database_client.modify_paypal_transaction(paymentId,'executed')
-        batch_id = str(uuid.uuid4)
-        seller_data = await database_client.execute_trade(paymentId)
-        logger.info(f"Trade executed with id {paymentId}")
-        token_account_address = None
-        for seller in seller_data:
-            amount = Decimal(seller['cost']) * Decimal(seller['number'])
-            amount1 = amount * (Decimal(100-ROYALTY+FEES)/Decimal(100))
-            amount2 = amount * (Decimal(ROYALTY)/Decimal(100))
-            payout_info = {
-                    "batch_id":batch_id,
-                    "recipient_email":seller['seller_email'],
-                    "amount":str(amount1),
-                    "currency":"USD",
-                    "note": f"Payment to {seller['seller_email']} for TRS of collection {seller['collection_name']}. "
-                }
-            await paypal.payout(payout_info)
-            logger.info(f"Paypal payout sent to {seller['seller_email']}. ")
-            royalty_payout_info = payout_info = {
-                    "batch_id":batch_id,
-                    "recipient_email":seller['seller_email'],
-                    "amount":str(amount2),
-                    "currency":"USD",
-                    "note": f"Royalty for {seller['creator_email']} for trade of TRS of collection {seller['collection_name']}. "
-                }
-            if not token_account_address:
-                token_account_address = 1
-            else: 
-                token_account_address,mint_address = await database_client.get_token_account_address(seller['collection_name'])
-            data = {
-                "transaction_number":paymentId,
-                "buyer_id": seller['buyer_id'],
-                "seller_id": seller['seller_id'],
-                "seller_email": seller['seller_email'],
-                "buyer_email":seller['buyer_email'],
-                "trs_count": seller['number'],
-                'token_account_address':token_account_address,
-                'mint_address':mint_address
-            }
-            #await dac.transfer(mint_address, seller['seller_email'],seller['buyer_email'],seller['number'])
-            #await transaction_module.transaction(data)
-            logger.info(f"Sent transaction to complete trade {paymentId}")
-            
-        logger.info(f"Completed Trade with buyer transaction number {paymentId}")
-        return {"message": f"Completed Trade with buyer transaction number {paymentId}"}
+        return await execute_trade_payment(paymentId, PayerID)
+    except Exception:
+        if paymentId:
+            await idempotency.release('execute_payment', paymentId)
+        raise
+
+
+async def refund_trade(paymentId, payment):
+    """
+    Compensates a payment that was charged but whose trade could not be settled: the sale is refunded
+    and the trade cancelled, returning its TRS to the marketplace. If the refund fails the trade stays
+    claimed (status `executing`) and the reservation sweeper retries it once the claim's lease runs out.
+
+    Returns:
+    bool: Whether the sale was refunded.
+    """
+    try:
+        await paypal.refund_payment(payment)
+    except Exception as e:
+        metrics.increment('trade_refund_errors')
+        logger.critical(f"Trade {paymentId} was charged but not settled, and the refund failed: {e}")
+        return False
+    metrics.increment('trade_refunds')
+    logger.warning(f"Refunded payment {paymentId} after its trade could not be settled. ")
+    try:
+        await cancel_refunded_trade(paymentId)
+    except Exception as e:
+        logger.error(f"Error cancelling refunded trade {paymentId}: {e}")
+    return True
+
+
+async def cancel_refunded_trade(paymentId):
+    await database_client.modify_paypal_transaction(paymentId,'refunded')
+    await database_client.release_trade_claim(paymentId)
+    await database_client.cancel_trade(paymentId)
 
 
+async def reconcile_claimed_trade(paymentId):
+    """
+    Finishes a trade left `executing` past its claim's lease, by a request that stopped between claiming
+    it and settling it (see ReservationSweeper). PayPal decides what happened to the payment: a paid
+    trade is settled, or refunded if it cannot be; a refunded one is cancelled; one that was never
+    charged is released back to `initiated`, where the buyer can still pay it until it expires.
 
+    Returns:
+    str: 'settled', 'refunded', 'unrefunded', 'cancelled' or 'released'.
+    """
+    payment = await paypal.get_payment(paymentId)
+    sale = paypal.payment_sale(payment) or {}
+    if payment.get('state') == 'approved' and sale.get('state') in ('completed', 'pending'):
+        try:
+            response, payouts = await settle_paid_trade(paymentId)
+        except Exception as e:
+            logger.error(f"Error settling paid trade {paymentId}: {e}")
+            return 'refunded' if await refund_trade(paymentId, payment) else 'unrefunded'
+        payout_worker.notify()
+        logger.info(f"Settled trade {paymentId} after its claim expired, {len(payouts)} payouts queued. ")
+        return 'settled'
+    if sale.get('state') == 'refunded':
+        # Refunded by refund_trade, which stopped before cancelling the trade.
+        await cancel_refunded_trade(paymentId)
+        logger.info(f"Cancelled refunded trade {paymentId} after its claim expired. ")
+        return 'cancelled'
+    await database_client.release_trade_claim(paymentId)
+    logger.info(f"Released trade {paymentId} after its claim expired, payment state {payment.get('state')}. ")
+    return 'released'
+
+
+async def execute_trade_payment(paymentId, PayerID):
+    try:
+        # Claim the trade before charging the buyer, so the reservation sweeper cannot cancel it while the payment runs.
+        if not await database_client.claim_trade(paymentId):
+            logger.info(f"Trade {paymentId} is no longer pending, not executing the payment. ")
+            raise HTTPException(status_code=410, detail="This trade has expired or was already completed. ")
+        try:
+            resp = await paypal.execute_payment(paymentId,PayerID)
+        except Exception:
+            await database_client.release_trade_claim(paymentId)
+            raise
+        if resp.get('state') != 'approved':
+            await database_client.release_trade_claim(paymentId)
+            logger.info(f"Payment {paymentId} was not approved: {resp}")
+            raise HTTPException(status_code=402, detail="The payment was not completed. ")
+        logger.info(f"Executed payment with id {paymentId}")
+        try:
+            response, payouts = await settle_paid_trade(paymentId)
+        except Exception:
+            await refund_trade(paymentId, resp)
+            raise
+        payout_worker.notify()
+        logger.info(f"Trade executed with id {paymentId}, {len(payouts)} payouts queued. ")
+        logger.info(f"Completed Trade with buyer transaction number {paymentId}")
+        return response
+    except HTTPException as error:
+        raise error
     except Exception as error:
         logger.error(f"Error executing transaction {paymentId} {error}")
         raise HTTPException(status_code=500, detail=str(error))
 
 
+async def settle_paid_trade(paymentId):
+    """Settles a paid trade and queues its payouts in one transaction. Returns the response and the payouts."""
+    async with database_client.transaction():
+        await database_client.modify_paypal_transaction(paymentId,'executed')
+        seller_data = await database_client.execute_trade(paymentId)
+        # A market order can buy from one seller at several prices; payouts are per seller.
+        sellers = {}
+        for seller in seller_data:
+            amount = Decimal(seller['cost']) * Decimal(seller['number'])
+            if seller['seller_id'] in sellers:
+                sellers[seller['seller_id']][1] += amount
+            else:
+                sellers[seller['seller_id']] = [seller, amount]
+        payouts = []
+        for seller, amount in sellers.values():
+            amount1 = amount * (Decimal(100-ROYALTY-FEES)/Decimal(100))
+            amount2 = amount * (Decimal(ROYALTY)/Decimal(100))
+            payouts.append({
+                "kind": "seller",
+                "reference": seller['seller_id'],
+                "recipient_email": seller['seller_email'],
+                "amount": amount1.quantize(Decimal('0.01')),
+                "currency": "USD",
+                "note": f"Payment to {seller['seller_email']} for TRS of collection {seller['collection_name']}. "
+            })
+            payouts.append({
+                "kind": "royalty",
+                "reference": seller['seller_id'],
+                "recipient_email": seller['creator_email'],
+                "amount": amount2.quantize(Decimal('0.01')),
+                "currency": "USD",
+                "note": f"Royalty for {seller['creator_email']} for trade of TRS of collection {seller['collection_name']}. "
+            })
+        await database_client.enqueue_payouts(paymentId, payouts)
+        response = {"message": f"Completed Trade with buyer transaction number {paymentId}"}
+        await idempotency.complete('execute_payment', paymentId, response)
+    return response, payouts
+
+
 
@@ -1,10 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException, Form, File, UploadFile
 from fastapi.responses import JSONResponse
 from typing import List
+import asyncio
+import os
+import uuid
 from app.utils.utils import get_current_user
 from app.core.database import database_client
-from app.utils.models import User
+from app.utils.models import User, TrsUploadRequest, TrsFinalizeRequest
 from app.core import storage
+from app.core.objectstore import STORAGE_MULTIPART_THRESHOLD, STORAGE_MULTIPART_CHUNKSIZE, PRESIGNED_URL_TTL
 
 from app.core import storage
 from app.utils.logging_config import logging_config  # Import the configuration file
@@ -14,6 +18,34 @@ logger = logging.getLogger("trs")
 
 router = APIRouter()
 
+# S3 allows at most 10000 parts per multipart upload.
+MAX_UPLOAD_PARTS = 10000
+# Seconds after its URLs expire that a direct upload can still be finalized; then it is aborted.
+TRS_UPLOAD_FINALIZE_GRACE = int(os.getenv("TRS_UPLOAD_FINALIZE_GRACE", 3600))
+
+
+def validate_title(title):
+    """Raises a 400 if `title` is empty, too long, or could be read as a path (contains `/`, `\\` or `..`)."""
+    if not title.strip() or len(title) > 255 or '/' in title or '\\' in title or '..' in title:
+        raise HTTPException(status_code=400, detail="Invalid title, it cannot be empty or contain '/', '\\' or '..'.")
+
+
+async def check_title_available(title):
+    """
+    Raises a 400 if `title` is not a valid title (see validate_title), and a 409 if a collection or a
+    pending or approved TRS creation request already uses it.
+    """
+    validate_title(title)
+    exist = await database_client.check_collection_exists(title)
+    pend_request = await database_client.get_trs_creation_requests('pending')
+    confirmed_request = await database_client.get_trs_creation_requests('approved')
+    all_request = pend_request + confirmed_request
+    for request in all_request: 
+        if request['title'] == title:
+            raise HTTPException(status_code=409, detail = "There is already a TRS creation request in this Title.")
+    if exist: 
+        raise HTTPException(status_code=409, detail = "Collection already exists.")
+
 
 
 @router.post("/create_trs_request", dependencies=[Depends(get_current_user)],tags=["TRS"], summary="Creates TRS", description="Makes a TRS Creation request, with all the given data.")
@@ -46,26 +78,149 @@ async def create_trs_request(
     """
     if len(files) > 10:
         return JSONResponse(status_code=400, content={"message": "A maximum of 10 files can be uploaded."})
-    exist = await database_client.check_collection_exists(title)
-    pend_request = await database_client.get_trs_creation_requests('pending')
-    confirmed_request = await database_client.get_trs_creation_requests('approved')
-    all_request = pend_request + confirmed_request
-    for request in all_request: 
-        if request['title'] == title:
-            raise HTTPException(status_code=409, detail = "There is already a TRS creation request in this Title.")
-    if exist: 
-        raise HTTPException(status_code=409, detail = "Collection already exists.")
+    await check_title_available(title)
     try:
-        
-        file_urls = []
-        for file in files:
-            file_url = await storage.upload_to_s3(file,f'trs_data/{title}/{file.filename}')
-            file_urls.append(file_url)
-        image_url = await storage.upload_to_s3(image, f'trs_data/{title}/thumbnail.png')
-        file_url_header =  f'trs_data/{title}/'
+        # Each request gets its own prefix, so two requests for the same title cannot overwrite each other's files.
+        file_url_header =  f'trs_data/{uuid.uuid4()}/'
+        uploads = [(file, f'{file_url_header}{file.filename}') for file in files]
+        uploads.append((image, f'{file_url_header}thumbnail.png'))
+        *file_urls, image_url = await storage.upload_many_to_s3(uploads)
 
         await database_client.add_trs_creation_request(model_name,title,description,current_user.email, file_url_header)
 
         return JSONResponse(status_code= 200, content = {"message":"Trs creation request submitted succesfully. "})
     except Exception as e:
         return HTTPException(status_code = 500, detail = str(e))
+
+
+def upload_prefix(upload_uuid):
+    return f'trs_data/{upload_uuid}/'
+
+
+def upload_files(data, upload_uuid):
+    """Returns (file, object key) for the files and the thumbnail of a presigned TRS creation request."""
+    files = []
+    for file in data.files:
+        if not file.filename or '/' in file.filename or file.filename in ('.', '..'):
+            raise HTTPException(status_code=400, detail=f"Invalid file name {file.filename}.")
+        files.append((file, f'{upload_prefix(upload_uuid)}{file.filename}'))
+    files.append((data.image, f'{upload_prefix(upload_uuid)}thumbnail.png'))
+    return files
+
+
+@router.post("/create_trs_request/uploads", dependencies=[Depends(get_current_user)],tags=["TRS"], summary="Starts a TRS creation request", description="Returns presigned URLs to upload the files of a TRS creation request directly to the bucket.")
+async def create_trs_uploads(data: TrsUploadRequest, current_user: User = Depends(get_current_user)):
+    """
+    First step of a TRS creation request whose files are uploaded directly to the bucket, so the
+    API never handles the file contents.
+
+    Files smaller than STORAGE_MULTIPART_THRESHOLD get one presigned PUT URL; the client must send the
+    Content-Type it declared. Larger files get a multipart upload, with one presigned URL per part of
+    `part_size` bytes; the client keeps the ETag returned for each part. The keys are under a prefix of
+    their own (trs_data/{upload_uuid}/), so requests for the same title never share objects. The client
+    then calls /create_trs_request/finalize with the upload_uuid. The issued uploads are recorded, so only they can be finalized, by the
+    same user, within PRESIGNED_URL_TTL + TRS_UPLOAD_FINALIZE_GRACE seconds; unfinished multipart uploads
+    are aborted after that by the upload sweeper.
+
+    Parameters:
+    data (TrsUploadRequest): The title, and the name, size and content type of every file and of the thumbnail.
+    current_user (User): The user making the TRS creation request.
+
+    Returns:
+    dict: 
+        - upload_uuid (str): Identifies the uploads; passed to /create_trs_request/finalize.
+        - uploads (list): Per file: filename, key, and either `url` or `upload_id`, `part_size` and `part_urls`.
+        - expires_in (int): Seconds the URLs stay valid.
+    """
+    if len(data.files) > 10:
+        return JSONResponse(status_code=400, content={"message": "A maximum of 10 files can be uploaded."})
+    await check_title_available(data.title)
+    upload_uuid = str(uuid.uuid4())
+    uploads = []
+    try:
+        for file, key in upload_files(data, upload_uuid):
+            filename = key.rsplit('/', 1)[1]
+            if file.size < STORAGE_MULTIPART_THRESHOLD:
+                url = await storage.filebase_store.presign_put(key, file.content_type)
+                uploads.append({'filename': filename, 'key': key, 'url': url})
+                continue
+            part_size = max(STORAGE_MULTIPART_CHUNKSIZE, -(-file.size // MAX_UPLOAD_PARTS))
+            upload_id = await storage.filebase_store.create_multipart_upload(key, file.content_type)
+            part_urls = [
+                await storage.filebase_store.presign_upload_part(key, upload_id, part_number)
+                for part_number in range(1, -(-file.size // part_size) + 1)
+            ]
+            uploads.append({'filename': filename, 'key': key, 'upload_id': upload_id, 'part_size': part_size, 'part_urls': part_urls})
+        await database_client.record_trs_uploads(current_user.id, data.title, [
+            (upload['key'], file.size, upload.get('upload_id'))
+            for upload, (file, _) in zip(uploads, upload_files(data, upload_uuid))
+        ], PRESIGNED_URL_TTL + TRS_UPLOAD_FINALIZE_GRACE)
+    except Exception as e:
+        for upload in uploads:
+            if upload.get('upload_id'):
+                try:
+                    await storage.filebase_store.abort_multipart_upload(upload['key'], upload['upload_id'])
+                except Exception as abort_error:
+                    logger.error(f"Error aborting upload of {upload['key']}: {abort_error}")
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Error creating upload URLs for {data.title}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    logger.info(f"Issued upload URLs for {len(uploads)} files of TRS {data.title} to {current_user.email}")
+    return {'upload_uuid': upload_uuid, 'uploads': uploads, 'expires_in': PRESIGNED_URL_TTL}
+
+
+@router.post("/create_trs_request/finalize", dependencies=[Depends(get_current_user)],tags=["TRS"], summary="Finalizes a TRS creation request", description="Checks the files uploaded with /create_trs_request/uploads and submits the TRS creation request.")
+async def finalize_trs_request(data: TrsFinalizeRequest, current_user: User = Depends(get_current_user)):
+    """
+    Second step of a TRS creation request with direct uploads. Every file must have been issued to the
+    caller by /create_trs_request/uploads, with the same size and upload id, and not have expired.
+    Multipart uploads are completed from the parts the client reports, every file is checked with a HEAD
+    request to exist with the declared size, and only then is the TRS creation request recorded.
+
+    Parameters:
+    data (TrsFinalizeRequest): The request details, and per file its size and, for multipart uploads, the upload id and parts.
+    current_user (User): The user making the TRS creation request.
+
+    Returns:
+    JSONResponse: A JSON response indicating the success of the TRS creation request.
+
+    Raises:
+    HTTPException: If a file was not issued to the caller, is missing or incomplete, or the title is invalid or taken.
+    """
+    if len(data.files) > 10:
+        return JSONResponse(status_code=400, content={"message": "A maximum of 10 files can be uploaded."})
+    await check_title_available(data.title)
+    files = upload_files(data, data.upload_uuid)
+    issued = await database_client.get_trs_uploads(current_user.id, [key for _, key in files])
+    for file, key in files:
+        upload = issued.get(key)
+        if upload is None or upload['upload_id'] != file.upload_id or upload['size'] != file.size:
+            raise HTTPException(status_code=400, detail=f"{file.filename} was not issued for upload, or its upload expired.")
+
+    async def verify(file, key):
+        if file.upload_id:
+            if not file.parts:
+                raise HTTPException(status_code=400, detail=f"No parts given for {file.filename}.")
+            await storage.filebase_store.complete_multipart_upload(key, file.upload_id, [(part.part_number, part.etag) for part in file.parts])
+        head = await storage.filebase_store.head_object(key)
+        if head['ContentLength'] != file.size:
+            raise HTTPException(status_code=400, detail=f"{file.filename} was not uploaded completely.")
+        await storage.cache_cid(key, head)
+
+    try:
+        await asyncio.gather(*(verify(file, key) for file, key in files))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error verifying the uploads of {data.title}: {e}")
+        raise HTTPException(status_code=400, detail=f"The uploaded files could not be verified: {e}")
+
+    file_url_header =  upload_prefix(data.upload_uuid)
+    try:
+        async with database_client.transaction():
+            await database_client.finalize_trs_uploads([issued[key]['id'] for _, key in files])
+            await database_client.add_trs_creation_request(data.model_name, data.title, data.description, current_user.email, file_url_header)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse(status_code= 200, content = {"message":"Trs creation request submitted succesfully. "})
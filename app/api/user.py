@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Response
 from pydantic import HttpUrl, BaseModel
 from app.utils.utils import get_current_user
 from app.core.database import database_client
 from app.utils.models import User
 from typing import Optional 
 from app.core.aws import upload_to_aws
+from app.utils.pagination import decode_cursor, next_cursor, page_size, NEXT_CURSOR_HEADER
 from app.utils.logging_config import logging_config  # Import the configuration file
 import logging.config
 logging.config.dictConfig(logging_config)
@@ -33,43 +34,37 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 
 
 @router.get('/wallet/get', dependencies=[Depends(get_current_user)],tags=["User"], description="Returns a formatted wallet, as a JSON with created TRS, TRS on marketplace, and TRS with artisan rights.")
-async def wallet_get(user: User = Depends(get_current_user)):
+async def wallet_get(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None, user: User = Depends(get_current_user)):
     """
     This function retrieves and formats the wallet of the current user. The wallet includes
     the created TRS, TRS on the marketplace, and TRS with artisan rights.
+    With a limit or a cursor, collections are returned one page at a time; the cursor of the next page,
+    if any, is returned in the X-Next-Cursor header.
 
     Parameters:
+    limit (int, optional): The number of collections per page; all of them if neither limit nor cursor is given.
+    cursor (str, optional): The X-Next-Cursor value of the previous page.
     user (User): The current user. This parameter is obtained from the 'get_current_user' function.
 
     Returns:
-    dict: A dictionary representing the formatted wallet. The dictionary contains the following keys:
-        - created_trs: A list of TRS created by the user.
-        - trs_on_marketplace: A list of TRS on the marketplace.
-        - trs_with_artisan_rights: A list of TRS with artisan rights.
+    dict: A dictionary keyed by collection name. Each entry contains:
+        - number: The number of TRS of the collection held by the user.
+        - created: Whether the user created the collection.
+        - artisan: The number of those TRS with artisan rights.
+        - marketplace: The number of those TRS on the marketplace.
+        - data: The collection data.
     """
     try:
-        wallet = await database_client.get_wallet_formatted(user.id)
+        limit = page_size(limit, cursor)
+        after = decode_cursor(cursor, 1)[0] if cursor else None
+        wallet = await database_client.get_wallet_summary(user.id, limit, after)
         logger.debug(wallet)
-        final_wallet = {}
-        
-        for trs in wallet['trs']:
-            if trs['collection_name'] in final_wallet.keys():
-                final_wallet[trs['collection_name']]['number'] +=1 
-                if trs['artisan'] == 1:
-                    final_wallet[trs['collection_name']]['artisan'] +=1
-                elif trs['marketplace'] == 1:
-                    final_wallet[trs['collection_name']]['marketplace'] +=1 
-                elif trs['creator'] == user.id:
-                    final_wallet[trs['collection_name']]['created'] = True
-            else:
-                collection_data = await database_client.get_collection_data(trs['collection_name'])
-                final_wallet[trs['collection_name']] = {'number': 1, 'created': False, 'artisan': 0,'marketplace': 0,'data':collection_data}
-                if trs['artisan'] == 1:
-                    final_wallet[trs['collection_name']]['artisan'] +=1
-                elif trs['marketplace'] == 1:
-                    final_wallet[trs['collection_name']]['marketplace'] +=1 
-
-        return final_wallet
+        cursor = next_cursor(list(wallet), limit, lambda collection_name: (collection_name,))
+        if cursor:
+            response.headers[NEXT_CURSOR_HEADER] = cursor
+        return wallet
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"Error fetching wallet: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -78,22 +73,10 @@ async def wallet_get(user: User = Depends(get_current_user)):
 @router.post('/artisan/activate',dependencies=[Depends(get_current_user)],tags=["User"],summary="Activates artisan rights for a user's TRS",description="Activates artisan rights for a user's TRS")
 async def artisan_activate(collection_name: str, number: int, user: User = Depends(get_current_user)) -> dict:
     try:
-        wallet = await database_client.get_wallet_formatted(user.id)
-        req_wallet = []
-        for i in wallet['trs']: 
-            logger.debug(i)
-            if i['collection_name'] == collection_name and i['marketplace'] == 0 and i['artisan'] == 0:
-                req_wallet.append(i)
-
-        if len(req_wallet) >= number:
-            values = []
-            for i in req_wallet[:number]:
-                values.append((i['trs_id'],))
-            await database_client.activate_artisan_trs(values, user.id)
-
-            return {"message": "Artisan rights activated. "}
-        else:
+        result = await database_client.activate_artisan_trs(user.id, collection_name, number)
+        if result is None:
             return {"message": F"Insufficient TRS of {collection_name} in wallet."}
+        return {"message": "Artisan rights activated. "}
     except Exception as e:
         logger.error("Error in activating artisan rights on trs. ", e)
         raise HTTPException(status_code = 500, detail = e)
@@ -103,20 +86,10 @@ async def artisan_activate(collection_name: str, number: int, user: User = Depen
 @router.post('/artisan/deactivate',dependencies=[Depends(get_current_user)],tags=["User"],summary="Deactivates artisan rights for a user's TRS",description="Deactivates artisan rights for a user's TRS")
 async def artisan_deactivate(collection_name: str, number: int, user: User = Depends(get_current_user)) -> dict:
     try:
-        wallet = await database_client.get_wallet_formatted(user.id)
-        req_wallet = []
-        for i in wallet['trs']: 
-            if i['collection_name'] == collection_name and i['marketplace'] == 0 and i['artisan'] == 1:
-                req_wallet.append(i)
-        if len(req_wallet) >= number:
-            values = []
-            for i in req_wallet[:number]:
-                values.append((i['trs_id'],))
-            await database_client.deactivate_artisan_trs(values, user.id)
-
-            return {"message": f"Artisan rights deactivated for the trs {collection_name}"}
-        else:
+        result = await database_client.deactivate_artisan_trs(user.id, collection_name, number)
+        if result is None:
             return {"message": f"Insufficient TRS of {collection_name} in wallet."}
+        return {"message": f"Artisan rights deactivated for the trs {collection_name}"}
         
     except Exception as e:
         logger.error("Error in deactivating artisan rights for trs. ", e)
@@ -139,7 +112,7 @@ async def onboard_data(
     profile_pic: UploadFile = File(...),
     current_user:User = Depends(get_current_user)
 ):
-    profile_pic_uri = upload_to_aws(profile_pic)
+    profile_pic_uri = await upload_to_aws(profile_pic)
     await database_client.store_user_details(current_user.email,first_name,last_name,username,bio,twitter,telegram,profile_pic_uri)
     return "Onboarding details succesfully added."
 
@@ -5,6 +5,8 @@ from botocore.exceptions import NoCredentialsError
 from dotenv import load_dotenv
 
 import mimetypes
+from botocore.client import Config
+from app.core.objectstore import S3ObjectStore, STORAGE_MAX_POOL_CONNECTIONS
 
 load_dotenv()
 
@@ -19,7 +21,9 @@ s3 = boto3.client(
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
     region_name=AWS_REGION,
+    config=Config(max_pool_connections=STORAGE_MAX_POOL_CONNECTIONS),
 )
+aws_store = S3ObjectStore(s3, AWS_BUCKET_NAME, name="aws")
 
 
 async def upload_to_aws(file: UploadFile):
@@ -29,12 +33,7 @@ async def upload_to_aws(file: UploadFile):
         content_type, _ = mimetypes.guess_type(file.filename)
         if content_type is None:
             content_type = "application/octet-stream"  
-        s3.upload_fileobj(
-            file.file,
-            AWS_BUCKET_NAME,
-            file.filename,
-            ExtraArgs={"ContentType": content_type}  
-        )
+        await aws_store.upload_fileobj(file.file, file.filename, content_type=content_type)
         file_url = f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file.filename}"
         return file_url
 
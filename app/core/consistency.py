@@ -0,0 +1,38 @@
+"""
+Checks that the holdings balances agree with the per-TRS rows in trs and listings.
+
+Every (user, collection) whose total, artisan, listed or reserved balance differs from the
+value recomputed from trs and listings is printed. The exit code is 1 if any mismatch is found.
+
+Usage:
+    python -m app.core.consistency            # report mismatches
+    python -m app.core.consistency --repair   # also rebuild the mismatching balances
+"""
+import argparse
+import asyncio
+import sys
+
+from app.core.database import database_client
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("database")
+
+
+async def check(repair=False):
+    await database_client.init_pool()
+    try:
+        return await database_client.check_holdings(repair)
+    finally:
+        await database_client.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the holdings balances with the trs and listings rows.")
+    parser.add_argument("--repair", action="store_true", help="Rebuild the balances that do not match.")
+    args = parser.parse_args()
+    mismatches = asyncio.run(check(args.repair))
+    for mismatch in mismatches:
+        print(f"{mismatch['user_id']} {mismatch['collection_name']}: expected (total, artisan, listed, reserved) = {mismatch['expected']}, found {mismatch['actual']}")
+    sys.exit(1 if mismatches and not args.repair else 0)
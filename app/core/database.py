@@ -1,13 +1,18 @@
 import asyncmy
 import asyncio
+import functools
 import uuid
+import json
 from fastapi import FastAPI, HTTPException
 from datetime import datetime, timedelta
-from app.core import storage
+from app.core.orderbook import order_book, price_key
 import os 
 import dotenv
 import random
+import time
 from datetime import datetime
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 dotenv.load_dotenv()
 
 import logging.config
@@ -15,30 +20,146 @@ from app.utils.logging_config import logging_config
 logging.config.dictConfig(logging_config)
 logger = logging.getLogger("database")
 
+# Rows per multi-row INSERT when minting.
+MINT_CHUNK_SIZE = int(os.getenv("MINT_CHUNK_SIZE", 5000))
+
+# Ids per block handed out by allocate_ids. Existing ids were laid out with this size
+# (see migration 0003), so it must not change once ids have been allocated.
+TRS_ID_BLOCK_SIZE = 10000
+
+# Listings locked per round trip when reserving, and TRS attached to a trade per statement batch.
+LISTING_CLAIM_BATCH_SIZE = int(os.getenv("LISTING_CLAIM_BATCH_SIZE", 16))
+RESERVE_BATCH_SIZE = int(os.getenv("RESERVE_BATCH_SIZE", 5000))
+
+# Times a unit of work InnoDB rolled back as a deadlock victim (error 1213) is run again, and the
+# base of the random backoff before each retry, in seconds.
+DEADLOCK_RETRIES = int(os.getenv("DATABASE_DEADLOCK_RETRIES", 3))
+DEADLOCK_RETRY_DELAY = float(os.getenv("DATABASE_DEADLOCK_RETRY_DELAY", 0.01))
+ER_LOCK_DEADLOCK = 1213
+
+# Run the reserve, settle and cancel steps of a trade as the stored procedures of migration 0006
+# (one round trip each) instead of statement by statement from Python.
+TRADE_PROCEDURES = os.getenv("TRADE_PROCEDURES", "false").lower() in ("1", "true", "yes")
+# Version of each procedure to call. trade_reserve_v2 (migration 0013) can reserve one trade at several
+# prices; set TRADE_RESERVE_PROCEDURE_VERSION=1 until that migration is applied.
+TRADE_PROCEDURE_VERSIONS = {
+    'trade_reserve': int(os.getenv("TRADE_RESERVE_PROCEDURE_VERSION", 2)),
+    'trade_settle': 2,
+    'trade_cancel': 1,
+}
+
+# Serve wallet reads and quantity checks from the holdings balances (migration 0005) instead of
+# counting trs rows. The balances are maintained either way.
+USE_HOLDINGS = os.getenv("USE_HOLDINGS", "false").lower() in ("1", "true", "yes")
+
+# Per-(user, collection) balances recomputed from trs and listings, in the shape of the holdings table.
+HOLDINGS_FROM_TRS = """
+SELECT t.user_id, t.collection_name, t.total, t.artisan, COALESCE(l.listed, 0) AS listed, t.reserved
+FROM (
+    SELECT user_id, collection_name, COUNT(*) AS total, SUM(artisan = 1) AS artisan, SUM(in_trade = 1) AS reserved
+    FROM trs
+    GROUP BY user_id, collection_name
+) AS t
+LEFT JOIN (
+    SELECT seller_id, collection_name, SUM(quantity) AS listed
+    FROM listings
+    GROUP BY seller_id, collection_name
+) AS l ON l.seller_id = t.user_id AND l.collection_name = t.collection_name
+"""
+
+# Connection owned by the unit of work running in the current task, if any.
+_current_connection = ContextVar("current_connection", default=None)
+# Callbacks to run once that unit of work commits.
+_commit_callbacks = ContextVar("commit_callbacks", default=None)
+
+
+def is_deadlock(error):
+    """True if `error`, or an error it was raised from, is InnoDB's deadlock error."""
+    while error is not None:
+        if isinstance(error, asyncmy.errors.OperationalError) and error.args and error.args[0] == ER_LOCK_DEADLOCK:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class SharedConnection:
+    """
+    Wraps the connection of an open unit of work when it is handed to a nested call.
+
+    Commit and rollback are left to the owner of the unit of work, so a nested method that
+    commits on success (as every DatabaseManager method does) does not end the transaction early.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
 class DatabaseManager:
     def __init__(self):
         self.pool = None
+        self.id_pool = None   # one connection of its own for allocate_ids
+        self.id_blocks = {}   # sequence name -> [next id, end of the cached range]
+        self.id_lock = asyncio.Lock()
         logger.info("Database Instance Created Successfully. ")
     async def init_pool(self):
-        """Initialize the database connection pool."""
-        self.pool = await asyncmy.create_pool(
+        """Initialize the database connection pool, and the connection allocate_ids commits on."""
+        settings = dict(
             host=os.getenv("DATABASE_HOST"),
             user=os.getenv("DATABASE_USERNAME"),
             password=os.getenv("DATABASE_PASSWORD"),
             database=os.getenv("DATABASE_NAME"),
-            minsize=5,
-            maxsize=10, 
             echo=True
         )
+        self.pool = await asyncmy.create_pool(
+            minsize=int(os.getenv("DATABASE_POOL_MINSIZE", 5)),
+            maxsize=int(os.getenv("DATABASE_POOL_MAXSIZE", 10)),
+            **settings
+        )
+        self.id_pool = await asyncmy.create_pool(minsize=1, maxsize=1, **settings)
         logger.info("Initialized Connection Pool successfully. ")
+
+    async def retry_on_deadlock(self, work):
+        """
+        Runs `work()`, a coroutine function that opens its own unit of work, and runs it again if InnoDB
+        rolled it back as a deadlock victim, up to DEADLOCK_RETRIES times after a short random backoff.
+        Inside an enclosing unit of work the deadlock rolled back the enclosing writes as well, so it is
+        raised for the owner of that unit of work to retry.
+        """
+        for attempt in range(DEADLOCK_RETRIES + 1):
+            try:
+                return await work()
+            except Exception as e:
+                if attempt == DEADLOCK_RETRIES or _current_connection.get() is not None or not is_deadlock(e):
+                    raise
+                logger.warning(f"Deadlock, retrying the transaction (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(random.uniform(0, DEADLOCK_RETRY_DELAY * 2 ** attempt))
+
+    async def close_pool(self):
+        """Closes the connection pools opened by init_pool."""
+        for pool in (self.pool, self.id_pool):
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
         
     async def get_connection(self):
         """
         Acquires a connection from the pool with retry logic.
+        Inside a unit of work (see `transaction`), the connection of that unit of work is returned instead.
 
         Returns:
         - Connection object
         """ 
+        shared = _current_connection.get()
+        if shared is not None:
+            return SharedConnection(shared)
         retries = 5
         for attempt in range(retries):
             try:
@@ -90,6 +211,66 @@ class DatabaseManager:
                     logger.error("Failed to acquire connection after retries.")
                     raise HTTPException(status_code=500, detail="Database connection error. Please try again later.")
 
+    async def release_connection(self, connection):
+        """
+        Returns a connection to the pool. Connections shared from a unit of work are released by its owner.
+        """
+        if isinstance(connection, SharedConnection):
+            return
+        await self.pool.release(connection)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Opens a unit of work. Every DatabaseManager call made inside it, including nested ones,
+        runs on the same pooled connection and is committed or rolled back once at the end.
+        Nested `transaction()` blocks join the outer one.
+
+        DB calls inside a unit of work must be awaited one after the other, not gathered,
+        since they share one connection.
+        Callbacks registered with `on_commit` run after the outermost commit.
+
+        Usage:
+            async with database_client.transaction() as connection:
+                ...
+        """
+        shared = _current_connection.get()
+        if shared is not None:
+            yield SharedConnection(shared)
+            return
+        connection = await self.get_connection()
+        callbacks = []
+        token = _current_connection.set(connection)
+        callbacks_token = _commit_callbacks.set(callbacks)
+        try:
+            yield connection
+            await connection.commit()
+        except BaseException:
+            await connection.rollback()
+            raise
+        else:
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Error in commit callback: {e}")
+        finally:
+            _commit_callbacks.reset(callbacks_token)
+            _current_connection.reset(token)
+            await self.pool.release(connection)
+
+    def on_commit(self, callback):
+        """
+        Runs `callback` once the outermost unit of work commits, or right away outside a unit of work.
+        Callbacks of a unit of work that is rolled back are dropped. Used to apply in-memory state,
+        such as the order book, only for writes that are durable.
+        """
+        callbacks = _commit_callbacks.get()
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
     async def login_user(self, user_id=None, email=None):
         connection = None
         try:
@@ -109,7 +290,7 @@ class DatabaseManager:
             logger.error("Failed to update last_login for user. ")
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
 
     async def add_user(self,email, password_hash):
         connection = None
@@ -130,7 +311,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
     async def get_user(self, user_id):
         connection = None
         try:
@@ -151,8 +332,39 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
     
+    async def get_users_batch(self, user_ids):
+        """
+        Fetches several users in one query.
+
+        Parameters:
+        - user_ids: iterable of user ids.
+
+        Returns:
+        - dict mapping each user id found to its users row.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = "SELECT * FROM users WHERE user_id IN (%s)" % ','.join(['%s'] * len(user_ids))
+                await cursor.execute(query, user_ids)
+                result1 = await cursor.fetchall()
+                columns = [column[0] for column in cursor.description]
+                users = [dict(zip(columns, row)) for row in result1]
+                return {user['user_id']: user for user in users}
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
     async def get_user_by_email(self, email):
         connection = None
         try:
@@ -178,7 +390,7 @@ class DatabaseManager:
         
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
     
     async def update_user(self, user_id, username=None, email=None, password_hash=None):
         connection = None
@@ -210,7 +422,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
 
     async def delete_user(self, user_id):
         connection = None
@@ -227,26 +439,24 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
 
     async def add_asset(self, values):
-        connection = None
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
                     
-                query = "INSERT INTO trs (user_id, trs_id, collection_name, creator) VALUES (%s, %s, %s, %s)"
-                logger.debug(values)
-                await cursor.executemany(query, values)
-                await connection.commit()
-                logger.info(f"Tokens added succesfully. ")
+                    query = "INSERT INTO trs (user_id, trs_id, collection_name, creator) VALUES (%s, %s, %s, %s)"
+                    logger.debug(values)
+                    await cursor.executemany(query, values)
+                    added = {}
+                    for user_id, trs_id, collection_name, creator in values:
+                        added[(user_id, collection_name)] = added.get((user_id, collection_name), 0) + 1
+                    await self.update_holdings(cursor, [(user_id, collection_name, number, 0, 0, 0) for (user_id, collection_name), number in added.items()])
+                    logger.info(f"Tokens added succesfully. ")
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                     
     async def get_owner(self, trs_id):
         connection = None
@@ -270,7 +480,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
     async def add_transaction(self, buyer_transaction_number, trs_id, buyer_id, seller_id, amount, number):
         connection = None
@@ -292,7 +502,7 @@ class DatabaseManager:
         
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                            
     async def modify_transaction(self, transaction_number,status):
         connection = None
@@ -312,56 +522,195 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
 
-    async def transfer_asset(self, user_id, trs_id):
+    async def allocate_ids(self, count, sequence_name='trs'):
+        """
+        Hands out `count` contiguous BIGINT ids (hi/lo allocation).
+
+        Ids are served from a range cached in memory; when it cannot cover `count`, enough blocks of
+        TRS_ID_BLOCK_SIZE for the whole request are reserved with one multi-row INSERT into id_blocks,
+        whose consecutive AUTO_INCREMENT values are the block numbers. The INSERT runs and commits on
+        id_pool, outside any unit of work the caller is in, so the blocks stay reserved when the mint
+        rolls back (its ids are simply skipped) and the id_blocks insert does not wait on the mint.
+        It has a pool of its own because a unit of work already holds a connection of the main pool,
+        and units of work waiting on a second one could exhaust it. Allocations are serialized, so
+        callers missing the cache together reserve blocks once.
+
+        Returns:
+        - range of the allocated ids.
+        """
+        cached = self.id_blocks.get(sequence_name)
+        if cached is None or cached[1] - cached[0] < count:
+            async with self.id_lock:
+                cached = self.id_blocks.get(sequence_name)
+                if cached is None or cached[1] - cached[0] < count:
+                    cached = await self.reserve_id_blocks(sequence_name, -(-count // TRS_ID_BLOCK_SIZE))
+        start = cached[0]
+        cached[0] += count
+        return range(start, start + count)
+
+    async def reserve_id_blocks(self, sequence_name, blocks):
+        """Reserves `blocks` id blocks on id_pool, committed on their own, and caches their range."""
+        if self.id_pool is None:
+            logger.error("Id allocation pool is not initialized!")
+            raise HTTPException(status_code=500, detail="Connection pool is not initialized.")
         connection = None
         try:
-            connection = await self.get_connection()
+            connection = await self.id_pool.acquire()
             async with connection.cursor() as cursor:
-                    
-                query = f"UPDATE trs SET user_id = %s WHERE trs_id = %s"
-
-                await cursor.execute(query, (user_id, trs_id))
-                logger.info(f"Transferred TRS {trs_id} to {user_id}.")
+                query = "INSERT INTO id_blocks (sequence_name) VALUES " + ",".join(["(%s)"] * blocks)
+                await cursor.execute(query, [sequence_name] * blocks)
+                first_hi = cursor.lastrowid
+                await connection.commit()
         except Exception as e:
-            await connection.rollback()
-            logger.error(f"Error: {e}")
+            if connection:
+                await connection.rollback()
+            logger.error(f"Error allocating ids: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        
         finally:
             if connection:
-                await self.pool.release(connection)
-                
-            
-    async def add_trs(self,number, mint_address, collection_name, token_account_address,creator_id):
-        connection = None
+                await self.id_pool.release(connection)
+        cached = [first_hi * TRS_ID_BLOCK_SIZE, (first_hi + blocks) * TRS_ID_BLOCK_SIZE]
+        self.id_blocks[sequence_name] = cached
+        logger.info(f"Allocated {blocks} id blocks for {sequence_name} starting at {cached[0]}")
+        return cached
+
+    async def update_holdings(self, cursor, changes):
+        """
+        Applies balance changes to the holdings table, creating missing rows.
+        Must run on the cursor of the write it accompanies, so both commit or roll back together.
+
+        Parameters:
+        - cursor: The cursor of the enclosing transaction.
+        - changes: iterable of (user_id, collection_name, total, artisan, listed, reserved) deltas.
+        """
+        changes = [change for change in changes if any(change[2:])]
+        if not changes:
+            return
+        query = """
+        INSERT INTO holdings (user_id, collection_name, total, artisan, listed, reserved)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            total = total + VALUES(total),
+            artisan = artisan + VALUES(artisan),
+            listed = listed + VALUES(listed),
+            reserved = reserved + VALUES(reserved)
+        """
+        await cursor.executemany(query, changes)
+
+    async def check_holdings(self, repair=False):
+        """
+        Compares the holdings balances with the balances recomputed from trs and listings.
+
+        Parameters:
+        - repair: If True, rebuilds the holdings of every mismatching (user, collection) from trs and listings.
+
+        Returns:
+        - list of dicts with user_id, collection_name, `expected` and `actual` (total, artisan, listed, reserved).
+        """
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                
-                batch_values = []
-                trs_id_values = []
-                for i in range(number):
-                    trs_id = uuid.uuid4().int
-                    batch_values.append((str(trs_id), collection_name, str(mint_address), str(token_account_address),str(creator_id)))
-                    trs_id_values.append((creator_id,str(trs_id),collection_name,creator_id))
-                
-                query = f"INSERT INTO collections (trs_id, collection_name, mint_address, token_account_address,creator_id) VALUES (%s, %s, %s, %s,%s)"
-                await cursor.executemany(query,batch_values)
-                await connection.commit()
-               
-                await self.add_asset(trs_id_values)  
-                   
-                logger.info(f"Added {number} tokens of collection name {collection_name} to {creator_id}.")
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    SELECT c.user_id, c.collection_name, c.total, c.artisan, c.listed, c.reserved,
+                           h.total, h.artisan, h.listed, h.reserved
+                    FROM (""" + HOLDINGS_FROM_TRS + """) AS c
+                    LEFT JOIN holdings h ON h.user_id = c.user_id AND h.collection_name = c.collection_name
+                    WHERE h.user_id IS NULL
+                       OR h.total <> c.total OR h.artisan <> c.artisan OR h.listed <> c.listed OR h.reserved <> c.reserved
+                    UNION ALL
+                    SELECT h.user_id, h.collection_name, 0, 0, 0, 0, h.total, h.artisan, h.listed, h.reserved
+                    FROM holdings h
+                    WHERE (h.total <> 0 OR h.artisan <> 0 OR h.listed <> 0 OR h.reserved <> 0)
+                      AND NOT EXISTS (SELECT 1 FROM trs t WHERE t.user_id = h.user_id AND t.collection_name = h.collection_name)
+                    """
+                    await cursor.execute(query)
+                    mismatches = []
+                    for row in await cursor.fetchall():
+                        mismatches.append({
+                            'user_id': row[0],
+                            'collection_name': row[1],
+                            'expected': tuple(int(value or 0) for value in row[2:6]),
+                            'actual': tuple(int(value or 0) for value in row[6:10]) if row[6] is not None else None
+                        })
+                    logger.info(f"Holdings check found {len(mismatches)} mismatches. ")
+                    if repair and mismatches:
+                        for mismatch in mismatches:
+                            await cursor.execute(
+                                "DELETE FROM holdings WHERE user_id = %s AND collection_name = %s",
+                                (mismatch['user_id'], mismatch['collection_name'])
+                            )
+                        await self.update_holdings(cursor, [
+                            (mismatch['user_id'], mismatch['collection_name']) + mismatch['expected']
+                            for mismatch in mismatches
+                        ])
+                        await cursor.executemany(
+                            "UPDATE holdings h SET h.created = EXISTS (SELECT 1 FROM trs t WHERE t.user_id = h.user_id AND t.collection_name = h.collection_name AND t.creator = h.user_id) WHERE h.user_id = %s AND h.collection_name = %s",
+                            [(mismatch['user_id'], mismatch['collection_name']) for mismatch in mismatches]
+                        )
+                        logger.info(f"Repaired holdings of {len(mismatches)} (user, collection) pairs. ")
+                    return mismatches
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def add_trs(self,number, mint_address, collection_name, token_account_address,creator_id, progress=None):
+        """
+        Mints `number` TRS of a collection to its creator.
+
+        Rows are generated and inserted in chunks of MINT_CHUNK_SIZE, as multi-row INSERTs into
+        `collections` and `trs`, all inside one transaction: memory stays bounded by the chunk size,
+        and a failure part-way leaves nothing behind.
+
+        Parameters:
+        - progress: Optional callable(minted, number, rows_per_second) invoked after every chunk.
+
+        Returns:
+        - dict with number, seconds and rows_per_second of the mint.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    started = time.monotonic()
+                    ids = await self.allocate_ids(number)
+                    minted = 0
+                    while minted < number:
+                        size = min(MINT_CHUNK_SIZE, number - minted)
+                        trs_ids = ids[minted:minted + size]
+
+                        collections_query = "INSERT INTO collections (trs_id, collection_name, mint_address, token_account_address,creator_id) VALUES " + ",".join(["(%s, %s, %s, %s, %s)"] * size)
+                        collections_values = []
+                        for trs_id in trs_ids:
+                            collections_values += [trs_id, collection_name, str(mint_address), str(token_account_address), str(creator_id)]
+                        await cursor.execute(collections_query, collections_values)
+
+                        trs_query = "INSERT INTO trs (user_id, trs_id, collection_name, creator) VALUES " + ",".join(["(%s, %s, %s, %s)"] * size)
+                        trs_values = []
+                        for trs_id in trs_ids:
+                            trs_values += [creator_id, trs_id, collection_name, creator_id]
+                        await cursor.execute(trs_query, trs_values)
+
+                        minted += size
+                        rows_per_second = minted / max(time.monotonic() - started, 1e-9)
+                        logger.info(f"Minted {minted}/{number} TRS of {collection_name} ({rows_per_second:.0f} rows/s)")
+                        if progress:
+                            progress(minted, number, rows_per_second)
+
+                    holdings_query = """
+                    INSERT INTO holdings (user_id, collection_name, total, created)
+                    VALUES (%s, %s, %s, 1)
+                    ON DUPLICATE KEY UPDATE total = total + VALUES(total), created = 1
+                    """
+                    await cursor.execute(holdings_query, (creator_id, collection_name, number))
+
+                    seconds = time.monotonic() - started
+                    logger.info(f"Added {number} tokens of collection name {collection_name} to {creator_id} in {seconds:.2f}s.")
+                    return {'number': number, 'seconds': seconds, 'rows_per_second': number / max(seconds, 1e-9)}
         except Exception as e:
-                await connection.rollback()
                 logger.error(f"Error: {e}")
                 raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                 
     async def add_paypal_transaction(self, transaction_number, buyer_id, seller_id, amount):
         connection = None
@@ -381,7 +730,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
     async def modify_paypal_transaction(self,transaction_id,status): 
         connection = None
@@ -400,34 +749,29 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                      
     async def get_wallet(self, user_id):
-        connection = None
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.info(f"User not found {user_id}")
-                    return None
-                else:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if not await self.get_user(user_id):
+                        logger.info(f"User not found {user_id}")
+                        return None
+                    else:
 
                         
-                    query = "SELECT trs_id,collection_name FROM trs WHERE user_id = %s"
-                    await cursor.execute(query, (user_id,))
-                    result1 = await cursor.fetchall()
-                    columns = [column[0] for column in cursor.description]
-                    result = [dict(zip(columns, row)) for row in result1]
-                    logger.info(f"Returned wallet of user {user_id}")
-                    return result
+                        query = "SELECT trs_id,collection_name FROM trs WHERE user_id = %s"
+                        await cursor.execute(query, (user_id,))
+                        result1 = await cursor.fetchall()
+                        columns = [column[0] for column in cursor.description]
+                        result = [dict(zip(columns, row)) for row in result1]
+                        logger.info(f"Returned wallet of user {user_id}")
+                        return result
                 
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                 
     async def get_collection_data(self,name):
         connection = None
@@ -447,8 +791,42 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
+    async def get_collection_data_batch(self, names):
+        """
+        Fetches the collection_data rows of several collections in one query.
+
+        Parameters:
+        - names: iterable of collection names.
+
+        Returns:
+        - dict mapping each collection name to its list of collection_data rows (empty if none).
+        """
+        names = list(dict.fromkeys(names))
+        if not names:
+            return {}
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = "SELECT * FROM collection_data WHERE name IN (%s)" % ','.join(['%s'] * len(names))
+                await cursor.execute(query, names)
+                result1 = await cursor.fetchall()
+                columns = [column[0] for column in cursor.description]
+                result = {name: [] for name in names}
+                for row in result1:
+                    data = dict(zip(columns, row))
+                    result.setdefault(data['name'], []).append(data)
+                return result
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
     async def get_approved_transactions(self,buyer_transaction_id):
         connection = None
         try:
@@ -467,7 +845,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                        
     
     
@@ -490,7 +868,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
 
     
@@ -512,32 +890,8 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                   
-    async def get_wallet_by_collection(self,user_id,collection_id):
-        connection = None
-        try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.error(f"User not found {user_id}")
-                    return None
-                else:
-                    query = "SELECT trs_id, collection_name FROM trs WHERE user_id = %s AND collection_name = %s"
-                    await cursor.execute(query, (user_id, collection_id))
-                    result1 = await cursor.fetchall()
-                    columns = [column[0] for column in cursor.description]
-                    result = [dict(zip(columns, row)) for row in result1]
-                    logger.info(f"Selected wallet by collection {collection_id}, from {user_id}")
-                    return result
-        except Exception as e:
-            await connection.rollback()
-            logger.error(f"Error: {e}")
-            raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
-                            
     async def get_mint_address(self,collection_name):
         connection = None
         try:
@@ -556,7 +910,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
     
     
@@ -581,127 +935,252 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                  
-    async def get_wallet_formatted(self,user_id):
+    async def get_wallet_summary(self, user_id, limit=None, after=None):
+        """
+        Returns the per-collection counts of a user's wallet, computed in SQL rather than
+        by loading one row per TRS. With USE_HOLDINGS the counts are read from the holdings balances.
 
-        connection = None
+        Parameters:
+        - user_id: The owner of the wallet.
+        - limit: Optional number of collections to return, ordered by collection name.
+        - after: Optional collection name of the last entry of the previous page.
+
+        Returns:
+        - dict mapping collection name to:
+            - number: TRS held in the collection
+            - artisan: TRS with artisan rights active
+            - marketplace: TRS listed on the marketplace, including those held by unfinished trades
+            - created: whether the user created the collection
+            - data: the collection_data rows of the collection
+        """
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.info(f"User not found {user_id}")
-                    return None
-                else: 
-                    query = "SELECT trs_id,collection_name,creator,artisan,marketplace FROM trs WHERE user_id = %s"
-                    await cursor.execute(query, (user_id,))
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if USE_HOLDINGS:
+                        query = """
+                        SELECT collection_name, total AS number, artisan, listed + reserved AS marketplace, created
+                        FROM holdings
+                        WHERE user_id = %s AND total > 0 {after}
+                        ORDER BY collection_name
+                        {limit}
+                        """
+                        values = [user_id]
+                    else:
+                        query = """
+                        SELECT t.collection_name,
+                               COUNT(*) AS number,
+                               SUM(t.artisan = 1) AS artisan,
+                               COALESCE(l.listed, 0) AS marketplace,
+                               MAX(t.creator = %s) AS created
+                        FROM trs t
+                        LEFT JOIN (
+                            SELECT collection_name, SUM(quantity + reserved) AS listed
+                            FROM listings
+                            WHERE seller_id = %s
+                            GROUP BY collection_name
+                        ) AS l ON l.collection_name = t.collection_name
+                        WHERE t.user_id = %s {after}
+                        GROUP BY t.collection_name, l.listed
+                        ORDER BY t.collection_name
+                        {limit}
+                        """
+                        values = [user_id, user_id, user_id]
+                    after_clause = ("AND collection_name > %s" if USE_HOLDINGS else "AND t.collection_name > %s")
+                    query = query.format(
+                        after=after_clause if after is not None else "",
+                        limit="LIMIT %s" if limit is not None else ""
+                    )
+                    if after is not None:
+                        values.append(after)
+                    if limit is not None:
+                        values.append(limit)
+                    await cursor.execute(query, values)
                     result1 = await cursor.fetchall()
                     columns = [column[0] for column in cursor.description]
-                    result = [dict(zip(columns, row)) for row in result1]
-                    created_trs = []
-                    artisan_trs = []
-                    marketplace_trs = []
-                    none_trs = []
-                    for i in result: 
-                        if i['creator'] == user_id:
-                            created_trs.append(i)
-                        if i['marketplace'] == 1:
-                            marketplace_trs.append(i)
-                        elif i['artisan'] == 1:
-                            artisan_trs.append(i)
-
-                        none_trs.append(i)
-
-
-                    logger.info(f"Returning formatted wallet for user {user_id} ")
-                    return {
-                        "created_trs": created_trs,
-                        "artisan_trs":artisan_trs,
-                        "marketplace_trs":marketplace_trs,
-                        "trs": none_trs
-                    }
+                    rows = [dict(zip(columns, row)) for row in result1]
+                    collection_data = await self.get_collection_data_batch([row['collection_name'] for row in rows])
+                    wallet = {}
+                    for row in rows:
+                        wallet[row['collection_name']] = {
+                            'number': int(row['number']),
+                            'created': bool(row['created']),
+                            'artisan': int(row['artisan'] or 0),
+                            'marketplace': int(row['marketplace'] or 0),
+                            'data': collection_data.get(row['collection_name'], [])
+                        }
+                    logger.info(f"Returning wallet summary for user {user_id} ")
+                    return wallet
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
-                 
-    async def add_trs_to_marketplace(self,user_id,values,values2, collection_name):
 
-        connection = None
+    async def get_listable_quantity(self, user_id, collection_name):
+        """
+        Returns how many TRS of a collection the user can still list or activate artisan rights on:
+        TRS that are neither artisan nor held by a trade, minus the quantity already listed.
+        Listings do not pin specific TRS, so this is the invariant that keeps them covered.
+
+        The user's holdings row is locked for the rest of the enclosing transaction before anything is
+        counted, so concurrent listings, delistings and trades of the same user are serialised; they all
+        update that row whether or not USE_HOLDINGS is set. With USE_HOLDINGS the quantity is read from
+        the locked row itself.
+        """
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                    
-                query = "INSERT INTO marketplace (trs_id,collection_name,order_type,buyer_seller_id,bid_price) VALUES (%s,%s,%s,%s,%s)"
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    SELECT total - artisan - listed - reserved
+                    FROM holdings
+                    WHERE user_id = %s AND collection_name = %s
+                    FOR UPDATE
+                    """
+                    await cursor.execute(query, (user_id, collection_name))
+                    result = await cursor.fetchone()
+                    if USE_HOLDINGS:
+                        return max(int(result[0]), 0) if result else 0
+                    query = """
+                    SELECT (SELECT COUNT(*) FROM trs
+                            WHERE user_id = %s AND collection_name = %s AND artisan = 0 AND in_trade = 0)
+                         - (SELECT COALESCE(SUM(quantity), 0) FROM listings
+                            WHERE seller_id = %s AND collection_name = %s) AS listable
+                    """
+                    await cursor.execute(query, (user_id, collection_name, user_id, collection_name))
+                    result = await cursor.fetchone()
+                    return max(int(result[0] or 0), 0)
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
 
-                await cursor.executemany(query, values)
-                
-                query = "UPDATE trs set marketplace = 1 WHERE trs_id = %s"
-                
-                await cursor.executemany(query,values2)
-                await connection.commit()
-                logger.info(f"Added {len(values)} trs of collection {collection_name} to the Marketplace")
-                return {'message':f"Added trs {len(values)} of collection {collection_name} to the Marketplace"}
+    async def add_trs_to_marketplace(self, user_id, collection_name, price, number):
+        """
+        Lists `number` TRS of a collection at `price` as a single listing row.
 
+        Returns:
+        - dict with a message, or None if the user does not have `number` listable TRS.
+        """
+        try:
+            if number <= 0:
+                raise ValueError(f"The number of TRS to list must be positive, got {number}")
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if await self.get_listable_quantity(user_id, collection_name) < number:
+                        logger.info(f"Insufficient listable TRS of {collection_name} for {user_id}")
+                        return None
+                    query = "INSERT INTO listings (seller_id, collection_name, price, quantity) VALUES (%s, %s, %s, %s)"
+                    await cursor.execute(query, (user_id, collection_name, price, number))
+                    await self.update_holdings(cursor, [(user_id, collection_name, 0, 0, number, 0)])
+            self.on_commit(functools.partial(order_book.add, collection_name, price, number))
+            logger.info(f"Added {number} trs of collection {collection_name} to the Marketplace")
+            return {'message':f"Added trs {number} of collection {collection_name} to the Marketplace"}
 
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                 
                 
-    async def remove_trs_from_marketplace(self, values,user_id):
-        connection = None
-        try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.info(f"User not found {user_id}")
-                    return None
-                else:
-
-                        
-                    query = "DELETE FROM marketplace where trs_id = %s"
+    async def remove_trs_from_marketplace(self, user_id, collection_name, number):
+        """
+        Delists `number` TRS of a collection, taking them from the user's newest listings first.
+        Quantity reserved by unfinished trades cannot be delisted.
 
-                    await cursor.executemany(query, values)
-                    
-                    query = "UPDATE trs set marketplace = 0 WHERE trs_id = %s"
-                    await cursor.executemany(query,values)
-                    await connection.commit()
-                    logger.info(f"Removed trs from the Marketplace")
-                    return {'message':f"Removed trs from the Marketplace"}
+        Returns:
+        - dict with a message, or None if fewer than `number` TRS are listed and unreserved.
+        """
+        try:
+            if number <= 0:
+                raise ValueError(f"The number of TRS to delist must be positive, got {number}")
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    SELECT listing_id, price, quantity, reserved
+                    FROM listings
+                    WHERE seller_id = %s AND collection_name = %s AND quantity > 0
+                    ORDER BY created_at DESC, listing_id DESC
+                    FOR UPDATE
+                    """
+                    await cursor.execute(query, (user_id, collection_name))
+                    listings = await cursor.fetchall()
+                    if sum(listing[2] for listing in listings) < number:
+                        logger.info(f"Insufficient listed TRS of {collection_name} for {user_id}")
+                        return None
+                    removed_levels = []
+                    remaining = number
+                    for listing_id, price, quantity, reserved in listings:
+                        if remaining == 0:
+                            break
+                        take = min(quantity, remaining)
+                        if take == quantity and reserved == 0:
+                            await cursor.execute("DELETE FROM listings WHERE listing_id = %s", (listing_id,))
+                        else:
+                            await cursor.execute("UPDATE listings SET quantity = quantity - %s WHERE listing_id = %s", (take, listing_id))
+                        removed_levels.append((price, take))
+                        remaining -= take
+                    await self.update_holdings(cursor, [(user_id, collection_name, 0, 0, -number, 0)])
+            for price, take in removed_levels:
+                self.on_commit(functools.partial(order_book.remove, collection_name, price, take))
+            logger.info(f"Removed {number} trs of collection {collection_name} from the Marketplace")
+            return {'message':f"Removed trs from the Marketplace"}
 
 
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                 
-    async def get_marketplace_all(self):
+    async def get_marketplace_all(self, limit=None, after=None):
+        """
+        Fetches every (collection, price) level on the marketplace together with its collection data,
+        in a single query.
+
+        Parameters:
+        - limit: Optional number of levels to return, ordered by (collection_name, bid_price).
+        - after: Optional (collection_name, bid_price) of the last level of the previous page.
 
+        Returns:
+        - list of dicts with collection_name, bid_price, number_of_trs (the quantity that can still be bought)
+          and collection_data (the matching collection_data rows, as returned by get_collection_data).
+        """
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
                     
-                query = "SELECT  collection_name, bid_price, COUNT(*) AS number_of_trs from  marketplace GROUP BY collection_name,bid_price "
+                query = """
+                SELECT m.collection_name, m.bid_price, m.number_of_trs, cd.*
+                FROM (
+                    SELECT collection_name, price AS bid_price, SUM(quantity) AS number_of_trs
+                    FROM listings
+                    {after}
+                    GROUP BY collection_name, price
+                    HAVING SUM(quantity) > 0
+                    ORDER BY collection_name, price
+                    {limit}
+                ) AS m
+                LEFT JOIN collection_data cd ON cd.name = m.collection_name
+                ORDER BY m.collection_name, m.bid_price
+                """.format(
+                    after="WHERE collection_name > %s OR (collection_name = %s AND price > %s)" if after is not None else "",
+                    limit="LIMIT %s" if limit is not None else ""
+                )
+                values = []
+                if after is not None:
+                    values += [after[0], after[0], after[1]]
+                if limit is not None:
+                    values.append(limit)
 
-                await cursor.execute(query)
+                await cursor.execute(query, values or None)
                 result1 = await cursor.fetchall()
                 columns = [column[0] for column in cursor.description]
-                results = [dict(zip(columns, row)) for row in result1]
-                for collection in results: 
-                    data = await self.get_collection_data(collection['collection_name'])
-                    collection['collection_data'] = data
+                data_columns = columns[3:]
+                levels = {}
+                for row in result1:
+                    key = (row[0], row[1])
+                    if key not in levels:
+                        levels[key] = {'collection_name': row[0], 'bid_price': row[1], 'number_of_trs': int(row[2]), 'collection_data': []}
+                    if any(value is not None for value in row[3:]):
+                        levels[key]['collection_data'].append(dict(zip(data_columns, row[3:])))
+                results = list(levels.values())
                     
                 logger.info(f"Entire Marketplace fetched successfully. ")
                 return results
@@ -714,16 +1193,42 @@ class DatabaseManager:
 
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
                 
+    async def get_marketplace_levels(self):
+        """
+        Fetches the quantity listed and the quantity held by unfinished trades for every
+        (collection, price) level. Used to load and reconcile the in-memory order book.
+        """
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                SELECT collection_name, price AS bid_price, SUM(quantity + reserved) AS listed, SUM(reserved) AS reserved
+                FROM listings
+                GROUP BY collection_name, price
+                """
+                await cursor.execute(query)
+                result1 = await cursor.fetchall()
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in result1]
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
     async def get_marketplace_collection(self, collection_name: str):
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
                     
-                query = "SELECT  collection_name, bid_price, COUNT(*) AS number_of_trs from  marketplace WHERE collection_name = %s GROUP BY collection_name,bid_price "
+                query = "SELECT collection_name, price AS bid_price, SUM(quantity) AS number_of_trs FROM listings WHERE collection_name = %s GROUP BY collection_name, price HAVING SUM(quantity) > 0 ORDER BY price"
 
                 await cursor.execute(query, (collection_name,))
                 result = await cursor.fetchall()
@@ -738,7 +1243,7 @@ class DatabaseManager:
 
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                                 
 
     async def add_admin(self, email: str) -> None:
@@ -760,7 +1265,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
     async def verify_user(self, email: str) -> None:
         connection = None
@@ -781,59 +1286,74 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
                 
     
-    async def activate_artisan_trs(self,values, user_id):
+    async def activate_artisan_trs(self, user_id, collection_name, number):
+        """
+        Activates artisan rights on `number` of the user's TRS of a collection that are not
+        listed or held by a trade.
 
-        connection = None
+        Returns:
+        - dict with a message, or None if the user does not have `number` such TRS.
+        """
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.info(f"User not found {user_id}")
-                    return None
-                else:
-                        query = "UPDATE trs set artisan = 1 WHERE trs_id = %s"
-                        await cursor.executemany(query,values)
-                        await connection.commit()
-                        logger.info(f"Activated TRS rights for {user_id}")
-                        return {'message':f"Activated TRS rights for {user_id}"}
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if await self.get_listable_quantity(user_id, collection_name) < number:
+                        logger.info(f"Insufficient TRS of {collection_name} for {user_id}")
+                        return None
+                    query = """
+                    UPDATE trs set artisan = 1
+                    WHERE user_id = %s AND collection_name = %s AND artisan = 0 AND in_trade = 0
+                    ORDER BY trs_id
+                    LIMIT %s
+                    """
+                    await cursor.execute(query, (user_id, collection_name, number))
+                    await self.update_holdings(cursor, [(user_id, collection_name, 0, cursor.rowcount, 0, 0)])
+                    logger.info(f"Activated TRS rights for {user_id}")
+                    return {'message':f"Activated TRS rights for {user_id}"}
 
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                 
     
-    async def deactivate_artisan_trs(self,values, user_id):
-        connection = None
+    async def deactivate_artisan_trs(self, user_id, collection_name, number):
+        """
+        Deactivates artisan rights on `number` of the user's TRS of a collection.
+
+        Returns:
+        - dict with a message, or None if fewer than `number` of the user's TRS have artisan rights.
+        """
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
-                if not await self.get_user(user_id):
-                    logger.info(f"User not found {user_id}")
-                    return None
-                else:
-                    
-                    query = "UPDATE trs set artisan = 0 WHERE trs_id = %s"
-                    await cursor.executemany(query,values)
-                    await connection.commit()
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if USE_HOLDINGS:
+                        query = "SELECT artisan FROM holdings WHERE user_id = %s AND collection_name = %s FOR UPDATE"
+                    else:
+                        query = "SELECT COUNT(*) FROM trs WHERE user_id = %s AND collection_name = %s AND artisan = 1"
+                    await cursor.execute(query, (user_id, collection_name))
+                    result = await cursor.fetchone()
+                    if not result or int(result[0]) < number:
+                        logger.info(f"Insufficient artisan TRS of {collection_name} for {user_id}")
+                        return None
+                    query = """
+                    UPDATE trs set artisan = 0
+                    WHERE user_id = %s AND collection_name = %s AND artisan = 1
+                    ORDER BY trs_id
+                    LIMIT %s
+                    """
+                    await cursor.execute(query, (user_id, collection_name, number))
+                    await self.update_holdings(cursor, [(user_id, collection_name, 0, -cursor.rowcount, 0, 0)])
                     logger.info(f"Deactivated artisan rights for TRS {user_id}")
                     return {'message':f"Deactivated artisan rights for TRS {user_id}"}
 
 
         except Exception as e:
-            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            if connection:
-                await self.pool.release(connection)
                         
     async def check_collection_exists(self,name):
         connection = None
@@ -857,7 +1377,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                    
     async def add_trs_creation_request(self,model_name,title,description,creator_email, file_url_header):
         connection = None
@@ -875,16 +1395,32 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                       
-    async def get_trs_creation_requests(self,status):
+    async def get_trs_creation_requests(self,status, limit=None, after=None):
+        """
+        Returns the TRS creation requests with the given status, ordered by id.
+
+        Parameters:
+        - status: The request status, e.g. 'pending' or 'approved'.
+        - limit: Optional page size.
+        - after: Optional id of the last request of the previous page.
+        """
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
                     
                 query = "SELECT * FROM trs_creation_requests WHERE status = %s"
-                await cursor.execute(query, (status,))
+                values = [status]
+                if after is not None:
+                    query += " AND id > %s"
+                    values.append(after)
+                query += " ORDER BY id"
+                if limit is not None:
+                    query += " LIMIT %s"
+                    values.append(limit)
+                await cursor.execute(query, values)
                 
                 result1 = await cursor.fetchall()
                 logger.debug(result1)
@@ -898,7 +1434,7 @@ class DatabaseManager:
         
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
     
     async def get_trs_creation_data(self,id):
@@ -920,257 +1456,1044 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                        
-    async def add_collection_data(self,name,creator,description,number,url_header):
+    async def add_collection_data(self,name,creator,description,number,image_uri):
+        """
+        Adds the collection_data row of a new collection. `image_uri` is resolved by the caller
+        (see storage.get_image_uri), so no storage call is made while the connection is held.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "INSERT INTO collection_data (name,creator, description, number, image_uri) VALUES (%s, %s, %s,%s,%s)"
+                    
+                    values = (name,creator,description,number,image_uri)
+                    await cursor.execute(query, values)
+                    logger.info(f"Collection data has been added for {name} . ")
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def get_object_cids(self, object_keys):
+        """
+        Looks up cached CIDs of uploaded objects.
+
+        Returns:
+        - dict mapping each cached object key to its CID; keys not in the cache are left out.
+        """
+        object_keys = list(dict.fromkeys(object_keys))
+        if not object_keys:
+            return {}
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
-                    
-                user_id = str(uuid.uuid4())
-                cid = storage.get_file_cid(f'{url_header}thumbnail.png')
-                image_uri = 'https://ipfs.filebase.io/ipfs/' + str(cid)
-                query = "INSERT INTO collection_data (name,creator, description, number, image_uri) VALUES (%s, %s, %s,%s,%s)"
-                
-                values = (name,creator,description,number,image_uri)
-                await cursor.execute(query, values)
-                await connection.commit()
-                logger.info(f"Collection data has been added for {name} . ")
+                query = "SELECT object_key, cid FROM storage_objects WHERE object_key IN (%s)" % ','.join(['%s'] * len(object_keys))
+                await cursor.execute(query, object_keys)
+                return {object_key: cid for object_key, cid in await cursor.fetchall()}
         except Exception as e:
             await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
-                                   
-            
-    async def approve_trs_creation_request(self,id,creator_email,number,mint_address,collection_name,token_account_address):
+                await self.release_connection(connection)
+
+    async def store_object_cids(self, objects):
+        """
+        Caches the CIDs of uploaded objects, replacing the CID of a key that was uploaded again.
+
+        Parameters:
+        - objects: list of (object_key, cid, size, sha256) tuples; size and sha256 may be None.
+        """
+        if not objects:
+            return
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    INSERT INTO storage_objects (object_key, cid, size, sha256) VALUES (%s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE cid = VALUES(cid), size = VALUES(size), sha256 = VALUES(sha256)
+                    """
+                    await cursor.executemany(query, objects)
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def get_object_by_digest(self, sha256):
+        """
+        Finds an uploaded object with the given content hash.
+
+        Returns:
+        - dict with object_key, cid and size, or None if no object has that content.
+        """
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
-                q1 = "select * from trs_creation_requests where id = %s"
-                query = "UPDATE trs_creation_requests set status = 'approved' WHERE id = %s"
-                await cursor.execute(query,(id,))
-                logger.info(f"Approved TRS creation request {id}")
-                creation_data = await self.get_trs_creation_data(id)
-                logger.info(creation_data)
-                creation_data = creation_data[0]
-                await self.add_collection_data(creation_data['title'],creator_email,creation_data['description'],number,creation_data['file_url_header'])
-                creator_id = await self.get_user_by_email(creator_email)
-                creator_id = creator_id['user_id']
-                await self.add_trs(number,mint_address,collection_name,token_account_address,creator_id)
-                logger.info(f"Finalized TRS Creation request. {id} from {creator_email}")
-                await connection.commit()
+                query = "SELECT object_key, cid, size FROM storage_objects WHERE sha256 = %s ORDER BY created_at LIMIT 1"
+                await cursor.execute(query, (sha256,))
+                row = await cursor.fetchone()
+                if row is None:
+                    return None
+                columns = [column[0] for column in cursor.description]
+                return dict(zip(columns, row))
         except Exception as e:
-            print(e)
             await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
+            
+    async def approve_trs_creation_request(self,id,creator_email,number,mint_address,collection_name,token_account_address,image_uri):
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    q1 = "select * from trs_creation_requests where id = %s"
+                    query = "UPDATE trs_creation_requests set status = 'approved' WHERE id = %s"
+                    await cursor.execute(query,(id,))
+                    logger.info(f"Approved TRS creation request {id}")
+                    creation_data = await self.get_trs_creation_data(id)
+                    logger.info(creation_data)
+                    creation_data = creation_data[0]
+                    await self.add_collection_data(creation_data['title'],creator_email,creation_data['description'],number,image_uri)
+                    creator_id = await self.get_user_by_email(creator_email)
+                    creator_id = creator_id['user_id']
+                    await self.add_trs(number,mint_address,collection_name,token_account_address,creator_id)
+                    logger.info(f"Finalized TRS Creation request. {id} from {creator_email}")
+        except Exception as e:
+            print(e)
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
                 
                 
+    async def call_procedure(self, cursor, name, args):
+        """
+        Calls the version of a trade procedure set in TRADE_PROCEDURE_VERSIONS and drains its result sets.
+
+        Returns:
+        - list of dicts, the rows of the first result set (empty if the procedure returns none).
+        """
+        await cursor.callproc(f"{name}_v{TRADE_PROCEDURE_VERSIONS[name]}", args)
+        rows = []
+        if cursor.description:
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in await cursor.fetchall()]
+        while await cursor.nextset():
+            pass
+        return rows
+
+    async def claim_listings(self, cursor, collection_name, cost, number):
+        """
+        Locks enough listings at (collection_name, cost), oldest first, to cover `number` TRS.
+
+        Listings are claimed a page at a time with FOR UPDATE SKIP LOCKED, so concurrent buyers at the
+        same price lock disjoint listings instead of queueing behind each other. The first page is one
+        listing and each next page twice the last, up to LISTING_CLAIM_BATCH_SIZE, so a buyer covered by
+        a few listings does not lock ones other buyers need. Only if the unlocked listings cannot cover
+        `number` does it wait for the ones held by other buyers; those waits can deadlock with another
+        waiting buyer, which trade_create_levels retries.
+
+        Returns:
+        - list of (listing_id, seller_id, quantity) tuples, in the order they should be drawn from.
+        """
+        claim_query = """
+        SELECT listing_id, seller_id, quantity, created_at
+        FROM listings
+        WHERE collection_name = %s AND price = %s AND quantity > 0 {after}
+        ORDER BY created_at, listing_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """
+        listings = []
+        available = 0
+        page_size = 1
+        while available < number:
+            values = [collection_name, cost]
+            if listings:
+                values += [listings[-1][3], listings[-1][3], listings[-1][0]]
+            values.append(page_size)
+            await cursor.execute(claim_query.format(
+                after="AND (created_at > %s OR (created_at = %s AND listing_id > %s))" if listings else ""
+            ), values)
+            page = await cursor.fetchall()
+            listings += page
+            available += sum(listing[2] for listing in page)
+            if len(page) < page_size:
+                break
+            page_size = min(page_size * 2, LISTING_CLAIM_BATCH_SIZE)
+        if available < number:
+            logger.info(f"Listings of {collection_name} at {cost} are held by other buyers, waiting for them. ")
+            wait_query = """
+            SELECT listing_id, seller_id, quantity, created_at
+            FROM listings
+            WHERE collection_name = %s AND price = %s AND quantity > 0
+            ORDER BY created_at, listing_id
+            FOR UPDATE
+            """
+            await cursor.execute(wait_query, (collection_name, cost))
+            listings = await cursor.fetchall()
+            available = sum(listing[2] for listing in listings)
+            if available < number:
+                raise ValueError(f"Not enough trs available. Required: {number}, Found: {available}")
+        return [(listing_id, seller_id, quantity) for listing_id, seller_id, quantity, created_at in listings]
+
+    async def claim_trs(self, cursor, trade_id, buyer_id, listing_id, seller_id, collection_name, number):
+        """
+        Attaches `number` of the seller's free TRS to a trade and marks them in_trade.
+
+        TRS are locked with FOR UPDATE SKIP LOCKED in batches of RESERVE_BATCH_SIZE; each batch is
+        marked in_trade before the next is read, so batches never overlap and concurrent trades on
+        the same seller skip each other's rows.
+        """
+        select_query = """
+        SELECT trs_id
+        FROM trs
+        WHERE user_id = %s AND collection_name = %s AND artisan = 0 AND in_trade = 0
+        ORDER BY trs_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """
+        claimed = 0
+        while claimed < number:
+            size = min(RESERVE_BATCH_SIZE, number - claimed)
+            await cursor.execute(select_query, (seller_id, collection_name, size))
+            trs_ids = [row[0] for row in await cursor.fetchall()]
+            if not trs_ids:
+                raise ValueError(f"Listing {listing_id} is not covered by the seller's TRS. Required: {number}, Found: {claimed}")
+            trade_insert_query = "INSERT INTO trades (trade_id, buyer_id, seller_id, trs_id, listing_id, status) VALUES " + ",".join(["(%s, %s, %s, %s, %s, 'initiated')"] * len(trs_ids))
+            trade_values = []
+            for trs_id in trs_ids:
+                trade_values += [trade_id, buyer_id, seller_id, trs_id, listing_id]
+            await cursor.execute(trade_insert_query, trade_values)
+            update_trs_query = "UPDATE trs SET in_trade = 1 WHERE trs_id IN (%s)" % ','.join(['%s'] * len(trs_ids))
+            await cursor.execute(update_trs_query, trs_ids)
+            claimed += len(trs_ids)
+
+    async def reserve_trade(self, cursor, trade_id, cost, number, collection_name, buyer_id):
+        """
+        Python implementation of the reserve step, run on the cursor of trade_create's transaction.
+
+        The quantity is drawn from the listings at that price, oldest first (see claim_listings), and
+        the seller's free TRS are attached to the trade in batches (see claim_trs).
+        """
+        if number <= 0 or price_key(cost) <= 0:
+            raise ValueError(f"Cannot reserve {number} TRS at {cost}. ")
+        listings = await self.claim_listings(cursor, collection_name, cost, number)
+
+        reserve_listing_query = """
+        UPDATE listings
+        SET quantity = quantity - %s, reserved = reserved + %s
+        WHERE listing_id = %s
+        """
+        sellers = {}
+        remaining = number
+        for listing_id, seller_id, quantity in listings:
+            if remaining == 0:
+                break
+            take = min(quantity, remaining)
+            await cursor.execute(reserve_listing_query, (take, take, listing_id))
+            await self.claim_trs(cursor, trade_id, buyer_id, listing_id, seller_id, collection_name, take)
+            sellers[seller_id] = sellers.get(seller_id, 0) + take
+            remaining -= take
+        await self.update_holdings(cursor, [
+            (seller_id, collection_name, 0, 0, -sellers[seller_id], sellers[seller_id]) for seller_id in sellers
+        ])
+        logger.info(f"Added trades for {collection_name} and updated trs status to in_trade")
+
+        transaction_insert_query = f"""
+        INSERT INTO transactions (transaction_number, collection_name, buyer_id, seller_id, cost, number, status,buyer_transaction_id) 
+        VALUES (%s, %s, %s, %s, %s, %s, 'initiated','{trade_id}')
+        """
+        transaction_values = [
+            (str(uuid.uuid4()), collection_name, buyer_id, seller_id, cost, sellers[seller_id])
+            for seller_id in sellers
+        ]
+        await cursor.executemany(transaction_insert_query, transaction_values)
+
     async def trade_create(self,trade_id, cost, number, collection_name,buyer_id):
-        connection = None
+        """
+        Reserves `number` TRS of a collection at `cost` for a buyer, in one transaction.
+
+        Listings and TRS are claimed with SKIP LOCKED, so buyers at the same price reserve disjoint TRS
+        without waiting on each other, and a reservation either claims exactly `number` TRS or rolls back.
+        With TRADE_PROCEDURES the step runs as the trade_reserve stored procedure, otherwise as reserve_trade.
+        """
+        await self.trade_create_levels(trade_id, [(cost, number)], collection_name, buyer_id)
+
+    async def trade_create_levels(self, trade_id, fills, collection_name, buyer_id):
+        """
+        Reserves TRS of a collection at several prices for one trade, in one transaction: either every
+        level is reserved or none is. Each level is reserved like trade_create; the trade's transactions
+        rows carry the price they were bought at, so execute_trade and cancel_trade handle them as usual.
+        A reservation picked as a deadlock victim is retried (see retry_on_deadlock).
+
+        Parameters:
+        - fills: list of (cost, number) tuples.
+        """
+        if not fills or any(number <= 0 or price_key(cost) <= 0 for cost, number in fills):
+            # The order book and the trade_reserve procedures take these as they come.
+            raise HTTPException(status_code=400, detail="A trade needs a positive number of TRS at a positive price. ")
+        if TRADE_PROCEDURES and len(fills) > 1 and TRADE_PROCEDURE_VERSIONS['trade_reserve'] < 2:
+            # trade_reserve_v1 writes the earlier levels' transactions rows again at every later level.
+            raise HTTPException(status_code=400, detail="Orders across several price levels are not available yet. ")
+        async def reserve():
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    for cost, number in fills:
+                        if TRADE_PROCEDURES:
+                            await self.call_procedure(cursor, 'trade_reserve', (trade_id, buyer_id, collection_name, cost, number))
+                        else:
+                            await self.reserve_trade(cursor, trade_id, cost, number, collection_name, buyer_id)
+                    logger.info(f"Transaction for collection {collection_name} and buyer {buyer_id} processed successfully.")
         try:
-            connection = await self.get_connection()
-            async with connection.cursor() as cursor:
+            await self.retry_on_deadlock(reserve)
+            for cost, number in fills:
+                self.on_commit(functools.partial(order_book.reserve, collection_name, cost, number))
+
                     
-                marketplace_query = """
-                SELECT trs_id, bid_price 
-                FROM marketplace 
-                WHERE collection_name = %s AND bid_price = %s
-                """
-                await cursor.execute(marketplace_query, (collection_name, cost))
-                marketplace_trs1 = await cursor.fetchall()
-                columns = [column[0] for column in cursor.description]
-                marketplace_trs = [dict(zip(columns, row)) for row in marketplace_trs1]
-                if len(marketplace_trs) < number:
-                    raise ValueError(f"Not enough trs available. Required: {number}, Found: {len(marketplace_trs)}")
-
-                # Step 2: Get trs data from trs table with in_trade = 0
-                trs_ids = [trs['trs_id'] for trs in marketplace_trs]
-                trs_query = """
-                SELECT trs_id, user_id 
-                FROM trs 
-                WHERE trs_id IN (%s) AND in_trade = 0
-                """ % ','.join(['%s'] * len(trs_ids))
-                
-                await cursor.execute(trs_query, trs_ids)
-                available_trs1 = await cursor.fetchall()
-                columns = [column[0] for column in cursor.description]
-                available_trs = [dict(zip(columns, row)) for row in available_trs1]
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
                 
-                if len(available_trs) < number:
-                    raise ValueError(f"Not enough trs available in trs table. Required: {number}, Found: {len(available_trs)}")
-
-                selected_trs = available_trs[:number]
-                update_trs_query = """
-                UPDATE trs 
-                SET in_trade = 1 
-                WHERE trs_id IN (%s)
-                """ % ','.join(['%s'] * number)
-                await cursor.execute(update_trs_query, [trs['trs_id'] for trs in selected_trs])
+
+    async def settle_trade(self, cursor, trade_id):
+        """
+        Python implementation of the settle step, run on the cursor of execute_trade's transaction.
+        Only a trade claimed with claim_trade (status `executing`) is settled.
+
+        Every statement is set-based and joined against `trades`, so the number of statements does not
+        depend on the number of TRS or sellers, and the users and collection data needed for the payouts
+        are fetched with one query each.
+        """
+        fetch_transactions_query = """
+        SELECT transaction_number, buyer_id, seller_id, number, cost, collection_name 
+        FROM transactions 
+        WHERE buyer_transaction_id = %s AND status = 'executing'
+        FOR UPDATE
+        """
+        await cursor.execute(fetch_transactions_query, (trade_id,))
+        transactions1 = await cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        transactions = [dict(zip(columns, row)) for row in transactions1]
+        if not transactions:
+            raise ValueError(f"No executing transactions for trade {trade_id}")
+        buyer_id = transactions[0]['buyer_id']
+
+        update_ownership_query = """
+        UPDATE trs t
+        JOIN trades tr ON tr.trs_id = t.trs_id
+        SET t.user_id = tr.buyer_id, t.in_trade = 0
+        WHERE tr.trade_id = %s AND tr.status = 'executing' AND t.user_id = tr.seller_id
+        """
+        await cursor.execute(update_ownership_query, (trade_id,))
+        logger.info(f"Changed the owner of {cursor.rowcount} TRS for trade {trade_id}")
+
+        settle_listings_query = """
+        UPDATE listings l
+        JOIN (
+            SELECT listing_id, COUNT(*) AS number
+            FROM trades
+            WHERE trade_id = %s AND status = 'executing'
+            GROUP BY listing_id
+        ) AS tr ON tr.listing_id = l.listing_id
+        SET l.reserved = l.reserved - tr.number
+        """
+        await cursor.execute(settle_listings_query, (trade_id,))
+        delete_listings_query = """
+        DELETE l FROM listings l
+        JOIN trades tr ON tr.listing_id = l.listing_id
+        WHERE tr.trade_id = %s AND l.quantity = 0 AND l.reserved = 0
+        """
+        await cursor.execute(delete_listings_query, (trade_id,))
+        logger.info(f"Removed from marketplace for trade {trade_id}")
+
+        update_trades_query = """
+        UPDATE trades 
+        SET status = 'completed' 
+        WHERE trade_id = %s AND status = 'executing'
+        """
+        await cursor.execute(update_trades_query, (trade_id,))
+        update_transactions_query = """
+        UPDATE transactions 
+        SET status = 'finished' 
+        WHERE buyer_transaction_id = %s AND status = 'executing'
+        """
+        await cursor.execute(update_transactions_query, (trade_id,))
+        logger.info(f"Finished the trades and transactions for trade {trade_id}")
+
+        holdings_changes = []
+        for transaction in transactions:
+            holdings_changes.append((transaction['seller_id'], transaction['collection_name'], -transaction['number'], 0, 0, -transaction['number']))
+            holdings_changes.append((transaction['buyer_id'], transaction['collection_name'], transaction['number'], 0, 0, 0))
+        await self.update_holdings(cursor, holdings_changes)
+
+        users = await self.get_users_batch([buyer_id] + [transaction['seller_id'] for transaction in transactions])
+        collection_data = await self.get_collection_data_batch([transaction['collection_name'] for transaction in transactions])
+        response_list = []
+        for transaction in transactions:
+            response_list.append({
+                'seller_id': transaction['seller_id'],
+                'seller_email':users[transaction['seller_id']]['email'],
+                'number': transaction['number'],
+                'cost': transaction['cost'],
+                'collection_name': transaction['collection_name'],
+                'buyer_id':buyer_id,
+                'buyer_email':users[buyer_id]['email'],
+                'creator_email':collection_data[transaction['collection_name']][0]['creator']
+            })
+        return response_list
+
+    async def execute_trade(self, trade_id):
+        """
+        Settles a reserved trade: moves the TRS to the buyer, releases the listings they were drawn
+        from and marks the trade and its transactions finished. With TRADE_PROCEDURES the step runs as
+        the trade_settle stored procedure, otherwise as settle_trade.
+
+        Returns:
+        - list with one dict per seller: seller_id, seller_email, number, cost, collection_name,
+          buyer_id, buyer_email and creator_email.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if TRADE_PROCEDURES:
+                        response_list = await self.call_procedure(cursor, 'trade_settle', (trade_id,))
+                    else:
+                        response_list = await self.settle_trade(cursor, trade_id)
+                    logger.info(f"Executed trade {trade_id}")
+            for transaction in response_list:
+                self.on_commit(functools.partial(order_book.settle, transaction['collection_name'], transaction['cost'], transaction['number']))
+            return response_list
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def cancel_trade(self, trade_id):
+        """
+        Cancels a reserved trade that will not be paid: its TRS are freed and the quantity returns to
+        the listings it was drawn from. With TRADE_PROCEDURES the step runs as the trade_cancel stored
+        procedure. Trades that are not pending, including trades claimed for execution, are left alone.
+
+        Returns:
+        - list of dicts with collection_name, cost and number, one per seller transaction released.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    if TRADE_PROCEDURES:
+                        released = await self.call_procedure(cursor, 'trade_cancel', (trade_id,))
+                    else:
+                        fetch_transactions_query = """
+                        SELECT seller_id, collection_name, cost, number
+                        FROM transactions
+                        WHERE buyer_transaction_id = %s AND status = 'initiated'
+                        FOR UPDATE
+                        """
+                        await cursor.execute(fetch_transactions_query, (trade_id,))
+                        result1 = await cursor.fetchall()
+                        columns = [column[0] for column in cursor.description]
+                        released = [dict(zip(columns, row)) for row in result1]
+                        if released:
+                            release_trs_query = """
+                            UPDATE trs t
+                            JOIN trades tr ON tr.trs_id = t.trs_id
+                            SET t.in_trade = 0
+                            WHERE tr.trade_id = %s AND tr.status = 'initiated'
+                            """
+                            await cursor.execute(release_trs_query, (trade_id,))
+                            release_listings_query = """
+                            UPDATE listings l
+                            JOIN (
+                                SELECT listing_id, COUNT(*) AS number
+                                FROM trades
+                                WHERE trade_id = %s AND status = 'initiated'
+                                GROUP BY listing_id
+                            ) AS tr ON tr.listing_id = l.listing_id
+                            SET l.quantity = l.quantity + tr.number, l.reserved = l.reserved - tr.number
+                            """
+                            await cursor.execute(release_listings_query, (trade_id,))
+                            await self.update_holdings(cursor, [
+                                (transaction['seller_id'], transaction['collection_name'], 0, 0, transaction['number'], -transaction['number'])
+                                for transaction in released
+                            ])
+                            await cursor.execute("UPDATE trades SET status = 'cancelled' WHERE trade_id = %s AND status = 'initiated'", (trade_id,))
+                            await cursor.execute("UPDATE transactions SET status = 'cancelled' WHERE buyer_transaction_id = %s AND status = 'initiated'", (trade_id,))
+                    logger.info(f"Cancelled trade {trade_id}, released {sum(int(transaction['number']) for transaction in released)} trs")
+            for transaction in released:
+                self.on_commit(functools.partial(order_book.release, transaction['collection_name'], transaction['cost'], int(transaction['number'])))
+            return released
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
                 
-                logger.info("Updated trs status to in_trade")
-                trade_insert_query = """
-                INSERT INTO trades (trade_id, buyer_id, seller_id, trs_id, status) 
-                VALUES (%s, %s, %s, %s, 'initiated')
+
+    async def get_expired_trades(self, ttl_seconds, limit):
+        """
+        Returns the ids of pending trades reserved more than `ttl_seconds` ago, oldest first.
+        Trades claimed for execution (status `executing`) are not returned.
+        Served by idx_transactions_status_created (migration 0007).
+        """
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                SELECT buyer_transaction_id
+                FROM transactions
+                WHERE status = 'initiated' AND created_at < NOW() - INTERVAL %s SECOND
+                GROUP BY buyer_transaction_id
+                ORDER BY MIN(created_at)
+                LIMIT %s
                 """
-                trade_values = [(trade_id, buyer_id, trs['user_id'], trs['trs_id']) for trs in selected_trs]
-                await cursor.executemany(trade_insert_query, trade_values)
-                logger.info(f"Added trades for {collection_name}")
-
-                # Step 5: Insert into transactions table for each seller
-                sellers = {}
-                for trs in selected_trs:
-                    seller_id = trs['user_id']
-                    if seller_id not in sellers:
-                        sellers[seller_id] = 0
-                    sellers[seller_id] += 1
-
-                transaction_insert_query = f"""
-                INSERT INTO transactions (transaction_number, collection_name, buyer_id, seller_id, cost, number, status,buyer_transaction_id) 
-                VALUES (%s, %s, %s, %s, %s, %s, 'initiated','{trade_id}')
+                await cursor.execute(query, (int(ttl_seconds), limit))
+                return [row[0] for row in await cursor.fetchall()]
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
+    async def claim_trade(self, trade_id):
+        """
+        Claims a pending trade for execution before the buyer is charged: its trades and transactions
+        rows move from `initiated` to `executing`. cancel_trade and get_expired_trades only touch
+        `initiated` trades, so the reservation sweeper cannot release the TRS while the payment runs,
+        and execute_trade only settles `executing` trades. The claim is a lease from `claimed_at`; a
+        trade still `executing` when it runs out is reconciled by the sweeper (see get_expired_claims).
+
+        Returns:
+        - bool: False if the trade is not pending (settled, cancelled, expired or already claimed).
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "UPDATE transactions SET status = 'executing', claimed_at = NOW() WHERE buyer_transaction_id = %s AND status = 'initiated'"
+                    await cursor.execute(query, (trade_id,))
+                    if cursor.rowcount == 0:
+                        return False
+                    query = "UPDATE trades SET status = 'executing' WHERE trade_id = %s AND status = 'initiated'"
+                    await cursor.execute(query, (trade_id,))
+                    logger.info(f"Claimed trade {trade_id} for execution")
+                    return True
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def release_trade_claim(self, trade_id):
+        """
+        Returns a trade claimed with claim_trade to `initiated`, when its payment did not go through
+        or was refunded, so it can be paid again or cancelled.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute("UPDATE transactions SET status = 'initiated', claimed_at = NULL WHERE buyer_transaction_id = %s AND status = 'executing'", (trade_id,))
+                    await cursor.execute("UPDATE trades SET status = 'initiated' WHERE trade_id = %s AND status = 'executing'", (trade_id,))
+                    logger.info(f"Released the execution claim on trade {trade_id}")
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def get_expired_claims(self, lease_seconds, limit):
+        """
+        Returns the ids of trades claimed for execution more than `lease_seconds` ago and still `executing`,
+        oldest claim first. Trades claimed before claimed_at existed count as expired.
+        Served by idx_transactions_status_claimed (migration 0016).
+        """
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                SELECT buyer_transaction_id
+                FROM transactions
+                WHERE status = 'executing' AND (claimed_at IS NULL OR claimed_at < NOW() - INTERVAL %s SECOND)
+                GROUP BY buyer_transaction_id
+                ORDER BY MIN(claimed_at)
+                LIMIT %s
                 """
-                transaction_values = [
-                    (str(uuid.uuid4()), collection_name, buyer_id, seller_id, cost, sellers[seller_id])
-                    for seller_id in sellers
-                ]
-                await cursor.executemany(transaction_insert_query, transaction_values)
-                
-                # Commit changes to the database
+                await cursor.execute(query, (int(lease_seconds), limit))
+                return [row[0] for row in await cursor.fetchall()]
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
+    async def take_over_trade_claim(self, trade_id, lease_seconds):
+        """
+        Renews the expired execution claim of a trade for the caller, so that only one sweeper reconciles it
+        and the request that claimed it first is past its lease.
+
+        Returns:
+        - bool: False if the claim is no longer expired or the trade is no longer `executing`.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    UPDATE transactions
+                    SET claimed_at = NOW()
+                    WHERE buyer_transaction_id = %s AND status = 'executing'
+                      AND (claimed_at IS NULL OR claimed_at < NOW() - INTERVAL %s SECOND)
+                    """
+                    await cursor.execute(query, (trade_id, int(lease_seconds)))
+                    return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def enqueue_payouts(self, trade_id, payouts):
+        """
+        Writes payout intents to payout_outbox, to be sent by the payout worker.
+        Call it in the unit of work that settles the trade, so intents exist if and only if the trade settled.
+
+        Parameters:
+        - trade_id: The settled trade.
+        - payouts: list of dicts with kind ('seller' or 'royalty'), reference (the seller id the payout
+          is for), recipient_email, amount, currency and note.
+
+        Each intent gets an idempotency key derived from (trade_id, kind, reference), so enqueuing the
+        same trade twice does not create duplicate payouts.
+        """
+        if not payouts:
+            return
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "INSERT IGNORE INTO payout_outbox (trade_id, kind, reference, recipient_email, amount, currency, note, idempotency_key) VALUES " + ",".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(payouts))
+                    values = []
+                    for payout in payouts:
+                        idempotency_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{trade_id}/{payout['kind']}/{payout['reference']}"))
+                        values += [trade_id, payout['kind'], payout['reference'], payout['recipient_email'], payout['amount'], payout.get('currency', 'USD'), payout.get('note'), idempotency_key]
+                    await cursor.execute(query, values)
+                    logger.info(f"Queued {len(payouts)} payouts for trade {trade_id}")
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def claim_payouts(self, limit, lease_seconds, batch_size):
+        """
+        Claims up to `limit` due payouts for sending, oldest first, grouped into payout batches.
+
+        Rows are locked with SKIP LOCKED so concurrent workers claim disjoint payouts, then marked
+        `sending` with a lease of `lease_seconds`: if the worker dies before recording the outcome,
+        the payout becomes due again when the lease runs out. Payouts without a sender_batch_id are
+        assigned a new one per `batch_size` rows; payouts that already have one (their last send had
+        an unknown outcome) keep it, so they are resent in the same batch.
+
+        Returns:
+        - list of payout_outbox rows as dicts, each with its sender_batch_id.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    SELECT id, trade_id, kind, reference, recipient_email, amount, currency, note, idempotency_key, sender_batch_id, attempts
+                    FROM payout_outbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """
+                    await cursor.execute(query, (limit,))
+                    result1 = await cursor.fetchall()
+                    columns = [column[0] for column in cursor.description]
+                    payouts = [dict(zip(columns, row)) for row in result1]
+                    kept_batches = list({payout['sender_batch_id'] for payout in payouts if payout['sender_batch_id'] is not None})
+                    if kept_batches:
+                        # A batch is resent whole, so pull in members the LIMIT cut off.
+                        members_query = """
+                        SELECT id, trade_id, kind, reference, recipient_email, amount, currency, note, idempotency_key, sender_batch_id, attempts
+                        FROM payout_outbox
+                        WHERE sender_batch_id IN (%s) AND id NOT IN (%s) AND status IN ('pending', 'sending')
+                        FOR UPDATE SKIP LOCKED
+                        """ % (','.join(['%s'] * len(kept_batches)), ','.join(['%s'] * len(payouts)))
+                        await cursor.execute(members_query, kept_batches + [payout['id'] for payout in payouts])
+                        payouts += [dict(zip(columns, row)) for row in await cursor.fetchall()]
+                    if payouts:
+                        unbatched = [payout for payout in payouts if payout['sender_batch_id'] is None]
+                        for start in range(0, len(unbatched), batch_size):
+                            batch = unbatched[start:start + batch_size]
+                            sender_batch_id = str(uuid.uuid4())
+                            batch_query = "UPDATE payout_outbox SET sender_batch_id = %s WHERE id IN (%s)" % ('%s', ','.join(['%s'] * len(batch)))
+                            await cursor.execute(batch_query, [sender_batch_id] + [payout['id'] for payout in batch])
+                            for payout in batch:
+                                payout['sender_batch_id'] = sender_batch_id
+                        claim_query = """
+                        UPDATE payout_outbox
+                        SET status = 'sending', attempts = attempts + 1, next_attempt_at = NOW() + INTERVAL %s SECOND
+                        WHERE id IN (%s)
+                        """ % ('%s', ','.join(['%s'] * len(payouts)))
+                        await cursor.execute(claim_query, [int(lease_seconds)] + [payout['id'] for payout in payouts])
+                        for payout in payouts:
+                            payout['attempts'] += 1
+                    return payouts
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def complete_payouts(self, ids, payout_batch_id):
+        """Marks payouts as sent in the PayPal payout batch `payout_batch_id`."""
+        if not ids:
+            return
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = "UPDATE payout_outbox SET status = 'sent', payout_batch_id = %s, last_error = NULL WHERE id IN (%s)" % ('%s', ','.join(['%s'] * len(ids)))
+                await cursor.execute(query, [payout_batch_id] + list(ids))
                 await connection.commit()
-                logger.info(f"Transaction for collection {collection_name} and buyer {buyer_id} processed successfully.")
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
 
-                    
+    async def rebatch_payouts(self, groups):
+        """
+        Moves each group of payout ids into a new payout batch of its own.
+
+        Parameters:
+        - groups: list of lists of payout_outbox ids.
+
+        Returns:
+        - list of the new sender_batch_ids, one per group.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    sender_batch_ids = []
+                    for ids in groups:
+                        sender_batch_id = str(uuid.uuid4())
+                        query = "UPDATE payout_outbox SET sender_batch_id = %s WHERE id IN (%s)" % ('%s', ','.join(['%s'] * len(ids)))
+                        await cursor.execute(query, [sender_batch_id] + list(ids))
+                        sender_batch_ids.append(sender_batch_id)
+                    return sender_batch_ids
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def retry_payouts(self, ids, error, delay_seconds=None, keep_batch=True):
+        """
+        Records a failed send of the payouts `ids`.
+
+        Parameters:
+        - delay_seconds: Retry after this many seconds; None marks the payouts failed for manual follow-up.
+        - keep_batch: Keep the sender_batch_id, for failures whose outcome is unknown (timeouts, 5xx).
+          PayPal rejected the batch otherwise, and the payouts are rebatched on the next attempt.
+        """
+        if not ids:
+            return
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                placeholders = ','.join(['%s'] * len(ids))
+                batch = "" if keep_batch else ", sender_batch_id = NULL"
+                if delay_seconds is None:
+                    query = f"UPDATE payout_outbox SET status = 'failed', last_error = %s{batch} WHERE id IN ({placeholders})"
+                    values = [str(error)] + list(ids)
+                else:
+                    query = f"UPDATE payout_outbox SET status = 'pending', last_error = %s, next_attempt_at = NOW() + INTERVAL %s SECOND{batch} WHERE id IN ({placeholders})"
+                    values = [str(error), int(delay_seconds)] + list(ids)
+                await cursor.execute(query, values)
+                await connection.commit()
         except Exception as e:
             await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
-                
+                await self.release_connection(connection)
 
-    async def execute_trade(self, trade_id):
+    async def get_unsettled_payout_batches(self, recheck_seconds, limit):
+        """
+        Returns the PayPal payout_batch_ids with items whose final status is not known yet and that
+        were not checked in the last `recheck_seconds`.
+        """
         connection = None
         try:
             connection = await self.get_connection()
             async with connection.cursor() as cursor:
-                    
-                fetch_trs_query = """
-                SELECT trs_id 
-                FROM trades 
-                WHERE trade_id = %s
-                """
-                await cursor.execute(fetch_trs_query, (trade_id,))
-                
-                trs_ids1 = [trs['trs_id'] for trs in await cursor.fetchall()]
-                columns = [column[0] for column in cursor.description]
-                trs_ids = [dict(zip(columns, row)) for row in trs_ids1]
-                logger.info(f"Fetched TRS ID's for trade {trade_id}.")
-                # Step 2: Update trades status to 'finished'
-                update_trades_query = """
-                UPDATE trades 
-                SET status = 'completed' 
-                WHERE trade_id = %s
+                query = """
+                SELECT DISTINCT payout_batch_id
+                FROM payout_outbox
+                WHERE status = 'sent' AND payout_batch_id IS NOT NULL
+                  AND (item_checked_at IS NULL OR item_checked_at < NOW() - INTERVAL %s SECOND)
+                  AND (item_status IS NULL OR item_status IN ('NEW', 'PENDING', 'ONHOLD', 'UNCLAIMED'))
+                LIMIT %s
                 """
-                await cursor.execute(update_trades_query, (trade_id,))
-                logger.info(f"Updated trade_status to finished for trade {trade_id}.")
-                # Step 3: Fetch all transactions corresponding to this trade and change status to 'approved'
-                fetch_transactions_query = """
-                SELECT transaction_number, buyer_id, seller_id, number, cost, collection_name 
-                FROM transactions 
-                WHERE buyer_transaction_id = %s
+                await cursor.execute(query, (int(recheck_seconds), limit))
+                return [row[0] for row in await cursor.fetchall()]
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
+    async def record_payout_items(self, items):
+        """
+        Stores the PayPal item results of a payout batch on the matching intents.
+        Items that ended in a failure status are marked failed for manual follow-up.
+
+        Parameters:
+        - items: list of (idempotency_key, payout_item_id, item_status, error) tuples.
+        """
+        if not items:
+            return
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                UPDATE payout_outbox
+                SET payout_item_id = %s, item_status = %s, item_checked_at = NOW(),
+                    status = IF(%s IN ('FAILED', 'RETURNED', 'BLOCKED', 'REFUNDED', 'REVERSED'), 'failed', status),
+                    last_error = COALESCE(%s, last_error)
+                WHERE idempotency_key = %s
                 """
-                await cursor.execute(fetch_transactions_query, (trade_id,))
-                transactions1 = await cursor.fetchall()
+                await cursor.executemany(query, [
+                    (payout_item_id, item_status, item_status, error, idempotency_key)
+                    for idempotency_key, payout_item_id, item_status, error in items
+                ])
+                await connection.commit()
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
+    async def claim_idempotency_key(self, scope, idempotency_key, user_id, request_hash, ttl_seconds, lock_seconds):
+        """
+        Claims an idempotency key for a request about to run.
+
+        The key is claimed if it is new, expired, or pending with a lock that ran out (the request that
+        held it died); the claim locks it for `lock_seconds` and keeps it for `ttl_seconds`.
+
+        Parameters:
+        - scope: The endpoint the key belongs to.
+        - idempotency_key: The client key, or the id the endpoint is keyed on.
+        - user_id: The caller, or None.
+        - request_hash: Hash of the request body, or None.
+
+        Returns:
+        - None if the caller now holds the key and should run the request, otherwise the stored row
+          as a dict (status, user_id, request_hash, status_code, response).
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    insert_query = """
+                    INSERT IGNORE INTO idempotency_keys (scope, idempotency_key, user_id, request_hash, locked_until, expires_at)
+                    VALUES (%s, %s, %s, %s, NOW() + INTERVAL %s SECOND, NOW() + INTERVAL %s SECOND)
+                    """
+                    select_query = """
+                    SELECT status, user_id, request_hash, status_code, response,
+                           expires_at < NOW() AS expired, status = 'pending' AND locked_until < NOW() AS abandoned
+                    FROM idempotency_keys
+                    WHERE scope = %s AND idempotency_key = %s
+                    FOR UPDATE
+                    """
+                    # The row that made the INSERT a no-op can be deleted (released or cleaned up)
+                    # before the SELECT reads it; the claim is then simply tried again.
+                    for attempt in range(3):
+                        await cursor.execute(insert_query, (scope, idempotency_key, user_id, request_hash, lock_seconds, ttl_seconds))
+                        if cursor.rowcount == 1:
+                            return None
+                        await cursor.execute(select_query, (scope, idempotency_key))
+                        columns = [column[0] for column in cursor.description]
+                        result = await cursor.fetchone()
+                        if result is not None:
+                            break
+                        logger.info(f"Idempotency key {scope}/{idempotency_key} was deleted while being claimed, retrying. ")
+                    else:
+                        raise ValueError(f"Could not claim idempotency key {scope}/{idempotency_key}")
+                    row = dict(zip(columns, result))
+                    if not (row['expired'] or row['abandoned']):
+                        return row
+                    query = """
+                    UPDATE idempotency_keys
+                    SET user_id = %s, request_hash = %s, status = 'pending', status_code = NULL, response = NULL,
+                        locked_until = NOW() + INTERVAL %s SECOND, expires_at = NOW() + INTERVAL %s SECOND
+                    WHERE scope = %s AND idempotency_key = %s
+                    """
+                    await cursor.execute(query, (user_id, request_hash, lock_seconds, ttl_seconds, scope, idempotency_key))
+                    return None
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def complete_idempotency_key(self, scope, idempotency_key, status_code, response):
+        """
+        Stores the response of the request holding an idempotency key.
+        Call it in the unit of work of the request, so the response is stored if and only if its writes commit.
+
+        Parameters:
+        - response: The JSON-serialisable response body.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    UPDATE idempotency_keys
+                    SET status = 'completed', status_code = %s, response = %s, locked_until = NULL
+                    WHERE scope = %s AND idempotency_key = %s
+                    """
+                    await cursor.execute(query, (status_code, json.dumps(response, default=str), scope, idempotency_key))
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def release_idempotency_key(self, scope, idempotency_key):
+        """Drops a pending idempotency key whose request failed, so the client can retry it."""
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "DELETE FROM idempotency_keys WHERE scope = %s AND idempotency_key = %s AND status = 'pending'"
+                    await cursor.execute(query, (scope, idempotency_key))
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def delete_expired_idempotency_keys(self, limit):
+        """
+        Deletes up to `limit` expired idempotency keys.
+
+        Returns:
+        - int: The number of keys deleted.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "DELETE FROM idempotency_keys WHERE expires_at < NOW() LIMIT %s"
+                    await cursor.execute(query, (limit,))
+                    return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def record_trs_uploads(self, user_id, title, uploads, ttl_seconds):
+        """
+        Records the direct uploads issued to a user for a TRS creation request.
+
+        Parameters:
+        - uploads: list of (object_key, size, upload_id) tuples; upload_id is None for a single PUT.
+        - ttl_seconds: How long the uploads can be finalized.
+        """
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = """
+                    INSERT INTO trs_uploads (user_id, title, object_key, size, upload_id, expires_at)
+                    VALUES (%s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND)
+                    """
+                    await cursor.executemany(query, [
+                        (user_id, title, object_key, size, upload_id, int(ttl_seconds))
+                        for object_key, size, upload_id in uploads
+                    ])
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def get_trs_uploads(self, user_id, object_keys):
+        """
+        Returns the issued, unexpired uploads of a user for the given object keys.
+
+        Returns:
+        - dict mapping object key to its latest upload row (id, object_key, size, upload_id).
+        """
+        object_keys = list(dict.fromkeys(object_keys))
+        if not object_keys:
+            return {}
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                SELECT id, object_key, size, upload_id
+                FROM trs_uploads
+                WHERE user_id = %s AND object_key IN (%s) AND status = 'issued' AND expires_at > NOW()
+                ORDER BY id
+                """ % ('%s', ','.join(['%s'] * len(object_keys)))
+                await cursor.execute(query, [user_id] + object_keys)
                 columns = [column[0] for column in cursor.description]
-                transactions = [dict(zip(columns, row)) for row in transactions1]
-                buyer_id = transactions[0]['buyer_id']
-                buyer_user = await self.get_user(buyer_id)
-                
-                update_transactions_status_query = """
-                UPDATE transactions 
-                SET status = 'approved' 
-                WHERE buyer_transaction_id IN (%s)
-                """ % ','.join(['%s'] * len(transactions))
-                transaction_ids = [transaction['transaction_number'] for transaction in transactions]
-                await cursor.execute(update_transactions_status_query, transaction_ids)
-                logger.info(f"Approved the transactions for trade {trade_id} ")
-                # Step 4: Change ownership of the trs (trs_id) to buyer_id from seller_id
-                update_ownership_query = """
-                UPDATE trs 
-                SET user_id = %s 
-                WHERE trs_id = %s AND user_id = %s
+                return {row['object_key']: row for row in (dict(zip(columns, row)) for row in await cursor.fetchall())}
+        except Exception as e:
+            await connection.rollback()
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            if connection:
+                await self.release_connection(connection)
+
+    async def finalize_trs_uploads(self, ids):
+        """
+        Marks issued uploads as finalized. Call it in the unit of work that records the TRS creation request.
+
+        Raises:
+        - ValueError: If one of the uploads was finalized or aborted meanwhile.
+        """
+        if not ids:
+            return
+        async with self.transaction() as connection:
+            async with connection.cursor() as cursor:
+                query = "UPDATE trs_uploads SET status = 'finalized' WHERE id IN (%s) AND status = 'issued'" % ','.join(['%s'] * len(ids))
+                await cursor.execute(query, list(ids))
+                if cursor.rowcount != len(ids):
+                    raise ValueError("The uploads were finalized or aborted meanwhile.")
+
+    async def get_expired_trs_uploads(self, limit):
+        """
+        Returns up to `limit` issued uploads past their expiry, as dicts with id, object_key and upload_id.
+        """
+        connection = None
+        try:
+            connection = await self.get_connection()
+            async with connection.cursor() as cursor:
+                query = """
+                SELECT id, object_key, upload_id
+                FROM trs_uploads
+                WHERE status = 'issued' AND expires_at < NOW()
+                ORDER BY expires_at
+                LIMIT %s
                 """
-                ownership_updates = [(transaction['buyer_id'], trs_id, transaction['seller_id']) 
-                                    for trs_id in trs_ids for transaction in transactions]
-                await cursor.executemany(update_ownership_query, ownership_updates)
-                logger.info(f"Changed the owner for trade {trade_id}")
-                # Step 5: Change transaction status to 'finished'
-                update_transactions_finished_query = """
-                UPDATE transactions 
-                SET status = 'finished' 
-                WHERE buyer_transaction_id IN (%s)
-                """ % ','.join(['%s'] * len(transactions))
-                await cursor.execute(update_transactions_finished_query, transaction_ids)
-                logger.info(f"Finished the transactions for trade {trade_id}")
-                # Step 6: Set in_trade = 0 for all involved trs
-                update_in_trade_query = """
-                UPDATE trs 
-                SET in_trade = 0 
-                WHERE trs_id IN (%s)
-                """ % ','.join(['%s'] * len(trs_ids))
-                await cursor.execute(update_in_trade_query, trs_ids)
-                remove_marketplace_query = """
-                UPDATE trs 
-                SET marketplace = 0 
-                WHERE trs_id IN (%s)
-                """ % ','.join(['%s'] * len(trs_ids))
-                await cursor.execute(remove_marketplace_query, trs_ids)
-                logger.info(f"Set in_trade to zero for trade {trade_id}")
-                
-                delete_marketplace_query = """
-                DELETE FROM marketplace 
-                WHERE trs_id IN (%s)
-                """ % ','.join(['%s'] * len(trs_ids))
-                await cursor.execute(delete_marketplace_query, trs_ids)
-                logger.info(f"Removed from marketplace for trade {trade_id}")
-                # Step 7: Create the response list
-                response_list = []
-                for transaction in transactions:
-                    seller_user = await self.get_user(transaction['seller_id'])
-                    collection_data = await self.get_collection_data(transaction['collection_name'])
-                    collection_data = collection_data[0]
-                    response_list.append({
-                        'seller_id': transaction['seller_id'],
-                        'seller_email':seller_user['email'],
-                        'number': transaction['number'],
-                        'cost': transaction['cost'],
-                        'collection_name': transaction['collection_name'],
-                        'buyer_id':buyer_id,
-                        'buyer_email':buyer_user['email'],
-                        'creator_email':collection_data['creator']
-                    })
-
-                # Commit all changes to the database
-                await connection.commit()
-                logger.info(f"Executed trade {trade_id}")
-                return response_list
+                await cursor.execute(query, (limit,))
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in await cursor.fetchall()]
         except Exception as e:
-            connection.rollback()
+            await connection.rollback()
             logger.error(f"Error: {e}")
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
-                
+                await self.release_connection(connection)
+
+    async def abort_trs_uploads(self, ids):
+        """Marks expired uploads as aborted, unless they were finalized meanwhile."""
+        if not ids:
+            return
+        try:
+            async with self.transaction() as connection:
+                async with connection.cursor() as cursor:
+                    query = "UPDATE trs_uploads SET status = 'aborted' WHERE id IN (%s) AND status = 'issued'" % ','.join(['%s'] * len(ids))
+                    await cursor.execute(query, list(ids))
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            raise HTTPException(status_code=400, detail=str(e))
 
     async def store_otp(self,email:str,expires : datetime,otp: str):
         connection = None
@@ -1210,7 +2533,7 @@ class DatabaseManager:
             raise HTTPException(status_code=400, detail=str(e))
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                 
 
     async def retrieve_otp(self, email: str):
@@ -1246,7 +2569,7 @@ class DatabaseManager:
             raise HTTPException(status_code=500, detail="Error retrieving OTP")
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                  
     async def store_user_details(self,email:str, first_name: str, last_name: str, username: str, bio: str, twitter: str, telegram: str, profile_pic_uri: str):
         connection = None
@@ -1289,7 +2612,7 @@ class DatabaseManager:
             raise HTTPException(status_code=500, detail="Error storing user details")
         finally:
             if connection:
-                await self.pool.release(connection)
+                await self.release_connection(connection)
                       
 
 
@@ -0,0 +1,124 @@
+"""
+Runs EXPLAIN on every query string in app/core/database.py and fails if one of them
+scans a whole table.
+
+Query strings are collected from the source with `ast`: every string literal that starts
+with SELECT, UPDATE, DELETE or REPLACE (and INSERT ... SELECT). Placeholders are replaced
+with sample values before explaining.
+
+A table access with EXPLAIN type ALL is reported as a full scan, also when possible_keys lists
+an index: MySQL picks ALL over an index on near-empty tables, so run the check against a database
+with representative data. A query that cannot be explained is reported as well, since its plan is
+unknown. Accepted exceptions go in ALLOWED_QUERIES, each with a comment saying why.
+
+Usage:
+    python -m app.core.explain [file ...]
+"""
+import argparse
+import ast
+import asyncio
+import os
+import re
+import sys
+
+from app.core.database import database_client
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("database")
+
+DEFAULT_SOURCES = [os.path.join(os.path.dirname(__file__), "database.py")]
+# Fragments of queries that may scan a table or fail to explain, each with the reason it is accepted.
+# A query is allowed if it contains one of the fragments (compared with whitespace collapsed).
+ALLOWED_QUERIES = {
+    # "SELECT ... FROM some_table": "why a full scan of it is fine",
+}
+EXPLAINABLE = re.compile(r"^\s*(SELECT|UPDATE|DELETE|REPLACE|INSERT\s+INTO\s+\w+\s*(\([^)]*\))?\s*SELECT)\b", re.IGNORECASE | re.DOTALL)
+
+
+def _literal(node):
+    """Returns the text of a string literal, with f-string fields replaced by empty strings."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr):
+        return "".join(part.value if isinstance(part, ast.Constant) else "" for part in node.values)
+    return None
+
+
+def collect_queries(path):
+    """
+    Returns (line, query) for every explainable query string in a Python source file.
+    """
+    with open(path) as file:
+        tree = ast.parse(file.read(), filename=path)
+    fstring_parts = {id(part) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for part in node.values}
+    queries = []
+    for node in ast.walk(tree):
+        if id(node) in fstring_parts:
+            continue
+        text = _literal(node)
+        if text and EXPLAINABLE.match(text):
+            queries.append((node.lineno, text))
+    return sorted(set(queries))
+
+
+def prepare(query):
+    """Substitutes placeholders so the query can be explained without parameters."""
+    query = re.sub(r"\{\w*\}", "", query)
+    query = re.sub(r"LIMIT\s+%s", "LIMIT 1", query, flags=re.IGNORECASE)
+    return query.replace("%s", "'0'")
+
+
+def allowed(query):
+    """True if `query` is listed in ALLOWED_QUERIES."""
+    return any(" ".join(fragment.split()) in query for fragment in ALLOWED_QUERIES)
+
+
+async def explain(paths):
+    """
+    Explains every query found in `paths`.
+
+    Returns:
+    - list of (path, line, problem, query) tuples for the full scans and unexplainable queries found.
+    """
+    await database_client.init_pool()
+    connection = await database_client.get_connection()
+    problems = []
+    try:
+        async with connection.cursor() as cursor:
+            for path in paths:
+                for line, query in collect_queries(path):
+                    normalized = " ".join(query.split())
+                    if allowed(normalized):
+                        continue
+                    try:
+                        await cursor.execute("EXPLAIN " + prepare(query))
+                    except Exception as e:
+                        problems.append((path, line, f"could not be explained ({e})", normalized))
+                        continue
+                    columns = [column[0] for column in cursor.description]
+                    for row in await cursor.fetchall():
+                        plan = dict(zip(columns, row))
+                        table = plan.get("table") or ""
+                        if plan.get("type") != "ALL" or table.startswith("<"):
+                            continue
+                        if plan.get("possible_keys"):
+                            problems.append((path, line, f"full scan of {table} although {plan['possible_keys']} could be used", normalized))
+                        else:
+                            problems.append((path, line, f"full scan of {table}", normalized))
+    finally:
+        await connection.rollback()
+        await database_client.release_connection(connection)
+        await database_client.close_pool()
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a query in the given files does a full table scan.")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_SOURCES)
+    args = parser.parse_args()
+    problems = asyncio.run(explain(args.paths))
+    for path, line, problem, query in problems:
+        print(f"{path}:{line}: {problem}: {query}")
+    sys.exit(1 if problems else 0)
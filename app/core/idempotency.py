@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+from app.core.database import database_client
+from app.utils.metrics import metrics
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("transactions")
+
+# How long the outcome of a request is kept, and how long a running request blocks its retries.
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 120))
+CLEANUP_INTERVAL = float(os.getenv("IDEMPOTENCY_CLEANUP_INTERVAL", 600))
+CLEANUP_BATCH_SIZE = int(os.getenv("IDEMPOTENCY_CLEANUP_BATCH_SIZE", 1000))
+
+
+def request_hash(payload):
+    """Returns a stable hash of a request body, to detect a key reused for a different request."""
+    if payload is None:
+        return None
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+async def begin(scope, idempotency_key, user_id=None, payload=None):
+    """
+    Starts an idempotent request.
+
+    Parameters:
+    scope (str): The endpoint the key belongs to.
+    idempotency_key (str): The client key, or the id the endpoint is keyed on.
+    user_id (str, optional): The caller; a key can only be replayed by the user who used it first.
+    payload (dict, optional): The request body; a key can only be replayed for the same body.
+
+    Returns:
+    JSONResponse: The stored response if the request already completed, or None if the caller should run
+    it and then call `complete` (or `release` if it fails).
+
+    Raises:
+    HTTPException: 409 while the first request with the key is still running, 422 if the key was used
+    for a different request.
+    """
+    body_hash = request_hash(payload)
+    row = await database_client.claim_idempotency_key(scope, idempotency_key, user_id, body_hash, IDEMPOTENCY_TTL, IDEMPOTENCY_LOCK_SECONDS)
+    if row is None:
+        return None
+    if row['user_id'] != user_id or row['request_hash'] != body_hash:
+        raise HTTPException(status_code=422, detail="This idempotency key was already used for a different request. ")
+    if row['status'] != 'completed':
+        metrics.increment('idempotency_conflicts')
+        raise HTTPException(status_code=409, detail="A request with this idempotency key is still being processed. ")
+    metrics.increment('idempotency_replays')
+    logger.info(f"Replaying the stored response of {scope} {idempotency_key}")
+    return JSONResponse(status_code=row['status_code'], content=json.loads(row['response']))
+
+
+async def complete(scope, idempotency_key, response, status_code=200):
+    """Stores the response of a request started with `begin`. Call it inside the request's transaction."""
+    await database_client.complete_idempotency_key(scope, idempotency_key, status_code, response)
+
+
+async def release(scope, idempotency_key):
+    """Frees the key of a request started with `begin` that failed, so it can be retried."""
+    try:
+        await database_client.release_idempotency_key(scope, idempotency_key)
+    except Exception as e:
+        # The lock runs out after IDEMPOTENCY_LOCK_SECONDS anyway.
+        logger.error(f"Error releasing idempotency key {scope} {idempotency_key}: {e}")
+
+
+class IdempotencyKeyCleaner:
+    """Deletes expired idempotency keys every CLEANUP_INTERVAL seconds, CLEANUP_BATCH_SIZE rows per statement."""
+    def __init__(self):
+        self.database = None
+        self._task = None
+
+    async def cleanup(self, batch_size=CLEANUP_BATCH_SIZE):
+        """
+        Runs one cleanup.
+
+        Returns:
+        int: The number of keys deleted.
+        """
+        started = time.monotonic()
+        deleted = 0
+        while True:
+            count = await self.database.delete_expired_idempotency_keys(batch_size)
+            deleted += count
+            if count < batch_size:
+                break
+        metrics.increment('idempotency_keys_expired', deleted)
+        if deleted:
+            logger.info(f"Deleted {deleted} expired idempotency keys in {time.monotonic() - started:.2f}s. ")
+        return deleted
+
+    async def run(self, interval=CLEANUP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logger.error(f"Error deleting expired idempotency keys: {e}")
+
+    def start(self, database, interval=CLEANUP_INTERVAL):
+        """Starts the periodic cleanup."""
+        self.database = database
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+idempotency_cleaner = IdempotencyKeyCleaner()
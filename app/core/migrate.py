@@ -0,0 +1,121 @@
+"""
+Applies the versioned SQL migrations in app/core/migrations.
+
+Each migration is a file named NNNN_description.sql. Applied versions are recorded in the
+schema_migrations table, so running the tool again only applies new files.
+Files may use `DELIMITER` lines, as in the mysql client, for stored program bodies.
+
+Usage:
+    python -m app.core.migrate            # apply all pending migrations
+    python -m app.core.migrate --status   # list applied and pending migrations
+    python -m app.core.migrate --target 3 # apply pending migrations up to version 3
+"""
+import argparse
+import asyncio
+import os
+import re
+
+from app.core.database import database_client
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("database")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+def list_migrations():
+    """
+    Returns the migrations on disk as (version, name, path) tuples, in version order.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Duplicate migration versions in " + MIGRATIONS_DIR)
+    return migrations
+
+
+def split_statements(sql):
+    """
+    Splits a migration file into statements, honouring `DELIMITER` lines.
+    Comment-only lines are dropped.
+    """
+    statements = []
+    delimiter = ";"
+    current = []
+    for line in sql.splitlines():
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith("--")):
+            continue
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split(None, 1)[1]
+            continue
+        if stripped.endswith(delimiter):
+            current.append(line.rstrip()[: -len(delimiter)])
+            statement = "\n".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+        else:
+            current.append(line)
+    if "\n".join(current).strip():
+        statements.append("\n".join(current).strip())
+    return statements
+
+
+async def applied_versions(cursor):
+    await cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        ) ENGINE=InnoDB
+    """)
+    await cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in await cursor.fetchall()}
+
+
+async def migrate(target=None, status=False):
+    """
+    Applies pending migrations in order, up to `target` if given.
+
+    MySQL commits DDL implicitly, so a migration that fails halfway is not rolled back;
+    the failing version is left unrecorded and the error is raised.
+    """
+    await database_client.init_pool()
+    connection = await database_client.get_connection()
+    try:
+        async with connection.cursor() as cursor:
+            applied = await applied_versions(cursor)
+            for version, name, path in list_migrations():
+                if status:
+                    logger.info(f"{version:04d} {name}: {'applied' if version in applied else 'pending'}")
+                    continue
+                if version in applied or (target is not None and version > target):
+                    continue
+                logger.info(f"Applying migration {version:04d} {name}")
+                with open(path) as file:
+                    for statement in split_statements(file.read()):
+                        await cursor.execute(statement)
+                await cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                await connection.commit()
+                logger.info(f"Applied migration {version:04d} {name}")
+    finally:
+        await database_client.release_connection(connection)
+        await database_client.close_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the SQL migrations in app/core/migrations.")
+    parser.add_argument("--target", type=int, default=None, help="Highest version to apply.")
+    parser.add_argument("--status", action="store_true", help="Only list applied and pending migrations.")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.target, args.status))
@@ -0,0 +1,122 @@
+-- Tables used by app/core/database.py, as they exist in production.
+-- Statements use IF NOT EXISTS so the migration can be recorded against an existing database.
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id VARCHAR(36) NOT NULL,
+    email VARCHAR(255) NOT NULL,
+    password_hash VARCHAR(255) NULL,
+    username VARCHAR(64) NULL,
+    first_name VARCHAR(100) NULL,
+    last_name VARCHAR(100) NULL,
+    bio TEXT NULL,
+    twitter VARCHAR(255) NULL,
+    telegram VARCHAR(255) NULL,
+    pfp_uri VARCHAR(512) NULL,
+    role VARCHAR(16) NOT NULL DEFAULT 'user',
+    status VARCHAR(32) NOT NULL DEFAULT 'not verified',
+    verified TINYINT(1) NOT NULL DEFAULT 0,
+    kyc TINYINT(1) NOT NULL DEFAULT 0,
+    artisan TINYINT(1) NOT NULL DEFAULT 0,
+    creator TINYINT(1) NOT NULL DEFAULT 0,
+    admin TINYINT(1) NOT NULL DEFAULT 0,
+    last_login DATETIME NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id),
+    UNIQUE KEY uq_users_email (email)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS collection_data (
+    id INT NOT NULL AUTO_INCREMENT,
+    name VARCHAR(255) NOT NULL,
+    creator VARCHAR(255) NOT NULL,
+    description TEXT NULL,
+    number INT NOT NULL,
+    image_uri VARCHAR(512) NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS collections (
+    trs_id VARCHAR(64) NOT NULL,
+    collection_name VARCHAR(255) NOT NULL,
+    mint_address VARCHAR(255) NULL,
+    token_account_address VARCHAR(255) NULL,
+    creator_id VARCHAR(36) NOT NULL,
+    PRIMARY KEY (trs_id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS trs (
+    trs_id VARCHAR(64) NOT NULL,
+    user_id VARCHAR(36) NOT NULL,
+    collection_name VARCHAR(255) NOT NULL,
+    creator VARCHAR(36) NOT NULL,
+    artisan TINYINT(1) NOT NULL DEFAULT 0,
+    marketplace TINYINT(1) NOT NULL DEFAULT 0,
+    in_trade TINYINT(1) NOT NULL DEFAULT 0,
+    PRIMARY KEY (trs_id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS marketplace (
+    trs_id VARCHAR(64) NOT NULL,
+    collection_name VARCHAR(255) NOT NULL,
+    order_type VARCHAR(8) NOT NULL,
+    buyer_seller_id VARCHAR(36) NOT NULL,
+    bid_price DECIMAL(18, 2) NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (trs_id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS trades (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    trade_id VARCHAR(64) NOT NULL,
+    buyer_id VARCHAR(36) NOT NULL,
+    seller_id VARCHAR(36) NOT NULL,
+    trs_id VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'initiated',
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_number VARCHAR(36) NOT NULL,
+    buyer_transaction_id VARCHAR(64) NULL,
+    collection_name VARCHAR(255) NULL,
+    trs_id VARCHAR(64) NULL,
+    buyer_id VARCHAR(36) NOT NULL,
+    seller_id VARCHAR(36) NOT NULL,
+    cost DECIMAL(18, 2) NULL,
+    amount DECIMAL(18, 2) NULL,
+    number INT NOT NULL DEFAULT 0,
+    status VARCHAR(16) NOT NULL DEFAULT 'initiated',
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (transaction_number)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS paypal_transactions (
+    transaction_id VARCHAR(64) NOT NULL,
+    buyer_id VARCHAR(36) NOT NULL,
+    seller_id VARCHAR(36) NOT NULL,
+    amount DECIMAL(18, 2) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'created',
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (transaction_id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS trs_creation_requests (
+    id INT NOT NULL AUTO_INCREMENT,
+    model_name VARCHAR(255) NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    description TEXT NULL,
+    creator_email VARCHAR(255) NOT NULL,
+    file_url_header VARCHAR(512) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS email_otps (
+    email VARCHAR(255) NOT NULL,
+    otp VARCHAR(16) NOT NULL,
+    expires_at DATETIME NOT NULL,
+    PRIMARY KEY (email)
+) ENGINE=InnoDB;
@@ -0,0 +1,44 @@
+-- Composite indexes for the queries DatabaseManager runs on every request.
+-- MySQL has no ADD INDEX IF NOT EXISTS, so every index is added through add_index_if_missing,
+-- which checks information_schema first; the migration can be recorded against an existing database.
+
+DROP PROCEDURE IF EXISTS add_index_if_missing;
+
+DELIMITER //
+CREATE PROCEDURE add_index_if_missing(IN p_table VARCHAR(64), IN p_index VARCHAR(64), IN p_definition VARCHAR(512))
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = p_table AND index_name = p_index
+    ) THEN
+        SET @add_index_ddl = CONCAT('ALTER TABLE ', p_table, ' ADD ', p_definition);
+        PREPARE add_index_statement FROM @add_index_ddl;
+        EXECUTE add_index_statement;
+        DEALLOCATE PREPARE add_index_statement;
+    END IF;
+END //
+DELIMITER ;
+
+-- Wallet reads: trs by user_id, and by (user_id, collection_name).
+CALL add_index_if_missing('trs', 'idx_trs_user_collection', 'INDEX idx_trs_user_collection (user_id, collection_name)');
+-- trs_id IN (...) AND in_trade = 0 is served by the primary key; email_otps by email likewise.
+
+-- Order book levels and trade_create: marketplace by (collection_name, bid_price).
+CALL add_index_if_missing('marketplace', 'idx_marketplace_level', 'INDEX idx_marketplace_level (collection_name, bid_price)');
+
+CALL add_index_if_missing('collections', 'idx_collections_collection', 'INDEX idx_collections_collection (collection_name)');
+
+CALL add_index_if_missing('collection_data', 'uq_collection_data_name', 'UNIQUE INDEX uq_collection_data_name (name)');
+
+-- execute_trade: transactions by buyer_transaction_id, trades by trade_id.
+CALL add_index_if_missing('transactions', 'idx_transactions_buyer_transaction', 'INDEX idx_transactions_buyer_transaction (buyer_transaction_id)');
+CALL add_index_if_missing('transactions', 'idx_transactions_buyer_status', 'INDEX idx_transactions_buyer_status (buyer_id, status)');
+CALL add_index_if_missing('trades', 'idx_trades_trade', 'INDEX idx_trades_trade (trade_id)');
+
+-- Admin listing pages by (status, id); duplicate title checks by title.
+CALL add_index_if_missing('trs_creation_requests', 'idx_trs_creation_requests_status', 'INDEX idx_trs_creation_requests_status (status, id)');
+CALL add_index_if_missing('trs_creation_requests', 'idx_trs_creation_requests_title', 'INDEX idx_trs_creation_requests_title (title)');
+
+CALL add_index_if_missing('users', 'idx_users_username', 'INDEX idx_users_username (username)');
+
+DROP PROCEDURE add_index_if_missing;
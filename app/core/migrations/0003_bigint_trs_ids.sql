@@ -0,0 +1,42 @@
+-- Replace the stringified uuid4().int TRS ids with compact BIGINT ids.
+--
+-- New ids are handed out by DatabaseManager.allocate_ids in blocks of TRS_ID_BLOCK_SIZE:
+-- block `hi` covers ids hi * TRS_ID_BLOCK_SIZE .. (hi + 1) * TRS_ID_BLOCK_SIZE - 1.
+-- id_blocks only hands out block numbers; its AUTO_INCREMENT lock is not held until commit,
+-- so concurrent mints do not serialise on it.
+
+CREATE TABLE IF NOT EXISTS id_blocks (
+    hi BIGINT NOT NULL AUTO_INCREMENT,
+    sequence_name VARCHAR(32) NOT NULL,
+    allocated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (hi)
+) ENGINE=InnoDB;
+
+-- Old id -> new id, kept for anything outside the database that recorded the old ids.
+CREATE TABLE IF NOT EXISTS trs_id_map (
+    old_id VARCHAR(64) NOT NULL,
+    new_id BIGINT NOT NULL,
+    PRIMARY KEY (old_id),
+    UNIQUE KEY uq_trs_id_map_new (new_id)
+) ENGINE=InnoDB;
+
+-- Existing TRS are renumbered 1..N, collection by collection.
+INSERT INTO trs_id_map (old_id, new_id)
+SELECT trs_id, ROW_NUMBER() OVER (ORDER BY collection_name, trs_id)
+FROM collections;
+
+-- Reserve the blocks the renumbered ids fall into, with TRS_ID_BLOCK_SIZE = 10000.
+INSERT INTO id_blocks (hi, sequence_name)
+SELECT COUNT(*) DIV 10000, 'trs' FROM trs_id_map;
+
+UPDATE collections c JOIN trs_id_map m ON m.old_id = c.trs_id SET c.trs_id = m.new_id;
+UPDATE trs t JOIN trs_id_map m ON m.old_id = t.trs_id SET t.trs_id = m.new_id;
+UPDATE marketplace k JOIN trs_id_map m ON m.old_id = k.trs_id SET k.trs_id = m.new_id;
+UPDATE trades t JOIN trs_id_map m ON m.old_id = t.trs_id SET t.trs_id = m.new_id;
+UPDATE transactions t JOIN trs_id_map m ON m.old_id = t.trs_id SET t.trs_id = m.new_id;
+
+ALTER TABLE collections MODIFY trs_id BIGINT NOT NULL;
+ALTER TABLE trs MODIFY trs_id BIGINT NOT NULL;
+ALTER TABLE marketplace MODIFY trs_id BIGINT NOT NULL;
+ALTER TABLE trades MODIFY trs_id BIGINT NOT NULL;
+ALTER TABLE transactions MODIFY trs_id BIGINT NULL;
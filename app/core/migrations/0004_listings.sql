@@ -0,0 +1,36 @@
+-- Replace the per-TRS marketplace rows with one row per listing.
+--
+-- A listing offers `quantity` TRS of a collection at a price; `reserved` of them are held by
+-- unfinished trades. Listings do not pin specific TRS: a seller's listed quantity is covered by
+-- their TRS with artisan = 0 and in_trade = 0, and the trade draws the tokens when it reserves.
+
+CREATE TABLE IF NOT EXISTS listings (
+    listing_id BIGINT NOT NULL AUTO_INCREMENT,
+    seller_id VARCHAR(36) NOT NULL,
+    collection_name VARCHAR(255) NOT NULL,
+    price DECIMAL(18, 2) NOT NULL,
+    quantity INT NOT NULL,
+    reserved INT NOT NULL DEFAULT 0,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (listing_id),
+    INDEX idx_listings_level (collection_name, price, created_at),
+    INDEX idx_listings_seller (seller_id, collection_name)
+) ENGINE=InnoDB;
+
+ALTER TABLE trades ADD COLUMN listing_id BIGINT NULL;
+
+INSERT INTO listings (seller_id, collection_name, price, quantity, reserved, created_at)
+SELECT m.buyer_seller_id, m.collection_name, m.bid_price, SUM(t.in_trade = 0), SUM(t.in_trade = 1), MIN(m.created_at)
+FROM marketplace m
+JOIN trs t ON t.trs_id = m.trs_id
+GROUP BY m.buyer_seller_id, m.collection_name, m.bid_price;
+
+UPDATE trades tr
+JOIN marketplace m ON m.trs_id = tr.trs_id
+JOIN listings l ON l.seller_id = m.buyer_seller_id AND l.collection_name = m.collection_name AND l.price = m.bid_price
+SET tr.listing_id = l.listing_id
+WHERE tr.status = 'initiated';
+
+UPDATE trs SET marketplace = 0 WHERE marketplace = 1;
+
+RENAME TABLE marketplace TO marketplace_legacy;
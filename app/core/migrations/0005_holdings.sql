@@ -0,0 +1,35 @@
+-- Per-(user, collection) balances kept alongside the per-TRS `trs` rows.
+--
+-- total:    TRS held
+-- artisan:  of which have artisan rights active
+-- listed:   quantity offered on unreserved listings (listings.quantity)
+-- reserved: of which are held by unfinished trades (trs.in_trade = 1)
+-- created:  whether the user created the collection
+--
+-- DatabaseManager updates these counters in the same transaction as every write to trs and
+-- listings; `python -m app.core.consistency` compares them with the per-TRS rows.
+
+CREATE TABLE IF NOT EXISTS holdings (
+    user_id VARCHAR(36) NOT NULL,
+    collection_name VARCHAR(255) NOT NULL,
+    total INT NOT NULL DEFAULT 0,
+    artisan INT NOT NULL DEFAULT 0,
+    listed INT NOT NULL DEFAULT 0,
+    reserved INT NOT NULL DEFAULT 0,
+    created TINYINT(1) NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, collection_name)
+) ENGINE=InnoDB;
+
+INSERT INTO holdings (user_id, collection_name, total, artisan, listed, reserved, created)
+SELECT t.user_id, t.collection_name, t.total, t.artisan, COALESCE(l.listed, 0), t.reserved, t.created
+FROM (
+    SELECT user_id, collection_name, COUNT(*) AS total, SUM(artisan = 1) AS artisan,
+           SUM(in_trade = 1) AS reserved, MAX(creator = user_id) AS created
+    FROM trs
+    GROUP BY user_id, collection_name
+) AS t
+LEFT JOIN (
+    SELECT seller_id, collection_name, SUM(quantity) AS listed
+    FROM listings
+    GROUP BY seller_id, collection_name
+) AS l ON l.seller_id = t.user_id AND l.collection_name = t.collection_name;
@@ -0,0 +1,168 @@
+-- Versioned stored procedures for the trade lifecycle, used when TRADE_PROCEDURES is enabled.
+--
+-- Each procedure performs one step of DatabaseManager's Python path (trade_create, execute_trade,
+-- cancel_trade) in a single round trip. They run inside the caller's transaction and never commit.
+-- A change in behaviour gets a new _vN procedure rather than an edit in place, so that application
+-- instances on the previous release keep calling the version they were written against.
+
+DELIMITER $$
+
+CREATE PROCEDURE trade_reserve_v1(
+    IN p_trade_id VARCHAR(64),
+    IN p_buyer_id VARCHAR(36),
+    IN p_collection_name VARCHAR(255),
+    IN p_price DECIMAL(18, 2),
+    IN p_number INT
+)
+BEGIN
+    DECLARE v_remaining INT DEFAULT p_number;
+    DECLARE v_listing_id BIGINT;
+    DECLARE v_seller_id VARCHAR(36);
+    DECLARE v_quantity INT;
+    DECLARE v_take INT;
+    DECLARE CONTINUE HANDLER FOR NOT FOUND SET v_listing_id = NULL;
+
+    WHILE v_remaining > 0 DO
+        SET v_listing_id = NULL;
+        SELECT listing_id, seller_id, quantity INTO v_listing_id, v_seller_id, v_quantity
+        FROM listings
+        WHERE collection_name = p_collection_name AND price = p_price AND quantity > 0
+        ORDER BY created_at, listing_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED;
+
+        IF v_listing_id IS NULL THEN
+            SELECT listing_id, seller_id, quantity INTO v_listing_id, v_seller_id, v_quantity
+            FROM listings
+            WHERE collection_name = p_collection_name AND price = p_price AND quantity > 0
+            ORDER BY created_at, listing_id
+            LIMIT 1
+            FOR UPDATE;
+        END IF;
+
+        IF v_listing_id IS NULL THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Not enough trs available.';
+        END IF;
+
+        SET v_take = LEAST(v_quantity, v_remaining);
+        UPDATE listings SET quantity = quantity - v_take, reserved = reserved + v_take WHERE listing_id = v_listing_id;
+
+        INSERT INTO trades (trade_id, buyer_id, seller_id, trs_id, listing_id, status)
+        SELECT p_trade_id, p_buyer_id, user_id, trs_id, v_listing_id, 'initiated'
+        FROM trs
+        WHERE user_id = v_seller_id AND collection_name = p_collection_name AND artisan = 0 AND in_trade = 0
+        ORDER BY trs_id
+        LIMIT v_take
+        FOR UPDATE SKIP LOCKED;
+
+        IF ROW_COUNT() < v_take THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Listing is not covered by the seller''s TRS.';
+        END IF;
+
+        UPDATE trs t
+        JOIN trades tr ON tr.trs_id = t.trs_id
+        SET t.in_trade = 1
+        WHERE tr.trade_id = p_trade_id AND tr.listing_id = v_listing_id;
+
+        INSERT INTO holdings (user_id, collection_name, listed, reserved)
+        VALUES (v_seller_id, p_collection_name, -v_take, v_take)
+        ON DUPLICATE KEY UPDATE listed = listed - v_take, reserved = reserved + v_take;
+
+        SET v_remaining = v_remaining - v_take;
+    END WHILE;
+
+    INSERT INTO transactions (transaction_number, collection_name, buyer_id, seller_id, cost, number, status, buyer_transaction_id)
+    SELECT UUID(), p_collection_name, p_buyer_id, seller_id, p_price, COUNT(*), 'initiated', p_trade_id
+    FROM trades
+    WHERE trade_id = p_trade_id
+    GROUP BY seller_id;
+END$$
+
+CREATE PROCEDURE trade_settle_v1(IN p_trade_id VARCHAR(64))
+BEGIN
+    DECLARE v_pending INT;
+
+    SELECT COUNT(*) INTO v_pending
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'initiated'
+    FOR UPDATE;
+
+    IF v_pending = 0 THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'No pending transactions for trade.';
+    END IF;
+
+    UPDATE trs t
+    JOIN trades tr ON tr.trs_id = t.trs_id
+    SET t.user_id = tr.buyer_id, t.in_trade = 0
+    WHERE tr.trade_id = p_trade_id AND tr.status = 'initiated' AND t.user_id = tr.seller_id;
+
+    UPDATE listings l
+    JOIN (
+        SELECT listing_id, COUNT(*) AS number
+        FROM trades
+        WHERE trade_id = p_trade_id AND status = 'initiated'
+        GROUP BY listing_id
+    ) AS tr ON tr.listing_id = l.listing_id
+    SET l.reserved = l.reserved - tr.number;
+
+    DELETE l FROM listings l
+    JOIN trades tr ON tr.listing_id = l.listing_id
+    WHERE tr.trade_id = p_trade_id AND l.quantity = 0 AND l.reserved = 0;
+
+    INSERT INTO holdings (user_id, collection_name, total, reserved)
+    SELECT seller_id, collection_name, -number, -number
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'initiated'
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total), reserved = reserved + VALUES(reserved);
+
+    INSERT INTO holdings (user_id, collection_name, total)
+    SELECT buyer_id, collection_name, SUM(number)
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'initiated'
+    GROUP BY buyer_id, collection_name
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total);
+
+    UPDATE trades SET status = 'completed' WHERE trade_id = p_trade_id AND status = 'initiated';
+    UPDATE transactions SET status = 'finished' WHERE buyer_transaction_id = p_trade_id AND status = 'initiated';
+
+    SELECT tx.seller_id, s.email AS seller_email, tx.number, tx.cost, tx.collection_name,
+           tx.buyer_id, b.email AS buyer_email, cd.creator AS creator_email
+    FROM transactions tx
+    JOIN users s ON s.user_id = tx.seller_id
+    JOIN users b ON b.user_id = tx.buyer_id
+    LEFT JOIN collection_data cd ON cd.name = tx.collection_name
+    WHERE tx.buyer_transaction_id = p_trade_id AND tx.status = 'finished';
+END$$
+
+CREATE PROCEDURE trade_cancel_v1(IN p_trade_id VARCHAR(64))
+BEGIN
+    SELECT collection_name, cost, number
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'initiated'
+    FOR UPDATE;
+
+    UPDATE trs t
+    JOIN trades tr ON tr.trs_id = t.trs_id
+    SET t.in_trade = 0
+    WHERE tr.trade_id = p_trade_id AND tr.status = 'initiated';
+
+    UPDATE listings l
+    JOIN (
+        SELECT listing_id, COUNT(*) AS number
+        FROM trades
+        WHERE trade_id = p_trade_id AND status = 'initiated'
+        GROUP BY listing_id
+    ) AS tr ON tr.listing_id = l.listing_id
+    SET l.quantity = l.quantity + tr.number, l.reserved = l.reserved - tr.number;
+
+    INSERT INTO holdings (user_id, collection_name, listed, reserved)
+    SELECT seller_id, collection_name, number, -number
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'initiated'
+    ON DUPLICATE KEY UPDATE listed = listed + VALUES(listed), reserved = reserved + VALUES(reserved);
+
+    UPDATE trades SET status = 'cancelled' WHERE trade_id = p_trade_id AND status = 'initiated';
+    UPDATE transactions SET status = 'cancelled' WHERE buyer_transaction_id = p_trade_id AND status = 'initiated';
+END$$
+
+DELIMITER ;
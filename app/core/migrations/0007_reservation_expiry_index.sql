@@ -0,0 +1,2 @@
+-- Reservation sweeper: pending trades by age, oldest first, without scanning finished ones.
+ALTER TABLE transactions ADD INDEX idx_transactions_status_created (status, created_at);
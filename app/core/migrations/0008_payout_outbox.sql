@@ -0,0 +1,27 @@
+-- Payout intents written in the same transaction as trade settlement and sent by the payout worker.
+--
+-- status: pending -> sending -> sent, or failed after PAYOUT_MAX_ATTEMPTS.
+-- A row in `sending` whose next_attempt_at has passed was claimed by a worker that died; it is
+-- claimed again and resent with the same idempotency_key, which PayPal uses to drop duplicates.
+
+CREATE TABLE IF NOT EXISTS payout_outbox (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    trade_id VARCHAR(64) NOT NULL,
+    kind VARCHAR(16) NOT NULL,
+    recipient_email VARCHAR(255) NOT NULL,
+    amount DECIMAL(18, 2) NOT NULL,
+    currency CHAR(3) NOT NULL DEFAULT 'USD',
+    note VARCHAR(255) NULL,
+    idempotency_key VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT NULL,
+    payout_batch_id VARCHAR(64) NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    UNIQUE INDEX uq_payout_outbox_idempotency_key (idempotency_key),
+    INDEX idx_payout_outbox_due (status, next_attempt_at),
+    INDEX idx_payout_outbox_trade (trade_id)
+) ENGINE=InnoDB;
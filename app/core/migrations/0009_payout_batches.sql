@@ -0,0 +1,15 @@
+-- Batched payouts: intents are grouped into multi-item PayPal payout batches.
+--
+-- reference:       the seller the payout is for (a trade has one seller and one royalty intent per seller)
+-- sender_batch_id: our id of the batch the intent was sent in; kept across retries of an unknown outcome
+--                  so that a resent batch is recognised by PayPal as a duplicate
+-- payout_item_id, item_status, item_checked_at: the PayPal item of the intent and its last known status
+
+ALTER TABLE payout_outbox
+    ADD COLUMN reference VARCHAR(36) NULL AFTER kind,
+    ADD COLUMN sender_batch_id VARCHAR(64) NULL AFTER idempotency_key,
+    ADD COLUMN payout_item_id VARCHAR(64) NULL AFTER payout_batch_id,
+    ADD COLUMN item_status VARCHAR(16) NULL AFTER payout_item_id,
+    ADD COLUMN item_checked_at DATETIME NULL AFTER item_status,
+    ADD INDEX idx_payout_outbox_sender_batch (sender_batch_id),
+    ADD INDEX idx_payout_outbox_items (status, item_checked_at);
@@ -0,0 +1,20 @@
+-- Outcomes of idempotent requests (/trade/create with an Idempotency-Key header, /trade/execute_payment
+-- keyed on the paymentId), so a retried request gets the stored response instead of running again.
+--
+-- status: pending while the first request runs (locked_until bounds how long a crashed request blocks
+-- retries), completed once its response is stored. Rows are deleted after expires_at.
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope VARCHAR(32) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    user_id VARCHAR(36) NULL,
+    request_hash CHAR(64) NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    status_code INT NULL,
+    response TEXT NULL,
+    locked_until DATETIME NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME NOT NULL,
+    PRIMARY KEY (scope, idempotency_key),
+    INDEX idx_idempotency_keys_expires (expires_at)
+) ENGINE=InnoDB;
@@ -0,0 +1,11 @@
+-- Object key -> IPFS CID of the files uploaded to Filebase, recorded right after each upload, so
+-- approving a TRS creation request reads the thumbnail CID from here instead of asking Filebase.
+
+CREATE TABLE IF NOT EXISTS storage_objects (
+    object_key VARCHAR(512) NOT NULL,
+    cid VARCHAR(128) NOT NULL,
+    size BIGINT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (object_key)
+) ENGINE=InnoDB;
@@ -0,0 +1,7 @@
+-- SHA-256 of the content of uploaded objects, so an upload whose content is already in the bucket
+-- is copied server-side (or skipped) instead of sent again. NULL for objects uploaded directly by
+-- clients, whose content the API never sees.
+
+ALTER TABLE storage_objects
+    ADD COLUMN sha256 CHAR(64) NULL AFTER size,
+    ADD INDEX idx_storage_objects_sha256 (sha256);
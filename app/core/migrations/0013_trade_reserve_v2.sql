@@ -0,0 +1,83 @@
+-- trade_reserve_v2: as trade_reserve_v1, but the transactions rows it writes cover only the TRS
+-- reserved by this call. v1 grouped every trades row of the trade, so a trade reserved at several
+-- prices (a market order) got the earlier levels' seller rows again at each later price.
+
+DELIMITER $$
+
+CREATE PROCEDURE trade_reserve_v2(
+    IN p_trade_id VARCHAR(64),
+    IN p_buyer_id VARCHAR(36),
+    IN p_collection_name VARCHAR(255),
+    IN p_price DECIMAL(18, 2),
+    IN p_number INT
+)
+BEGIN
+    DECLARE v_remaining INT DEFAULT p_number;
+    DECLARE v_listing_id BIGINT;
+    DECLARE v_seller_id VARCHAR(36);
+    DECLARE v_quantity INT;
+    DECLARE v_take INT;
+    DECLARE v_before BIGINT;
+    DECLARE CONTINUE HANDLER FOR NOT FOUND SET v_listing_id = NULL;
+
+    -- A market order calls this once per price level for the same trade; only the trades rows
+    -- written by this call get a transactions row here.
+    SELECT COALESCE(MAX(id), 0) INTO v_before FROM trades WHERE trade_id = p_trade_id;
+
+    WHILE v_remaining > 0 DO
+        SET v_listing_id = NULL;
+        SELECT listing_id, seller_id, quantity INTO v_listing_id, v_seller_id, v_quantity
+        FROM listings
+        WHERE collection_name = p_collection_name AND price = p_price AND quantity > 0
+        ORDER BY created_at, listing_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED;
+
+        IF v_listing_id IS NULL THEN
+            SELECT listing_id, seller_id, quantity INTO v_listing_id, v_seller_id, v_quantity
+            FROM listings
+            WHERE collection_name = p_collection_name AND price = p_price AND quantity > 0
+            ORDER BY created_at, listing_id
+            LIMIT 1
+            FOR UPDATE;
+        END IF;
+
+        IF v_listing_id IS NULL THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Not enough trs available.';
+        END IF;
+
+        SET v_take = LEAST(v_quantity, v_remaining);
+        UPDATE listings SET quantity = quantity - v_take, reserved = reserved + v_take WHERE listing_id = v_listing_id;
+
+        INSERT INTO trades (trade_id, buyer_id, seller_id, trs_id, listing_id, status)
+        SELECT p_trade_id, p_buyer_id, user_id, trs_id, v_listing_id, 'initiated'
+        FROM trs
+        WHERE user_id = v_seller_id AND collection_name = p_collection_name AND artisan = 0 AND in_trade = 0
+        ORDER BY trs_id
+        LIMIT v_take
+        FOR UPDATE SKIP LOCKED;
+
+        IF ROW_COUNT() < v_take THEN
+            SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'Listing is not covered by the seller''s TRS.';
+        END IF;
+
+        UPDATE trs t
+        JOIN trades tr ON tr.trs_id = t.trs_id
+        SET t.in_trade = 1
+        WHERE tr.trade_id = p_trade_id AND tr.listing_id = v_listing_id;
+
+        INSERT INTO holdings (user_id, collection_name, listed, reserved)
+        VALUES (v_seller_id, p_collection_name, -v_take, v_take)
+        ON DUPLICATE KEY UPDATE listed = listed - v_take, reserved = reserved + v_take;
+
+        SET v_remaining = v_remaining - v_take;
+    END WHILE;
+
+    INSERT INTO transactions (transaction_number, collection_name, buyer_id, seller_id, cost, number, status, buyer_transaction_id)
+    SELECT UUID(), p_collection_name, p_buyer_id, seller_id, p_price, COUNT(*), 'initiated', p_trade_id
+    FROM trades
+    WHERE trade_id = p_trade_id AND id > v_before
+    GROUP BY seller_id;
+END$$
+
+DELIMITER ;
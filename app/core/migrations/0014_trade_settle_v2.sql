@@ -0,0 +1,63 @@
+-- trade_settle_v2: as trade_settle_v1, but settles the trade only once it has been claimed for
+-- execution (status `executing`, see DatabaseManager.claim_trade). The claim is taken before the
+-- buyer is charged, so the reservation sweeper cannot cancel a trade whose payment is running.
+
+DELIMITER $$
+
+CREATE PROCEDURE trade_settle_v2(IN p_trade_id VARCHAR(64))
+BEGIN
+    DECLARE v_pending INT;
+
+    SELECT COUNT(*) INTO v_pending
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'executing'
+    FOR UPDATE;
+
+    IF v_pending = 0 THEN
+        SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'No executing transactions for trade.';
+    END IF;
+
+    UPDATE trs t
+    JOIN trades tr ON tr.trs_id = t.trs_id
+    SET t.user_id = tr.buyer_id, t.in_trade = 0
+    WHERE tr.trade_id = p_trade_id AND tr.status = 'executing' AND t.user_id = tr.seller_id;
+
+    UPDATE listings l
+    JOIN (
+        SELECT listing_id, COUNT(*) AS number
+        FROM trades
+        WHERE trade_id = p_trade_id AND status = 'executing'
+        GROUP BY listing_id
+    ) AS tr ON tr.listing_id = l.listing_id
+    SET l.reserved = l.reserved - tr.number;
+
+    DELETE l FROM listings l
+    JOIN trades tr ON tr.listing_id = l.listing_id
+    WHERE tr.trade_id = p_trade_id AND l.quantity = 0 AND l.reserved = 0;
+
+    INSERT INTO holdings (user_id, collection_name, total, reserved)
+    SELECT seller_id, collection_name, -number, -number
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'executing'
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total), reserved = reserved + VALUES(reserved);
+
+    INSERT INTO holdings (user_id, collection_name, total)
+    SELECT buyer_id, collection_name, SUM(number)
+    FROM transactions
+    WHERE buyer_transaction_id = p_trade_id AND status = 'executing'
+    GROUP BY buyer_id, collection_name
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total);
+
+    UPDATE trades SET status = 'completed' WHERE trade_id = p_trade_id AND status = 'executing';
+    UPDATE transactions SET status = 'finished' WHERE buyer_transaction_id = p_trade_id AND status = 'executing';
+
+    SELECT tx.seller_id, s.email AS seller_email, tx.number, tx.cost, tx.collection_name,
+           tx.buyer_id, b.email AS buyer_email, cd.creator AS creator_email
+    FROM transactions tx
+    JOIN users s ON s.user_id = tx.seller_id
+    JOIN users b ON b.user_id = tx.buyer_id
+    LEFT JOIN collection_data cd ON cd.name = tx.collection_name
+    WHERE tx.buyer_transaction_id = p_trade_id AND tx.status = 'finished';
+END$$
+
+DELIMITER ;
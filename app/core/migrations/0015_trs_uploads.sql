@@ -0,0 +1,21 @@
+-- Direct uploads issued by /create_trs_request/uploads, so /create_trs_request/finalize only accepts
+-- objects the caller was given URLs for, and unfinished multipart uploads can be aborted.
+--
+-- upload_id:  the multipart upload of the object, NULL for a single presigned PUT
+-- status:     issued, finalized (part of a submitted TRS creation request) or aborted (expired)
+-- expires_at: until when the upload can be finalized; the sweeper aborts it afterwards
+
+CREATE TABLE IF NOT EXISTS trs_uploads (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    user_id VARCHAR(36) NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    object_key VARCHAR(512) NOT NULL,
+    size BIGINT NOT NULL,
+    upload_id VARCHAR(255) NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'issued',
+    expires_at DATETIME NOT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    INDEX idx_trs_uploads_user_key (user_id, object_key, status),
+    INDEX idx_trs_uploads_expiry (status, expires_at)
+) ENGINE=InnoDB;
@@ -0,0 +1,5 @@
+-- Execution claims of trades (DatabaseManager.claim_trade) carry a lease: claimed_at is set when a
+-- trade moves to `executing`, so the reservation sweeper can find trades left `executing` by a
+-- request that stopped between charging the buyer and settling, and reconcile them with PayPal.
+ALTER TABLE transactions ADD COLUMN claimed_at DATETIME NULL;
+ALTER TABLE transactions ADD INDEX idx_transactions_status_claimed (status, claimed_at);
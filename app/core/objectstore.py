@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+
+from app.utils.metrics import metrics
+
+from app.utils.logging_config import logging_config
+import logging.config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("storage")
+
+# Storage calls run on their own threads; at most STORAGE_CONCURRENCY run at a time per store.
+STORAGE_CONCURRENCY = int(os.getenv("STORAGE_CONCURRENCY", 4))
+# Seconds a transfer (upload/download) and a metadata call may take before the caller gets a timeout.
+STORAGE_TRANSFER_TIMEOUT = float(os.getenv("STORAGE_TRANSFER_TIMEOUT", 600))
+STORAGE_METADATA_TIMEOUT = float(os.getenv("STORAGE_METADATA_TIMEOUT", 15))
+# Files from STORAGE_MULTIPART_THRESHOLD bytes up are uploaded as multipart uploads of
+# STORAGE_MULTIPART_CHUNKSIZE parts, STORAGE_MULTIPART_CONCURRENCY parts at a time.
+STORAGE_MULTIPART_THRESHOLD = int(os.getenv("STORAGE_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+STORAGE_MULTIPART_CHUNKSIZE = int(os.getenv("STORAGE_MULTIPART_CHUNKSIZE", 16 * 1024 * 1024))
+STORAGE_MULTIPART_CONCURRENCY = int(os.getenv("STORAGE_MULTIPART_CONCURRENCY", 4))
+# Connections a client needs so that every concurrent part upload gets one.
+STORAGE_MAX_POOL_CONNECTIONS = STORAGE_CONCURRENCY * STORAGE_MULTIPART_CONCURRENCY
+# Seconds a presigned upload URL stays valid.
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", 3600))
+
+
+class ObjectStore:
+    """
+    Async interface to an object store bucket, used by app/core/storage.py (Filebase) and app/core/aws.py.
+
+    Implementations must not block the event loop.
+    """
+    async def upload_fileobj(self, fileobj, key, content_type=None, metadata=None):
+        """Uploads a file object to `key`."""
+        raise NotImplementedError
+
+    async def download_file(self, key, path):
+        """Downloads `key` to the local file `path`."""
+        raise NotImplementedError
+
+    async def head_object(self, key):
+        """Returns the metadata of `key` as returned by S3 HeadObject."""
+        raise NotImplementedError
+
+    async def copy_object(self, source_key, key):
+        """Copies the object `source_key` to `key` inside the bucket, without transferring its content through the app."""
+        raise NotImplementedError
+
+    async def presign_put(self, key, content_type=None, expires=None):
+        """Returns a URL a client can PUT the object `key` to directly."""
+        raise NotImplementedError
+
+    async def create_multipart_upload(self, key, content_type=None):
+        """Starts a multipart upload of `key` and returns its upload id."""
+        raise NotImplementedError
+
+    async def presign_upload_part(self, key, upload_id, part_number, expires=None):
+        """Returns a URL a client can PUT one part of a multipart upload to directly."""
+        raise NotImplementedError
+
+    async def complete_multipart_upload(self, key, upload_id, parts):
+        """Assembles a multipart upload from its (part_number, etag) parts."""
+        raise NotImplementedError
+
+    async def abort_multipart_upload(self, key, upload_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class S3ObjectStore(ObjectStore):
+    """
+    ObjectStore over a boto3 S3 client.
+
+    boto3 is synchronous, so every call runs on a dedicated thread pool of `concurrency` threads and the
+    coroutine waits for it; the event loop keeps serving requests while a file is transferred. A semaphore
+    makes callers beyond `concurrency` wait in the loop instead of queueing unboundedly on the pool.
+
+    Uploads of large files are multipart, with parts sent in parallel by boto3's transfer manager,
+    so one store can have up to `concurrency` x STORAGE_MULTIPART_CONCURRENCY requests in flight;
+    create the client with STORAGE_MAX_POOL_CONNECTIONS connections.
+
+    A call that exceeds its timeout raises asyncio.TimeoutError to the caller. The thread cannot be
+    interrupted and finishes the transfer in the background, but its result is discarded.
+    """
+    def __init__(self, client, bucket, concurrency=STORAGE_CONCURRENCY, name="s3"):
+        self.client = client
+        self.bucket = bucket
+        self.name = name
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"storage-{name}")
+        self._semaphore = None
+        self.transfer_config = TransferConfig(
+            multipart_threshold=STORAGE_MULTIPART_THRESHOLD,
+            multipart_chunksize=STORAGE_MULTIPART_CHUNKSIZE,
+            max_concurrency=STORAGE_MULTIPART_CONCURRENCY,
+            use_threads=True
+        )
+
+    async def run(self, timeout, function, *args, **kwargs):
+        """Runs a blocking boto3 call on the store's thread pool, bounded by its concurrency and `timeout`."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            try:
+                return await asyncio.wait_for(loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs)), timeout)
+            except asyncio.TimeoutError:
+                metrics.increment(f'storage_{self.name}_timeouts')
+                logger.error(f"{self.name} call {function.__name__} timed out after {timeout}s. ")
+                raise
+            finally:
+                metrics.observe(f'storage_{self.name}_{function.__name__}_seconds', loop.time() - started)
+
+    async def upload_fileobj(self, fileobj, key, content_type=None, metadata=None, timeout=STORAGE_TRANSFER_TIMEOUT):
+        extra_args = {}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        if metadata:
+            extra_args['Metadata'] = metadata
+        await self.run(timeout, self.client.upload_fileobj, fileobj, self.bucket, key, ExtraArgs=extra_args or None, Config=self.transfer_config)
+
+    async def download_file(self, key, path, timeout=STORAGE_TRANSFER_TIMEOUT):
+        await self.run(timeout, self.client.download_file, self.bucket, key, path, Config=self.transfer_config)
+
+    async def head_object(self, key, timeout=STORAGE_METADATA_TIMEOUT):
+        return await self.run(timeout, self.client.head_object, Bucket=self.bucket, Key=key)
+
+    async def copy_object(self, source_key, key, timeout=STORAGE_TRANSFER_TIMEOUT):
+        # The managed copy switches to a multipart copy for large objects.
+        await self.run(timeout, self.client.copy, {'Bucket': self.bucket, 'Key': source_key}, self.bucket, key, Config=self.transfer_config)
+
+    # Presigning only signs locally, so it runs on the loop without a thread.
+    async def presign_put(self, key, content_type=None, expires=PRESIGNED_URL_TTL):
+        params = {'Bucket': self.bucket, 'Key': key}
+        if content_type:
+            params['ContentType'] = content_type
+        return self.client.generate_presigned_url('put_object', Params=params, ExpiresIn=expires)
+
+    async def presign_upload_part(self, key, upload_id, part_number, expires=PRESIGNED_URL_TTL):
+        params = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number}
+        return self.client.generate_presigned_url('upload_part', Params=params, ExpiresIn=expires)
+
+    async def create_multipart_upload(self, key, content_type=None, timeout=STORAGE_METADATA_TIMEOUT):
+        extra_args = {'ContentType': content_type} if content_type else {}
+        response = await self.run(timeout, self.client.create_multipart_upload, Bucket=self.bucket, Key=key, **extra_args)
+        return response['UploadId']
+
+    async def complete_multipart_upload(self, key, upload_id, parts, timeout=STORAGE_METADATA_TIMEOUT):
+        multipart_upload = {'Parts': [{'PartNumber': part_number, 'ETag': etag} for part_number, etag in sorted(parts)]}
+        return await self.run(timeout, self.client.complete_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload=multipart_upload)
+
+    async def abort_multipart_upload(self, key, upload_id, timeout=STORAGE_METADATA_TIMEOUT):
+        await self.run(timeout, self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
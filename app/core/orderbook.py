@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import os
+import random
+from decimal import Decimal
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("marketplace")
+
+RECONCILE_INTERVAL = float(os.getenv("ORDERBOOK_RECONCILE_INTERVAL", 60))
+# A reconcile that raced a marketplace write is retried this many times, a random 0-1s apart.
+RECONCILE_ATTEMPTS = int(os.getenv("ORDERBOOK_RECONCILE_ATTEMPTS", 10))
+
+
+def price_key(price):
+    """Normalises a price so that 5, 5.0 and Decimal('5.00') address the same level."""
+    return Decimal(str(price))
+
+
+class OrderBook:
+    """
+    In-process view of the marketplace: collection -> sorted price levels -> quantity.
+
+    Each level keeps the number of TRS listed at that price and how many of them are reserved by
+    an unfinished trade. It is loaded from the database at startup, updated by DatabaseManager once
+    every marketplace write commits (DatabaseManager.on_commit), and periodically reconciled against
+    the database to repair any drift.
+    """
+    def __init__(self):
+        self.levels = {}            # collection_name -> {price: [listed, reserved]}
+        self.prices = {}            # collection_name -> sorted list of prices
+        self.collections = []       # sorted collection names
+        self.collection_data = {}   # collection_name -> collection_data rows
+        self.database = None
+        self.loaded = False
+        self.mutations = 0
+        self._reconcile_task = None
+
+    def _level(self, collection_name, price):
+        price = price_key(price)
+        if collection_name not in self.levels:
+            bisect.insort(self.collections, collection_name)
+        levels = self.levels.setdefault(collection_name, {})
+        if price not in levels:
+            levels[price] = [0, 0]
+            bisect.insort(self.prices.setdefault(collection_name, []), price)
+        return levels[price]
+
+    def _drop_if_empty(self, collection_name, price):
+        price = price_key(price)
+        levels = self.levels.get(collection_name, {})
+        level = levels.get(price)
+        if level is not None and level[0] <= 0:
+            del levels[price]
+            self.prices[collection_name].remove(price)
+            if not levels:
+                del self.levels[collection_name]
+                del self.prices[collection_name]
+                self.collections.remove(collection_name)
+
+    def add(self, collection_name, price, number):
+        """Lists `number` more TRS at `price`."""
+        self._level(collection_name, price)[0] += number
+        self.mutations += 1
+
+    def remove(self, collection_name, price, number, reserved=0):
+        """Delists `number` TRS at `price`, `reserved` of which were held by a trade."""
+        level = self._level(collection_name, price)
+        level[0] -= number
+        level[1] = max(level[1] - reserved, 0)
+        self._drop_if_empty(collection_name, price)
+        self.mutations += 1
+
+    def reserve(self, collection_name, price, number):
+        """Marks `number` listed TRS at `price` as held by a trade."""
+        self._level(collection_name, price)[1] += number
+        self.mutations += 1
+
+    def release(self, collection_name, price, number):
+        """Returns `number` reserved TRS at `price` to the available quantity."""
+        level = self._level(collection_name, price)
+        level[1] = max(level[1] - number, 0)
+        self.mutations += 1
+
+    def settle(self, collection_name, price, number):
+        """Removes `number` reserved TRS at `price` once their trade has executed."""
+        level = self._level(collection_name, price)
+        level[0] -= number
+        level[1] = max(level[1] - number, 0)
+        self._drop_if_empty(collection_name, price)
+        self.mutations += 1
+
+    def available(self, collection_name, price):
+        """Returns the number of TRS at `price` that can still be bought."""
+        level = self.levels.get(collection_name, {}).get(price_key(price))
+        if level is None:
+            return 0
+        return max(level[0] - level[1], 0)
+
+    def fill(self, collection_name, number, max_price=None):
+        """
+        Plans a market order: walks the price levels of a collection from the cheapest upward, up to
+        `max_price` if given, taking available TRS until `number` are covered.
+
+        Returns:
+        list: (price, number) tuples, cheapest first; they cover fewer than `number` TRS if the book is too thin.
+
+        Raises:
+        ValueError: If `number` is not positive.
+        """
+        if number <= 0:
+            raise ValueError(f"Cannot fill an order for {number} TRS. ")
+        fills = []
+        remaining = number
+        levels = self.levels.get(collection_name, {})
+        for price in self.prices.get(collection_name, []):
+            if remaining <= 0 or (max_price is not None and price > price_key(max_price)):
+                break
+            take = min(max(levels[price][0] - levels[price][1], 0), remaining)
+            if take > 0:
+                fills.append((price, take))
+                remaining -= take
+        return fills
+
+    def get_collection(self, collection_name):
+        """
+        Returns the price levels of one collection, cheapest first, in the shape of
+        DatabaseManager.get_marketplace_collection.
+        """
+        levels = self.levels.get(collection_name, {})
+        return [
+            {'collection_name': collection_name, 'bid_price': price, 'number_of_trs': self.available(collection_name, price)}
+            for price in self.prices.get(collection_name, [])
+            if levels[price][0] - levels[price][1] > 0
+        ]
+
+    async def get_all(self, limit=None, after=None):
+        """
+        Returns price levels with their collection data, in the shape of DatabaseManager.get_marketplace_all,
+        ordered by (collection_name, bid_price). Collection data is cached; only collections not seen before
+        are fetched from the database.
+
+        Parameters:
+        limit (int, optional): The maximum number of levels to return.
+        after (list, optional): The (collection_name, bid_price) of the last level of the previous page.
+        """
+        results = []
+        start = bisect.bisect_left(self.collections, after[0]) if after else 0
+        for index in range(start, len(self.collections)):
+            collection_name = self.collections[index]
+            levels = self.levels[collection_name]
+            prices = self.prices[collection_name]
+            first = 0
+            if after and collection_name == after[0]:
+                first = bisect.bisect_right(prices, price_key(after[1]))
+            for price in prices[first:]:
+                if levels[price][0] - levels[price][1] <= 0:
+                    continue
+                results.append({'collection_name': collection_name, 'bid_price': price, 'number_of_trs': self.available(collection_name, price)})
+                if limit is not None and len(results) >= limit:
+                    break
+            if limit is not None and len(results) >= limit:
+                break
+        missing = list(dict.fromkeys(level['collection_name'] for level in results if level['collection_name'] not in self.collection_data))
+        if missing and self.database is not None:
+            self.collection_data.update(await self.database.get_collection_data_batch(missing))
+        for level in results:
+            level['collection_data'] = self.collection_data.get(level['collection_name'], [])
+        return results
+
+    async def load(self, database):
+        """
+        Builds the book from the database, replacing the current contents.
+
+        Parameters:
+        database (DatabaseManager): The database client to read the marketplace from.
+        """
+        self.database = database
+        mutations = self.mutations
+        rows = await database.get_marketplace_levels()
+        if self.loaded and mutations != self.mutations:
+            logger.info("Order book changed while reconciling, retrying. ")
+            return False
+        levels = {}
+        prices = {}
+        for row in rows:
+            price = price_key(row['bid_price'])
+            levels.setdefault(row['collection_name'], {})[price] = [int(row['listed']), int(row['reserved'] or 0)]
+        for collection_name, collection_levels in levels.items():
+            prices[collection_name] = sorted(collection_levels)
+        if self.loaded and levels != self.levels:
+            logger.warning("Order book drifted from the database, reloaded. ")
+        self.levels = levels
+        self.prices = prices
+        self.collections = sorted(levels)
+        if levels:
+            self.collection_data = await database.get_collection_data_batch(list(levels))
+        self.loaded = True
+        logger.info(f"Order book loaded with {sum(len(v) for v in levels.values())} price levels. ")
+        return True
+
+    async def reconcile_once(self, attempts=RECONCILE_ATTEMPTS):
+        """
+        Reloads the book, retrying while marketplace writes land during the snapshot.
+
+        Returns:
+        bool: True if the book was reloaded.
+        """
+        for attempt in range(attempts):
+            if await self.load(self.database):
+                return True
+            await asyncio.sleep(random.random())
+        logger.warning(f"Order book could not be reconciled in {attempts} attempts. ")
+        return False
+
+    async def reconcile(self, interval=RECONCILE_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reconcile_once()
+            except Exception as e:
+                logger.error(f"Error reconciling order book: {e}")
+
+    def start(self, database, interval=RECONCILE_INTERVAL):
+        """Starts the periodic reconcile against the database."""
+        self.database = database
+        if self._reconcile_task is None:
+            self._reconcile_task = asyncio.create_task(self.reconcile(interval))
+
+    async def stop(self):
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+            try:
+                await self._reconcile_task
+            except asyncio.CancelledError:
+                pass
+            self._reconcile_task = None
+
+
+order_book = OrderBook()
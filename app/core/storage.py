@@ -11,6 +11,11 @@ import os
 from dotenv import load_dotenv
 from app.utils.logging_config import logging_config  # Import the configuration file
 import logging.config
+from app.core.objectstore import S3ObjectStore, STORAGE_MAX_POOL_CONNECTIONS
+from app.core.database import database_client
+from app.utils.metrics import metrics
+import asyncio
+import hashlib
 logging.config.dictConfig(logging_config)
 logger = logging.getLogger("storage")
 
@@ -21,6 +26,7 @@ FILEBASE_ACCESS_KEY = os.getenv("FILEBASE_ACCESS_KEY")
 FILEBASE_SECRET_KEY = os.getenv("FILEBASE_SECRET")
 ENDPOINT_URL = os.getenv("FILEBASE_ENDPOINT")
 BUCKET_NAME = os.getenv("FILEBASE_BUCKET")
+IPFS_GATEWAY_URL = 'https://ipfs.filebase.io/ipfs/'
 
 # Initialize boto3 S3 resource with Filebase credentials
 s3 = boto3.resource(
@@ -35,8 +41,10 @@ s3_client = boto3.client(
     aws_access_key_id=FILEBASE_ACCESS_KEY,
     aws_secret_access_key=FILEBASE_SECRET_KEY,
     endpoint_url=ENDPOINT_URL,
-    config=Config(signature_version='s3v4')
+    config=Config(signature_version='s3v4', max_pool_connections=STORAGE_MAX_POOL_CONNECTIONS)
 )
+# Non-blocking access to the bucket for the app; boto3 calls run off the event loop.
+filebase_store = S3ObjectStore(s3_client, BUCKET_NAME, name="filebase")
 
 def upload_file(file_path, object_name=None):
     """Upload a file to Filebase S3 bucket."""
@@ -49,10 +57,51 @@ def upload_file(file_path, object_name=None):
     except Exception as e:
         print(f"Error uploading file: {e}")
 
+# Bytes read at a time when hashing an upload.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_fileobj(fileobj):
+    """Returns the SHA-256 hex digest and size of a file object, leaving it at the start."""
+    digest = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+async def upload_deduplicated(file: UploadFile, object_name: str):
+    """
+    Stores a file at `object_name` unless its content is already in the bucket.
+
+    The file is hashed (off the event loop) and looked up in the storage_objects digest index. Content
+    already stored at `object_name` is not sent again, content stored under another key is copied inside
+    the bucket, and only new content is uploaded. Hits, misses and bytes not sent are counted in the metrics.
+    """
+    sha256, size = await asyncio.get_running_loop().run_in_executor(None, hash_fileobj, file.file)
+    existing = await database_client.get_object_by_digest(sha256)
+    if existing is not None:
+        try:
+            if existing['object_key'] != object_name:
+                await filebase_store.copy_object(existing['object_key'], object_name)
+                await database_client.store_object_cids([(object_name, existing['cid'], size, sha256)])
+            metrics.increment('upload_dedupe_hits')
+            metrics.increment('upload_dedupe_bytes_saved', size)
+            logger.info(f"Content of '{object_name}' is already stored as '{existing['object_key']}', not uploading it again.")
+            return
+        except Exception as e:
+            # The indexed object may have been deleted; upload the content instead.
+            logger.warning(f"Could not reuse '{existing['object_key']}' for '{object_name}': {e}")
+    metrics.increment('upload_dedupe_misses')
+    await filebase_store.upload_fileobj(file.file, object_name)
+    metrics.increment('upload_bytes_sent', size)
+    await capture_cid(object_name, sha256)
+
 async def upload_to_s3(file: UploadFile, object_name: str):
     try:
         # Upload the file object to S3 bucket
-        s3.Bucket(BUCKET_NAME).upload_fileobj(file.file, object_name)
+        await upload_deduplicated(file, object_name)
         # Generate the file URL after uploading
         file_url = f"{ENDPOINT_URL}/{BUCKET_NAME}/{object_name}"
 
@@ -61,6 +110,27 @@ async def upload_to_s3(file: UploadFile, object_name: str):
         logger.error(f"Error uploading file: {e}")
         raise HTTPException(status_code=500, detail=f"Error uploading file: {e}")
 
+# Files of one request uploaded at the same time; filebase_store caps uploads across requests.
+UPLOAD_REQUEST_CONCURRENCY = int(os.getenv("UPLOAD_REQUEST_CONCURRENCY", 4))
+
+async def upload_many_to_s3(uploads, concurrency=UPLOAD_REQUEST_CONCURRENCY):
+    """
+    Uploads several files concurrently, at most `concurrency` at a time.
+
+    Parameters:
+    uploads (list): (UploadFile, object_name) tuples.
+
+    Returns:
+    list: The file URLs, in the order of `uploads`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(file, object_name):
+        async with semaphore:
+            return await upload_to_s3(file, object_name)
+
+    return await asyncio.gather(*(upload(file, object_name) for file, object_name in uploads))
+
 def download_file(object_name, download_path):
     """Download a file from Filebase S3 bucket."""
     try:
@@ -88,10 +158,10 @@ async def test():
 #asyncio.run(test())
 
 
-def get_file_cid( object_name):
+async def get_file_cid( object_name):
     try:
         # Retrieve object metadata
-        response = s3_client.head_object(Bucket=BUCKET_NAME, Key=object_name)
+        response = await filebase_store.head_object(object_name)
         
         # Extract the CID from metadata
         metadata = response.get('Metadata', {})
@@ -107,3 +177,46 @@ def get_file_cid( object_name):
     except Exception as e:
         print(f"Error retrieving CID: {e}")
         return None
+
+
+async def cache_cid(object_name, head, sha256=None):
+    """
+    Records the CID Filebase assigned to an object, from the object's HEAD response, with the
+    SHA-256 of its content if known.
+
+    Returns:
+    str: The CID, or None if the object has none yet.
+    """
+    cid = head.get('Metadata', {}).get('cid')
+    if cid:
+        await database_client.store_object_cids([(object_name, cid, head.get('ContentLength'), sha256)])
+    return cid
+
+async def capture_cid(object_name, sha256=None):
+    """
+    Fetches and records the CID of an object that was just uploaded. Failures are only logged;
+    resolve_cid fetches the CID again when it is needed.
+    """
+    try:
+        return await cache_cid(object_name, await filebase_store.head_object(object_name), sha256)
+    except Exception as e:
+        logger.warning(f"Could not record the CID of '{object_name}': {e}")
+        return None
+
+async def resolve_cid(object_name):
+    """Returns the CID of an object from the storage_objects cache, asking Filebase only on a miss."""
+    cids = await database_client.get_object_cids([object_name])
+    if object_name in cids:
+        metrics.increment('cid_cache_hits')
+        return cids[object_name]
+    metrics.increment('cid_cache_misses')
+    return await capture_cid(object_name)
+
+async def get_image_uri(url_header):
+    """Returns the IPFS gateway URI of the thumbnail of a TRS creation request."""
+    cid = await resolve_cid(f'{url_header}thumbnail.png')
+    if cid:
+        logger.info(f"CID for '{url_header}thumbnail.png' is: {cid}")
+    else:
+        logger.info(f"No CID found for '{url_header}thumbnail.png'.")
+    return IPFS_GATEWAY_URL + str(cid)
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import time
+
+from app.core import storage
+from app.utils.metrics import metrics
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("transactions")
+
+# Pending trades older than this are cancelled. PayPal approval links stay valid for three hours,
+# so a shorter TTL could cancel a trade whose buyer is still able to pay.
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", 3 * 60 * 60))
+SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", 60))
+SWEEP_BATCH_SIZE = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", 100))
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", 600))
+# Trades claimed for execution longer ago than this are reconciled with PayPal. It must exceed the
+# longest a request takes from claiming a trade to settling it, PayPal retries included.
+TRADE_CLAIM_LEASE = float(os.getenv("TRADE_CLAIM_LEASE", 15 * 60))
+
+
+class ReservationSweeper:
+    """
+    Cancels trades that were reserved but never paid, returning their TRS to the marketplace.
+
+    Every SWEEP_INTERVAL seconds the oldest pending trades past RESERVATION_TTL are read in batches of
+    SWEEP_BATCH_SIZE and cancelled one transaction per trade with DatabaseManager.cancel_trade, until
+    none are left. Trades claimed for execution past TRADE_CLAIM_LEASE are then taken over one at a time
+    and handed to `reconcile` (app/api/transactions.py), which settles, refunds or releases them.
+    """
+    def __init__(self):
+        self.database = None
+        self.reconcile = None
+        self._task = None
+
+    async def sweep(self, ttl=RESERVATION_TTL, batch_size=SWEEP_BATCH_SIZE):
+        """
+        Runs one sweep.
+
+        Returns:
+        int: The number of trades cancelled.
+        """
+        started = time.monotonic()
+        cancelled = 0
+        released = 0
+        while True:
+            trade_ids = await self.database.get_expired_trades(ttl, batch_size)
+            batch_cancelled = 0
+            for trade_id in trade_ids:
+                try:
+                    transactions = await self.database.cancel_trade(trade_id)
+                except Exception as e:
+                    metrics.increment('reservations_sweep_errors')
+                    logger.error(f"Error expiring trade {trade_id}: {e}")
+                    continue
+                if transactions:
+                    batch_cancelled += 1
+                    released += sum(int(transaction['number']) for transaction in transactions)
+            cancelled += batch_cancelled
+            # Stop on a short batch, or when nothing in a full batch could be cancelled (left for the next run).
+            if len(trade_ids) < batch_size or not batch_cancelled:
+                break
+        seconds = time.monotonic() - started
+        metrics.increment('reservations_expired', cancelled)
+        metrics.increment('reservations_released_trs', released)
+        metrics.observe('reservations_sweep_seconds', seconds)
+        if cancelled:
+            logger.info(f"Expired {cancelled} pending trades and released {released} TRS in {seconds:.2f}s. ")
+        return cancelled
+
+    async def reconcile_claims(self, lease=TRADE_CLAIM_LEASE, batch_size=SWEEP_BATCH_SIZE):
+        """
+        Reconciles the trades whose execution claim is older than `lease`.
+
+        Returns:
+        dict: The number of trades per outcome of `reconcile`.
+        """
+        outcomes = {}
+        while True:
+            trade_ids = await self.database.get_expired_claims(lease, batch_size)
+            taken = 0
+            for trade_id in trade_ids:
+                try:
+                    # Renewing the claim keeps other sweepers off the trade while it is reconciled.
+                    if not await self.database.take_over_trade_claim(trade_id, lease):
+                        continue
+                    taken += 1
+                    outcome = await self.reconcile(trade_id)
+                except Exception as e:
+                    metrics.increment('trade_claims_reconcile_errors')
+                    logger.error(f"Error reconciling claimed trade {trade_id}: {e}")
+                    continue
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                metrics.increment(f'trade_claims_{outcome}')
+            if len(trade_ids) < batch_size or not taken:
+                break
+        if outcomes:
+            logger.warning(f"Reconciled trades past their claim's lease: {outcomes}. ")
+        return outcomes
+
+    async def run(self, interval=SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping expired reservations: {e}")
+            if self.reconcile is not None:
+                try:
+                    await self.reconcile_claims()
+                except Exception as e:
+                    logger.error(f"Error reconciling expired trade claims: {e}")
+
+    def start(self, database, reconcile=None, interval=SWEEP_INTERVAL):
+        """Starts the periodic sweep. `reconcile` settles, refunds or releases a trade past its claim's lease."""
+        self.database = database
+        self.reconcile = reconcile
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class UploadSweeper:
+    """
+    Aborts direct TRS uploads that were issued but not finalized in time (see app/api/trs.py).
+
+    Every UPLOAD_SWEEP_INTERVAL seconds the expired uploads are read in batches of SWEEP_BATCH_SIZE;
+    multipart uploads are aborted in the bucket, so their parts stop taking up storage, and every
+    expired upload is marked aborted.
+    """
+    def __init__(self):
+        self.database = None
+        self._task = None
+
+    async def sweep(self, batch_size=SWEEP_BATCH_SIZE):
+        """
+        Runs one sweep.
+
+        Returns:
+        int: The number of uploads aborted.
+        """
+        aborted = 0
+        while True:
+            uploads = await self.database.get_expired_trs_uploads(batch_size)
+            ids = []
+            for upload in uploads:
+                if upload['upload_id']:
+                    try:
+                        await storage.filebase_store.abort_multipart_upload(upload['object_key'], upload['upload_id'])
+                    except Exception as e:
+                        metrics.increment('upload_sweep_errors')
+                        logger.error(f"Error aborting upload of {upload['object_key']}: {e}")
+                        continue
+                ids.append(upload['id'])
+            await self.database.abort_trs_uploads(ids)
+            aborted += len(ids)
+            if len(uploads) < batch_size or not ids:
+                break
+        metrics.increment('uploads_expired', aborted)
+        if aborted:
+            logger.info(f"Aborted {aborted} expired TRS uploads. ")
+        return aborted
+
+    async def run(self, interval=UPLOAD_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping expired uploads: {e}")
+
+    def start(self, database, interval=UPLOAD_SWEEP_INTERVAL):
+        """Starts the periodic sweep."""
+        self.database = database
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reservation_sweeper = ReservationSweeper()
+upload_sweeper = UploadSweeper()
@@ -0,0 +1,201 @@
+import asyncio
+import os
+
+from app.fintech import paypal
+from app.utils.metrics import metrics
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("paypal")
+
+PAYOUT_CONCURRENCY = int(os.getenv("PAYOUT_CONCURRENCY", 4))
+PAYOUT_POLL_INTERVAL = float(os.getenv("PAYOUT_POLL_INTERVAL", 5))
+PAYOUT_LEASE_SECONDS = int(os.getenv("PAYOUT_LEASE_SECONDS", 300))
+PAYOUT_MAX_ATTEMPTS = int(os.getenv("PAYOUT_MAX_ATTEMPTS", 8))
+PAYOUT_RETRY_BASE_SECONDS = float(os.getenv("PAYOUT_RETRY_BASE_SECONDS", 10))
+PAYOUT_RETRY_MAX_SECONDS = float(os.getenv("PAYOUT_RETRY_MAX_SECONDS", 3600))
+# Payouts per PayPal payout batch, and how long to wait for more payouts after a trade settles.
+PAYOUT_BATCH_SIZE = int(os.getenv("PAYOUT_BATCH_SIZE", 500))
+PAYOUT_BATCH_WINDOW = float(os.getenv("PAYOUT_BATCH_WINDOW", 2))
+# How often the item statuses of a sent batch are fetched until they are final.
+PAYOUT_ITEM_RECHECK_SECONDS = int(os.getenv("PAYOUT_ITEM_RECHECK_SECONDS", 300))
+
+
+# Statuses of a batch PayPal may have failed to take in for a transient reason; sent again unchanged.
+RETRYABLE_STATUSES = {408, 429}
+# Statuses of a batch PayPal refused for its content; one invalid item fails the whole batch.
+VALIDATION_STATUSES = {400, 422}
+
+
+class PayoutError(Exception):
+    def __init__(self, message, rejected=False, retry_after=None, already_sent=False):
+        super().__init__(message)
+        self.rejected = rejected          # PayPal refused the content of the batch
+        self.retry_after = retry_after    # seconds PayPal asked us to wait (Retry-After)
+        self.already_sent = already_sent  # the sender_batch_id was used by a batch whose response we lost
+
+
+def is_duplicate(response):
+    """True if PayPal rejected the payout because its sender_batch_id was already used, i.e. it was sent before."""
+    text = str(response.get('message', '')) + str(response.get('details', ''))
+    return response.get('name') == 'USER_BUSINESS_ERROR' and 'sender_batch_id' in text.lower()
+
+
+class PayoutWorker:
+    """
+    Sends the payout intents queued in payout_outbox as multi-item PayPal payout batches.
+
+    Due payouts are claimed (DatabaseManager.claim_payouts) and grouped into batches of up to
+    PAYOUT_BATCH_SIZE items, with at most PAYOUT_CONCURRENCY batch requests in flight. After a trade
+    settles the worker waits PAYOUT_BATCH_WINDOW seconds, so payouts of trades settling close together
+    share a batch. Every item carries the idempotency key of its intent as sender_item_id; the batch
+    keeps its sender_batch_id (and PayPal-Request-Id) across retries of an unknown outcome, so a resent
+    batch is answered with the first response instead of being paid twice. Timeouts, 408, 429 and 5xx
+    are retried with exponential backoff, waiting at least as long as PayPal's Retry-After. A batch PayPal
+    rejects as invalid (400, 422) is split in halves that are sent right away, down to single payouts, so
+    one bad item does not hold back the rest. Failures are retried up to PAYOUT_MAX_ATTEMPTS, then left as
+    `failed`. A batch PayPal reports as already sent after the request id expired is failed for manual
+    reconciliation, since PayPal offers no documented lookup by sender_batch_id. The payout_batch_id is
+    stored as soon as PayPal returns it, and the status of every item is then fetched from PayPal and
+    stored on its intent.
+    """
+    def __init__(self):
+        self.database = None
+        self.semaphore = None
+        self._wakeup = None
+        self._task = None
+
+    def notify(self):
+        """Wakes the worker after new payouts were committed, instead of waiting for the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def send_batch(self, sender_batch_id, payouts):
+        """
+        Sends payouts as one PayPal payout batch and returns its payout_batch_id.
+
+        Raises:
+        PayoutError: If PayPal did not accept the batch.
+        """
+        status, response, retry_after = await paypal.payout_batch(sender_batch_id, [
+            {
+                "recipient_email": payout['recipient_email'],
+                "amount": str(payout['amount']),
+                "currency": payout['currency'],
+                "note": payout['note'],
+                "sender_item_id": payout['idempotency_key']
+            }
+            for payout in payouts
+        ])
+        metrics.increment('paypal_payout_requests')
+        if response.get('batch_header'):
+            return response['batch_header']['payout_batch_id']
+        if is_duplicate(response):
+            raise PayoutError(f"Payout batch {sender_batch_id} was already sent, but PayPal did not return it. ", already_sent=True)
+        message = response.get('message') or str(response)
+        if status in RETRYABLE_STATUSES or status >= 500:
+            raise PayoutError(message, retry_after=retry_after)
+        raise PayoutError(message, rejected=status in VALIDATION_STATUSES)
+
+    async def process_batch(self, sender_batch_id, payouts):
+        ids = [payout['id'] for payout in payouts]
+        attempts = max(payout['attempts'] for payout in payouts)
+        try:
+            async with self.semaphore:
+                payout_batch_id = await self.send_batch(sender_batch_id, payouts)
+        except Exception as e:
+            rejected = isinstance(e, PayoutError) and e.rejected
+            if isinstance(e, PayoutError) and e.already_sent:
+                # Sending it again could pay twice; the batch has to be matched up in PayPal by hand.
+                metrics.increment('payout_batches_unreconciled')
+                logger.critical(f"Payout batch {sender_batch_id} ({len(ids)} payouts) needs manual reconciliation: {e}")
+                await self.database.retry_payouts(ids, e)
+            elif rejected and len(payouts) > 1:
+                # PayPal rejects the whole batch for one bad item. Bisect it, so the valid payouts
+                # still go out and the bad one ends up alone and is retried or failed on its own.
+                half = len(payouts) // 2
+                halves = [payouts[:half], payouts[half:]]
+                metrics.increment('payout_batches_split')
+                logger.warning(f"Payout batch {sender_batch_id} ({len(ids)} payouts) was rejected, splitting it: {e}")
+                sender_batch_ids = await self.database.rebatch_payouts([[payout['id'] for payout in batch] for batch in halves])
+                await asyncio.gather(*(self.process_batch(batch_id, batch) for batch_id, batch in zip(sender_batch_ids, halves)))
+            elif attempts >= PAYOUT_MAX_ATTEMPTS:
+                metrics.increment('payouts_failed', len(ids))
+                logger.error(f"Payout batch {sender_batch_id} ({len(ids)} payouts) failed after {attempts} attempts: {e}")
+                await self.database.retry_payouts(ids, e, keep_batch=not rejected)
+            else:
+                delay = PAYOUT_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                if isinstance(e, PayoutError) and e.retry_after:
+                    delay = max(delay, e.retry_after)
+                delay = min(delay, PAYOUT_RETRY_MAX_SECONDS)
+                metrics.increment('payouts_retried', len(ids))
+                logger.warning(f"Payout batch {sender_batch_id} ({len(ids)} payouts) failed, retrying in {delay:.0f}s: {e}")
+                await self.database.retry_payouts(ids, e, delay, keep_batch=not rejected)
+            return
+        await self.database.complete_payouts(ids, payout_batch_id)
+        metrics.increment('payouts_sent', len(ids))
+        metrics.increment('payout_batches_sent')
+        logger.info(f"Payout batch {sender_batch_id} with {len(ids)} payouts sent as {payout_batch_id}. ")
+
+    async def run_once(self):
+        """
+        Claims and sends one round of due payouts.
+
+        Returns:
+        int: The number of payouts claimed.
+        """
+        payouts = await self.database.claim_payouts(PAYOUT_BATCH_SIZE * PAYOUT_CONCURRENCY, PAYOUT_LEASE_SECONDS, PAYOUT_BATCH_SIZE)
+        batches = {}
+        for payout in payouts:
+            batches.setdefault(payout['sender_batch_id'], []).append(payout)
+        await asyncio.gather(*(self.process_batch(sender_batch_id, batch) for sender_batch_id, batch in batches.items()))
+        return len(payouts)
+
+    async def sync_items(self):
+        """Fetches the item statuses of sent batches that are not final yet and stores them on the intents."""
+        for payout_batch_id in await self.database.get_unsettled_payout_batches(PAYOUT_ITEM_RECHECK_SECONDS, PAYOUT_CONCURRENCY * 4):
+            details = await paypal.get_payout_batch(payout_batch_id)
+            metrics.increment('paypal_payout_requests')
+            items = []
+            for item in details.get('items', []):
+                error = item.get('errors', {}).get('message') if item.get('errors') else None
+                items.append((item['payout_item']['sender_item_id'], item['payout_item_id'], item['transaction_status'], error))
+            await self.database.record_payout_items(items)
+
+    async def run(self, interval=PAYOUT_POLL_INTERVAL):
+        while True:
+            try:
+                claimed = await self.run_once()
+                await self.sync_items()
+            except Exception as e:
+                logger.error(f"Error sending payouts: {e}")
+                claimed = 0
+            if claimed:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+                await asyncio.sleep(PAYOUT_BATCH_WINDOW)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, database, interval=PAYOUT_POLL_INTERVAL):
+        """Starts sending queued payouts in the background."""
+        self.database = database
+        self.semaphore = asyncio.Semaphore(PAYOUT_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+payout_worker = PayoutWorker()
@@ -1,16 +1,13 @@
 import aiohttp
 import asyncio
 import json
-from aiohttp import web
-import urllib3
 import os
 import time
-import requests
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 load_dotenv()
-from requests.auth import HTTPBasicAuth
-import base64
-import logging
+
+from app.utils.metrics import metrics
 
 # Initialize logging
 import logging.config
@@ -19,82 +16,213 @@ logging.config.dictConfig(logging_config)
 logger = logging.getLogger("paypal")
 
 
-PAYPAL_API_URL = 'https://api-m.sandbox.paypal.com/v1/payments/payment'
+# Point at a local stand-in (app/fintech/paypal_standin.py) to run without the PayPal sandbox.
+PAYPAL_BASE_URL = os.getenv('PAYPAL_BASE_URL', 'https://api-m.sandbox.paypal.com').rstrip('/')
+PAYPAL_API_URL = f'{PAYPAL_BASE_URL}/v1/payments/payment'
+PAYPAL_TOKEN_URL = f'{PAYPAL_BASE_URL}/v1/oauth2/token'
+PAYPAL_PAYOUT_URL = f'{PAYPAL_BASE_URL}/v1/payments/payouts'
+PAYPAL_SALE_URL = f'{PAYPAL_BASE_URL}/v1/payments/sale'
 PAYPAL_CLIENT_ID = os.getenv('PAYPAL_CLIENT_ID')
 PAYPAL_CLIENT_SECRET = os.getenv('PAYPAL_CLIENT_SECRET')
+# Seconds for a whole PayPal request, and for opening a connection.
+PAYPAL_TIMEOUT = float(os.getenv('PAYPAL_TIMEOUT', 30))
+PAYPAL_CONNECT_TIMEOUT = float(os.getenv('PAYPAL_CONNECT_TIMEOUT', 5))
+# Maximum number of open connections to PayPal.
+PAYPAL_POOL_SIZE = int(os.getenv('PAYPAL_POOL_SIZE', 20))
+# An access token is refreshed this many seconds before PayPal expires it.
+PAYPAL_TOKEN_REFRESH_MARGIN = 60
+
 
+class PayPalError(Exception):
+    pass
 
-def get_access_token():
-    url = "https://api-m.sandbox.paypal.com/v1/oauth2/token"
 
-    headers = {
-    "Accept": "application/json",
-    "Accept-Language": "en_US"
-    }
-    payload = {
-    "grant_type": "client_credentials"
-    }
-    response = requests.post(url, headers=headers, data=payload, auth=HTTPBasicAuth(PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET))
+def retry_after_seconds(value):
+    """Parses a Retry-After header, given in seconds or as an HTTP date. Returns None if it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
 
-    if response.status_code == 200:
-        access_token = response.json().get('access_token')
-        
-        return access_token
 
 class PayPal:
+    """
+    PayPal REST client.
+
+    All requests share one aiohttp session, so connections are kept alive and reused. The OAuth access
+    token is cached until shortly before it expires; concurrent callers that find it expired wait for a
+    single refresh. The app starts the client at startup and closes it at shutdown; outside the app the
+    session is created on first use.
+    """
     def __init__(self):
         self.client_id = PAYPAL_CLIENT_ID
         self.client_secret = PAYPAL_CLIENT_SECRET
-        self.payout_url = 'https://api.sandbox.paypal.com/v1/payments/payouts'
-        
-    async def create_payment(self,amount,return_url,cancel_url,description):
-        async with aiohttp.ClientSession() as session:
-            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+        self.payout_url = PAYPAL_PAYOUT_URL
+        self.session = None
+        self._access_token = None
+        self._token_expires_at = 0
+        self._token_lock = None
+
+    async def start(self):
+        """Opens the shared session, if it is not open yet, and returns it."""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=PAYPAL_POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(total=PAYPAL_TIMEOUT, connect=PAYPAL_CONNECT_TIMEOUT)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def _token_valid(self):
+        return self._access_token is not None and time.monotonic() < self._token_expires_at
+
+    async def get_access_token(self):
+        """
+        Returns a valid OAuth access token, requesting a new one only if the cached one has expired.
+
+        Raises:
+        PayPalError: If PayPal does not issue a token.
+        """
+        if self._token_valid():
+            return self._access_token
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            # Another caller may have refreshed the token while this one waited for the lock.
+            if self._token_valid():
+                return self._access_token
+            session = await self.start()
             headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
+                "Accept": "application/json",
+                "Accept-Language": "en_US"
             }
-            data = {
-                "intent": "sale",
-                "redirect_urls": {
-                    "return_url": return_url,
-                    "cancel_url": cancel_url
-                },
-                "payer": {
-                    "payment_method": "paypal"
-                },
-                "transactions": [{
-                    "amount": {
-                        "total": amount,
-                        "currency": "USD"
-                    },
-                    "description": description
-                }]
+            payload = {
+                "grant_type": "client_credentials"
             }
-            async with session.post(PAYPAL_API_URL, auth=auth, headers=headers, json=data) as response:
-                response_data = await response.json()
-            
-                logger.info(f"Created payment with id {response_data['id']},description : {response_data['transactions'][0]['description']}")
-                return response_data
+            started = time.perf_counter()
+            async with session.post(PAYPAL_TOKEN_URL, headers=headers, data=payload, auth=aiohttp.BasicAuth(self.client_id, self.client_secret)) as response:
+                response_data = await response.json(content_type=None)
+                response_headers = response.headers
+            metrics.observe('paypal_token_seconds', time.perf_counter() - started)
+            if response.status != 200 or 'access_token' not in response_data:
+                raise PayPalError(f"Could not get a PayPal access token: {response_data}")
+            self._access_token = response_data['access_token']
+            self._token_expires_at = time.monotonic() + int(response_data.get('expires_in', 0)) - PAYPAL_TOKEN_REFRESH_MARGIN
+            metrics.increment('paypal_token_refreshes')
+            logger.info("Refreshed PayPal access token. ")
+            return self._access_token
+
+    async def request(self, method, url, **kwargs):
+        """
+        Sends an authorised request on the shared session.
+
+        A 401 means the cached token was revoked early; it is dropped and the request is sent once more.
+
+        Returns:
+        tuple: (HTTP status, response JSON).
+        """
+        status, response_data, headers = await self.request_with_headers(method, url, **kwargs)
+        return status, response_data
+
+    async def request_with_headers(self, method, url, **kwargs):
+        """Like request, and also returns the response headers: (HTTP status, response JSON, headers)."""
+        session = await self.start()
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            **kwargs.pop('headers', {})
+        }
+        for attempt in range(2):
+            access_token = await self.get_access_token()
+            started = time.perf_counter()
+            async with session.request(method, url, headers={**headers, "Authorization": f"Bearer {access_token}"}, **kwargs) as response:
+                response_data = await response.json(content_type=None)
+            metrics.observe('paypal_request_seconds', time.perf_counter() - started)
+            if response.status == 401 and attempt == 0:
+                if self._access_token == access_token:
+                    self._access_token = None
+                continue
+            return response.status, response_data, response_headers
+
+    async def create_payment(self,amount,return_url,cancel_url,description):
+        data = {
+            "intent": "sale",
+            "redirect_urls": {
+                "return_url": return_url,
+                "cancel_url": cancel_url
+            },
+            "payer": {
+                "payment_method": "paypal"
+            },
+            "transactions": [{
+                "amount": {
+                    "total": amount,
+                    "currency": "USD"
+                },
+                "description": description
+            }]
+        }
+        status, response_data = await self.request('POST', PAYPAL_API_URL, json=data)
+        logger.info(f"Created payment with id {response_data['id']},description : {response_data['transactions'][0]['description']}")
+        return response_data
 
     async def execute_payment(self, payment_id, payer_id):
         execute_url = f'{PAYPAL_API_URL}/{payment_id}/execute'
-        async with aiohttp.ClientSession() as session:
-            auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
-            headers = {
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            }
-            data = {
-                "payer_id": payer_id
-            }
-            async with session.post(execute_url, auth=auth, headers=headers, json=data) as response:
-                response_data = await response.json()
-                #print(response_data)
-                return response_data
+        data = {
+            "payer_id": payer_id
+        }
+        # PayPal-Request-Id makes a retried execute return the first result instead of failing.
+        status, response_data = await self.request('POST', execute_url, json=data, headers={"PayPal-Request-Id": f"execute-{payment_id}"})
+        return response_data
+
+    async def get_payment(self, payment_id):
+        """Returns the status and details of a payment, including the state of its sale once it is executed."""
+        status, response_data = await self.request('GET', f'{PAYPAL_API_URL}/{payment_id}')
+        return status, response_data
 
-    
-    async def send_payout(self,access_token, sender_batch_id, recipient_email, amount, currency="USD", note="Payout"):
+    async def refund_sale(self, sale_id):
+        """
+        Refunds the full amount of a sale.
+
+        Returns:
+        tuple: (HTTP status, response JSON).
+        """
+        # PayPal-Request-Id makes a retried refund return the first refund instead of refunding twice.
+        status, response_data = await self.request('POST', f'{PAYPAL_SALE_URL}/{sale_id}/refund', json={}, headers={"PayPal-Request-Id": f"refund-{sale_id}"})
+        logger.info(f"Refund of sale {sale_id} returned status {status}")
+        return status, response_data
+
+    async def send_payout(self, sender_batch_id, recipient_email, amount, currency="USD", note="Payout"):
+        status, response_data, retry_after = await self.send_payout_batch(sender_batch_id, [
+            {"recipient_email": recipient_email, "amount": amount, "currency": currency, "note": note, "sender_item_id": sender_batch_id}
+        ])
+        if status == 201:  # 201 Created
+            logger.info("Payout successfully sent!")
+        else:
+            logger.error(f"Failed to send payout: {response_data}")
+        return response_data
+
+    async def send_payout_batch(self, sender_batch_id, items):
+        """
+        Sends several payouts as one PayPal payout batch.
+
+        Parameters:
+        sender_batch_id (str): Our id of the batch; PayPal rejects a second batch with the same id.
+        items (list): dicts with recipient_email, amount, currency, note and sender_item_id.
+
+        Returns:
+        tuple: (HTTP status, response JSON, seconds of the Retry-After header or None).
+        """
         payout_data = {
             "sender_batch_header": {
                 "sender_batch_id": sender_batch_id,
@@ -105,49 +233,80 @@ class PayPal:
                 {
                     "recipient_type": "EMAIL",
                     "amount": {
-                        "value": amount,
-                        "currency": currency
+                        "value": item['amount'],
+                        "currency": item.get('currency', "USD")
                     },
-                    "note": note,
-                    "sender_item_id": sender_batch_id,
-                    "receiver": recipient_email
+                    "note": item.get('note') or "Payout",
+                    "sender_item_id": item['sender_item_id'],
+                    "receiver": item['recipient_email']
                 }
+                for item in items
             ]
         }
+        # PayPal answers a resent request with the same PayPal-Request-Id with the response of the first.
+        status, response_data, headers = await self.request_with_headers('POST', self.payout_url, data=json.dumps(payout_data), headers={"PayPal-Request-Id": sender_batch_id})
+        logger.info(f"Payout batch {sender_batch_id} with {len(items)} items sent, status {status}")
+        return status, response_data, retry_after_seconds(headers.get('Retry-After'))
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
+    async def get_payout_batch(self, payout_batch_id):
+        """Returns the details of a payout batch, including the status of every item."""
+        status, response_data = await self.request('GET', f"{self.payout_url}/{payout_batch_id}")
+        return response_data
+
+
+paypal_client = PayPal()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.payout_url, headers=headers, data=json.dumps(payout_data)) as response:
-                response_data = await response.json()
-                if response.status == 201:  # 201 Created
-                    print("Payout successfully sent!")
-                    return response_data
-                else:
-                    print(f"Failed to send payout: {response_data}")
-                    return response_data
+async def get_access_token():
+    return await paypal_client.get_access_token()
 
 async def verify_transaction(transaction):
     return
 
 async def create_payment(data):
-    paypal = PayPal()
-    resp =  await paypal.create_payment(data['amount'], data['return_url'], data['cancel_url'], data['description'])
+    resp =  await paypal_client.create_payment(data['amount'], data['return_url'], data['cancel_url'], data['description'])
     return resp
 
 async def execute_payment(payment_id, payer_id):
-    paypal  = PayPal()
-    resp = await paypal.execute_payment(payment_id, payer_id)
+    resp = await paypal_client.execute_payment(payment_id, payer_id)
     return resp 
 
+async def get_payment(payment_id):
+    """
+    Looks up a payment, as create_payment and execute_payment return it.
+
+    Raises:
+    PayPalError: If PayPal does not return the payment.
+    """
+    status, response = await paypal_client.get_payment(payment_id)
+    if status != 200:
+        raise PayPalError(f"Lookup of payment {payment_id} failed: {response}")
+    return response
+
+def payment_sale(payment):
+    """Returns the sale of an executed payment, or None if the payment has no sale."""
+    try:
+        return payment['transactions'][0]['related_resources'][0]['sale']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+async def refund_payment(payment):
+    """
+    Refunds an executed payment, given the response of execute_payment or get_payment.
+
+    Raises:
+    PayPalError: If the payment has no sale or PayPal does not complete the refund.
+    """
+    sale = payment_sale(payment)
+    if sale is None or 'id' not in sale:
+        raise PayPalError(f"Payment {payment.get('id')} has no sale to refund")
+    sale_id = sale['id']
+    status, response = await paypal_client.refund_sale(sale_id)
+    if status not in (200, 201) or response.get('state') not in ('completed', 'pending'):
+        raise PayPalError(f"Refund of sale {sale_id} failed: {response}")
+    return response
+
 async def payout(data):
-    paypal = PayPal()
-    access_token = get_access_token()
-    response = await paypal.send_payout(
-        access_token,
+    response = await paypal_client.send_payout(
         sender_batch_id=data['batch_id'],
         recipient_email=data['recipient_email'],
         amount=data['amount'],
@@ -156,3 +315,8 @@ async def payout(data):
     logger.info(f"Payout sent to {data['recipient_email']}, amount = {data['amount']} ")
     return response
 
+async def payout_batch(sender_batch_id, items):
+    return await paypal_client.send_payout_batch(sender_batch_id, items)
+
+async def get_payout_batch(payout_batch_id):
+    return await paypal_client.get_payout_batch(payout_batch_id)
@@ -0,0 +1,233 @@
+"""
+Local stand-in for the parts of the PayPal REST API the app uses, for load testing without the sandbox.
+
+Implements the OAuth token, payment create/execute/lookup, sale refund and payouts endpoints, keeping all state in memory.
+Every response can be delayed by a log-normal latency, failed with a 500 at a given rate and limited to
+a number of requests per second (429 above it), so the app can be measured under PSP-like behaviour.
+Bearer tokens are checked, payment execution and payouts honour PayPal-Request-Id, a reused
+sender_batch_id is rejected like PayPal does, and a 429 carries a Retry-After header.
+
+Point the app at it with PAYPAL_BASE_URL, e.g.:
+    python -m app.fintech.paypal_standin --port 8081 --latency-ms 120 --error-rate 0.01 --rate-limit 100
+    PAYPAL_BASE_URL=http://localhost:8081 uvicorn app.main:app
+
+GET /standin/stats returns the number of requests and injected faults per endpoint.
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+import uuid
+from aiohttp import web
+
+import logging.config
+from app.utils.logging_config import logging_config
+logging.config.dictConfig(logging_config)
+logger = logging.getLogger("paypal")
+
+
+class StandIn:
+    """
+    In-memory PayPal.
+
+    Parameters:
+    - latency_ms: Median response latency.
+    - latency_sigma: Spread of the log-normal latency; 0 gives a constant latency.
+    - error_rate: Fraction of requests answered with a 500.
+    - rate_limit: Requests per second accepted before answering 429; 0 for no limit.
+    - item_failure_rate: Fraction of payout items that end up FAILED.
+    - token_ttl: Lifetime of the issued access tokens, in seconds.
+    """
+    def __init__(self, latency_ms=100, latency_sigma=0.5, error_rate=0.0, rate_limit=0, item_failure_rate=0.0, token_ttl=32400):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.item_failure_rate = item_failure_rate
+        self.token_ttl = token_ttl
+        self.tokens = {}            # access_token -> expiry (monotonic)
+        self.payments = {}          # payment_id -> payment
+        self.executions = {}        # PayPal-Request-Id -> response of the execute call
+        self.sales = {}             # sale_id -> sale of an executed payment
+        self.refunds = {}           # sale_id -> refund
+        self.batches = {}           # payout_batch_id -> batch
+        self.sender_batches = {}    # sender_batch_id -> payout_batch_id
+        self.payout_requests = {}   # PayPal-Request-Id -> response of the payout call
+        self.stats = {}
+        self._window = int(time.monotonic())
+        self._window_requests = 0
+
+    def count(self, endpoint, outcome):
+        counts = self.stats.setdefault(endpoint, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    def latency(self):
+        if self.latency_ms <= 0:
+            return 0
+        return random.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+
+    def rate_limited(self):
+        if not self.rate_limit:
+            return False
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._window_requests = 0
+        self._window_requests += 1
+        return self._window_requests > self.rate_limit
+
+    @staticmethod
+    def error(status, name, message, headers=None):
+        return web.json_response({"name": name, "message": message, "debug_id": uuid.uuid4().hex[:13]}, status=status, headers=headers)
+
+    @web.middleware
+    async def faults(self, request, handler):
+        """Applies latency, rate limiting, injected errors and the bearer token check to every API call."""
+        endpoint = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        if endpoint.startswith("/standin"):
+            return await handler(request)
+        await asyncio.sleep(self.latency())
+        if self.rate_limited():
+            self.count(endpoint, "rate_limited")
+            return self.error(429, "RATE_LIMIT_REACHED", "Too many requests. Blocked due to rate limiting.", headers={"Retry-After": "1"})
+        if random.random() < self.error_rate:
+            self.count(endpoint, "error")
+            return self.error(500, "INTERNAL_SERVICE_ERROR", "An internal service error has occurred.")
+        if endpoint != "/v1/oauth2/token":
+            token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if self.tokens.get(token, 0) < time.monotonic():
+                self.count(endpoint, "unauthorized")
+                return self.error(401, "AUTHENTICATION_FAILURE", "Authentication failed due to invalid authentication credentials or a missing Authorization header.")
+        self.count(endpoint, "ok")
+        return await handler(request)
+
+    async def token(self, request):
+        access_token = uuid.uuid4().hex
+        self.tokens[access_token] = time.monotonic() + self.token_ttl
+        return web.json_response({"access_token": access_token, "token_type": "Bearer", "expires_in": self.token_ttl})
+
+    async def create_payment(self, request):
+        data = await request.json()
+        payment_id = "PAYID-" + uuid.uuid4().hex[:24].upper()
+        payment = {
+            "id": payment_id,
+            "intent": data.get("intent", "sale"),
+            "state": "created",
+            "payer": data.get("payer", {}),
+            "transactions": data.get("transactions", []),
+            "links": [
+                {"href": f"{request.url.origin()}/v1/payments/payment/{payment_id}", "rel": "self", "method": "GET"},
+                {"href": f"{request.url.origin()}/checkoutnow?token={payment_id}", "rel": "approval_url", "method": "REDIRECT"},
+                {"href": f"{request.url.origin()}/v1/payments/payment/{payment_id}/execute", "rel": "execute", "method": "POST"}
+            ]
+        }
+        self.payments[payment_id] = payment
+        return web.json_response(payment, status=201)
+
+    async def get_payment(self, request):
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return self.error(404, "INVALID_RESOURCE_ID", "Requested resource ID was not found.")
+        return web.json_response(payment)
+
+    async def execute_payment(self, request):
+        request_id = request.headers.get("PayPal-Request-Id")
+        if request_id in self.executions:
+            return web.json_response(self.executions[request_id])
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return self.error(404, "INVALID_RESOURCE_ID", "Requested resource ID was not found.")
+        if payment["state"] == "approved":
+            return self.error(400, "PAYMENT_ALREADY_DONE", "Payment has been done already for this cart.")
+        data = await request.json()
+        payment["state"] = "approved"
+        for transaction in payment["transactions"]:
+            sale_id = uuid.uuid4().hex[:17].upper()
+            transaction["related_resources"] = [{"sale": {"id": sale_id, "state": "completed", "amount": transaction.get("amount", {}), "parent_payment": payment["id"]}}]
+            self.sales[sale_id] = transaction["related_resources"][0]["sale"]
+        payment["payer"] = {**payment["payer"], "status": "VERIFIED", "payer_info": {"payer_id": data.get("payer_id")}}
+        if request_id:
+            self.executions[request_id] = payment
+        return web.json_response(payment)
+
+    async def refund_sale(self, request):
+        sale_id = request.match_info["sale_id"]
+        if sale_id in self.refunds:
+            return web.json_response(self.refunds[sale_id], status=201)
+        sale = self.sales.get(sale_id)
+        if sale is None:
+            return self.error(404, "INVALID_RESOURCE_ID", "Requested resource ID was not found.")
+        sale["state"] = "refunded"
+        self.refunds[sale_id] = {"id": uuid.uuid4().hex[:17].upper(), "state": "completed", "sale_id": sale_id, "amount": sale["amount"]}
+        return web.json_response(self.refunds[sale_id], status=201)
+
+    async def create_payout(self, request):
+        request_id = request.headers.get("PayPal-Request-Id")
+        if request_id in self.payout_requests:
+            return web.json_response(self.payout_requests[request_id], status=201)
+        data = await request.json()
+        sender_batch_id = data["sender_batch_header"]["sender_batch_id"]
+        if sender_batch_id in self.sender_batches:
+            return self.error(400, "USER_BUSINESS_ERROR", "Batch with given sender_batch_id already exists")
+        payout_batch_id = uuid.uuid4().hex[:13].upper()
+        items = []
+        for item in data["items"]:
+            items.append({
+                "payout_item_id": uuid.uuid4().hex[:13].upper(),
+                "transaction_status": "FAILED" if random.random() < self.item_failure_rate else "SUCCESS",
+                "payout_batch_id": payout_batch_id,
+                "payout_item": item
+            })
+        for item in items:
+            if item["transaction_status"] == "FAILED":
+                item["errors"] = {"name": "RECEIVER_UNREGISTERED", "message": "Receiver is unregistered"}
+        batch_header = {"payout_batch_id": payout_batch_id, "batch_status": "PENDING", "sender_batch_header": data["sender_batch_header"]}
+        self.batches[payout_batch_id] = {"batch_header": batch_header, "items": items}
+        self.sender_batches[sender_batch_id] = payout_batch_id
+        if request_id:
+            self.payout_requests[request_id] = {"batch_header": batch_header}
+        return web.json_response({"batch_header": batch_header}, status=201)
+
+    async def get_payout(self, request):
+        batch = self.batches.get(request.match_info["payout_batch_id"])
+        if batch is None:
+            return self.error(404, "INVALID_RESOURCE_ID", "Requested resource ID was not found.")
+        batch["batch_header"]["batch_status"] = "SUCCESS"
+        return web.json_response(batch)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def reset_stats(self, request):
+        self.stats = {}
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application(middlewares=[self.faults])
+        app.router.add_post("/v1/oauth2/token", self.token)
+        app.router.add_post("/v1/payments/payment", self.create_payment)
+        app.router.add_get("/v1/payments/payment/{payment_id}", self.get_payment)
+        app.router.add_post("/v1/payments/payment/{payment_id}/execute", self.execute_payment)
+        app.router.add_post("/v1/payments/sale/{sale_id}/refund", self.refund_sale)
+        app.router.add_post("/v1/payments/payouts", self.create_payout)
+        app.router.add_get("/v1/payments/payouts/{payout_batch_id}", self.get_payout)
+        app.router.add_get("/standin/stats", self.get_stats)
+        app.router.add_delete("/standin/stats", self.reset_stats)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local PayPal stand-in for load testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=100, help="Median response latency.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the log-normal latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Requests per second before answering 429; 0 for no limit.")
+    parser.add_argument("--item-failure-rate", type=float, default=0.0, help="Fraction of payout items that fail.")
+    parser.add_argument("--token-ttl", type=int, default=32400, help="Lifetime of access tokens, in seconds.")
+    args = parser.parse_args()
+    standin = StandIn(args.latency_ms, args.latency_sigma, args.error_rate, args.rate_limit, args.item_failure_rate, args.token_ttl)
+    logger.info(f"PayPal stand-in listening on http://{args.host}:{args.port}")
+    web.run_app(standin.app(), host=args.host, port=args.port)
@@ -4,6 +4,13 @@ import logging
 ROYALTY  = 2.5
 FEES = 2.5
 from app.core.database import  database_client
+from app.core.orderbook import order_book
+from app.core.sweeper import reservation_sweeper, upload_sweeper
+from app.core.idempotency import idempotency_cleaner
+from app.core.storage import filebase_store
+from app.core.aws import aws_store
+from app.fintech.payouts import payout_worker
+from app.fintech.paypal import paypal_client
 from fastapi.middleware.cors import CORSMiddleware
 # Initialize logging
 from app.utils.logging_config import logging_config  # Import the configuration file
@@ -12,6 +19,7 @@ logging.config.dictConfig(logging_config)
 logger = logging.getLogger("main")
 
 from app.utils.utils import SERVER_URL
+from app.utils.pagination import NEXT_CURSOR_HEADER
 from app.api import admin,auth,marketplace,transactions,trs,user
 app = FastAPI(
     title="Whiplano API",
@@ -30,6 +38,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  
     allow_headers=["*"], 
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 
@@ -62,6 +71,24 @@ async def root():
 @app.on_event("startup")
 async def startup_event():
     await database_client.init_pool()
+    await order_book.load(database_client)
+    order_book.start(database_client)
+    await paypal_client.start()
+    reservation_sweeper.start(database_client, transactions.reconcile_claimed_trade)
+    upload_sweeper.start(database_client)
+    idempotency_cleaner.start(database_client)
+    payout_worker.start(database_client)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await payout_worker.stop()
+    await idempotency_cleaner.stop()
+    await upload_sweeper.stop()
+    await reservation_sweeper.stop()
+    await paypal_client.close()
+    await order_book.stop()
+    filebase_store.close()
+    aws_store.close()
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
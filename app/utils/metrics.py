@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class Metrics:
+    """
+    Process-local counters and timings, exposed by /admin/metrics.
+
+    Counters only go up; timings keep the count, total, maximum and last observed value in seconds.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['last'] = seconds
+
+    def snapshot(self):
+        """Returns a copy of every counter and timing, with the uptime of the process."""
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started_at,
+                'counters': dict(self.counters),
+                'timings': {name: dict(timing) for name, timing in self.timings.items()}
+            }
+
+
+metrics = Metrics()
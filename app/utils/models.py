@@ -1,7 +1,8 @@
 
 from pydantic import BaseModel,Field,EmailStr
 from datetime import datetime, timedelta,date
-from typing import Optional
+from typing import Optional, Literal, List
+from uuid import UUID
 
 class SignupRequest(BaseModel):
     email: EmailStr
@@ -31,8 +32,39 @@ class MintTrsData(BaseModel):
    
 class TradeCreateData(BaseModel):
     collection_name : str = Field(..., description = "Name of the collection to be bought")
-    number : int = Field(..., description = "Number of TRSs to be traded") 
-    cost : float = Field(..., description = "Cost of one TRS")
+    number : int = Field(..., gt = 0, description = "Number of TRSs to be traded") 
+    cost : Optional[float] = Field(None, gt = 0, description = "Cost of one TRS. Required for limit orders")
+    order_type : Literal['limit', 'market'] = Field('limit', description = "limit buys at exactly `cost`; market buys at the best prices, cheapest first")
+    max_price : Optional[float] = Field(None, gt = 0, description = "Highest price per TRS a market order may pay")
+
+class TrsUploadFile(BaseModel):
+    filename : str = Field(..., description = "Name of the file, without any path")
+    size : int = Field(..., gt = 0, description = "Size of the file in bytes")
+    content_type : Optional[str] = Field(None, description = "MIME type of the file")
+
+class TrsUploadRequest(BaseModel):
+    title : str = Field(..., description = "Title of the TRS")
+    files : List[TrsUploadFile] = Field(..., description = "The files of the TRS, at most 10")
+    image : TrsUploadFile = Field(..., description = "The thumbnail of the TRS")
+
+class TrsUploadPart(BaseModel):
+    part_number : int = Field(..., description = "Number of the part, starting at 1")
+    etag : str = Field(..., description = "ETag returned by the bucket for the part")
+
+class TrsUploadedFile(BaseModel):
+    filename : str = Field(..., description = "Name of the file, as sent to /create_trs_request/uploads")
+    size : int = Field(..., gt = 0, description = "Size of the file in bytes")
+    upload_id : Optional[str] = Field(None, description = "Upload id, for files uploaded in parts")
+    parts : Optional[List[TrsUploadPart]] = Field(None, description = "The uploaded parts, for files uploaded in parts")
+
+class TrsFinalizeRequest(BaseModel):
+    model_name : str = Field(..., description = "Name of the model used for creating the TRS")
+    title : str = Field(..., description = "Title of the TRS")
+    description : str = Field(..., description = "Description of the TRS")
+    number : int = Field(..., description = "Number of TRS to be minted")
+    upload_uuid : UUID = Field(..., description = "upload_uuid returned by /create_trs_request/uploads")
+    files : List[TrsUploadedFile] = Field(..., description = "The uploaded files")
+    image : TrsUploadedFile = Field(..., description = "The uploaded thumbnail")
 
 class KYCData(BaseModel):
     first_name: str
@@ -0,0 +1,71 @@
+import base64
+import json
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: list) -> str:
+    """
+    Encodes the sort key of the last item of a page as an opaque cursor.
+
+    Parameters:
+    values (list): The sort key values, in sort order.
+
+    Returns:
+    str: A URL-safe cursor string.
+    """
+    raw = json.dumps([str(value) for value in values]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    """
+    Decodes a cursor produced by encode_cursor.
+
+    Parameters:
+    cursor (str): The cursor sent by the client.
+    length (int): The number of sort key values the endpoint expects.
+
+    Returns:
+    list: The sort key values, as strings.
+
+    Raises:
+    HTTPException: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return values
+
+
+def page_size(limit: int, cursor: str = None) -> int:
+    """
+    Returns the page size of a listing request, clamped to 1..MAX_PAGE_SIZE.
+
+    Listings are only paginated when the client asks for it: without a limit and a cursor the whole
+    list is returned (None), as before pagination existed. A cursor without a limit gets DEFAULT_PAGE_SIZE.
+    """
+    if limit is None:
+        return DEFAULT_PAGE_SIZE if cursor else None
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def next_cursor(items: list, limit: int, key) -> str:
+    """
+    Returns the cursor of the page after `items`, or None if `items` is the last page or the list was not paginated.
+
+    Parameters:
+    items (list): The page just fetched.
+    limit (int): The page size that was requested, or None.
+    key (callable): Returns the sort key values of an item.
+    """
+    if limit is None or len(items) < limit:
+        return None
+    return encode_cursor(key(items[-1]))
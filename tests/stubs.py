@@ -0,0 +1,137 @@
+"""
+Stand-ins for the asyncmy pool, so DatabaseManager can run without a database.
+
+A StubPool hands out a fixed number of StubConnections and makes `acquire` wait while all of them
+are in use, like asyncmy's pool. Their cursors record every statement, wait `latency` seconds to
+simulate the round trip, and answer through the pool's `responder(query, values)`, which returns a
+Result, or None for a statement without rows. Queries reach the responder with whitespace collapsed.
+
+Pools that model state per connection (row locks, say) override `respond`, which may be a coroutine,
+and `finish`, which runs when a connection commits or rolls back.
+"""
+import asyncio
+import inspect
+
+from app.core.database import DatabaseManager
+
+
+class Result:
+    def __init__(self, columns=(), rows=(), rowcount=None, lastrowid=None):
+        self.columns = list(columns)
+        self.rows = [tuple(row) for row in rows]
+        self.rowcount = len(self.rows) if rowcount is None else rowcount
+        self.lastrowid = lastrowid
+
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = 0
+        self.lastrowid = None
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, query, values=None):
+        query = " ".join(query.split())
+        self.connection.statements.append((query, values))
+        # Yield to the loop, so concurrent units of work interleave as they would on a real connection.
+        await asyncio.sleep(self.connection.pool.latency)
+        result = self.connection.pool.respond(self.connection, query, values)
+        if inspect.isawaitable(result):
+            result = await result
+        result = result or Result()
+        self.description = [(column,) for column in result.columns] or None
+        self.rows = list(result.rows)
+        self.rowcount = result.rowcount
+        self.lastrowid = result.lastrowid
+
+    async def executemany(self, query, values):
+        # One round trip, as asyncmy sends the rows of an INSERT as one multi-row statement.
+        await self.execute(query, list(values))
+
+    async def callproc(self, name, args):
+        await self.execute(f"CALL {name}", args)
+
+    async def nextset(self):
+        return None
+
+    async def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    async def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class StubConnection:
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return StubCursor(self)
+
+    async def commit(self):
+        self.commits += 1
+        self.pool.finish(self, committed=True)
+
+    async def rollback(self):
+        self.rollbacks += 1
+        self.pool.finish(self, committed=False)
+
+
+class StubPool:
+    def __init__(self, size, responder=None, latency=0):
+        self.size = size
+        self.responder = responder or (lambda query, values: None)
+        self.latency = latency
+        self.connections = [StubConnection(self, f"connection-{number}") for number in range(size)]
+        self.free = asyncio.Queue()
+        for connection in self.connections:
+            self.free.put_nowait(connection)
+        self.acquires = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    @property
+    def freesize(self):
+        return self.free.qsize()
+
+    @property
+    def statements(self):
+        """Every statement run on the pool, in no particular order across connections."""
+        return [statement for connection in self.connections for statement in connection.statements]
+
+    def respond(self, connection, query, values):
+        return self.responder(query, values)
+
+    def finish(self, connection, committed):
+        pass
+
+    async def acquire(self):
+        connection = await self.free.get()
+        self.acquires += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        return connection
+
+    async def release(self, connection):
+        self.in_use -= 1
+        self.free.put_nowait(connection)
+
+
+def database_with_pool(size, responder=None, latency=0):
+    """Returns a DatabaseManager whose pool is a StubPool of `size` connections, and whose id_pool has one."""
+    database = DatabaseManager()
+    database.pool = StubPool(size, responder, latency)
+    database.id_pool = StubPool(1, responder, latency)
+    return database
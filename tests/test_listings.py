@@ -0,0 +1,59 @@
+"""
+Listing and delisting TRS: DatabaseManager.add_trs_to_marketplace and remove_trs_from_marketplace.
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.core import database as database_module
+from tests.stubs import Result, database_with_pool
+
+
+def listing_responder(listable):
+    """Answers the coverage reads of a user who owns `listable` free, unlisted TRS."""
+    def respond(query, values):
+        if query.startswith("SELECT total - artisan - listed - reserved FROM holdings"):
+            return Result(["listable"], [(listable,)])
+        if query.startswith("SELECT (SELECT COUNT(*) FROM trs"):
+            return Result(["listable"], [(listable,)])
+        return None
+    return respond
+
+
+@pytest.mark.parametrize("number", [0, -5])
+@pytest.mark.parametrize("method", ["add", "remove"])
+def test_a_non_positive_number_is_rejected_before_any_statement(method, number):
+    async def scenario():
+        database = database_with_pool(1, listing_responder(10))
+        with pytest.raises(HTTPException) as raised:
+            if method == "add":
+                await database.add_trs_to_marketplace("seller", "Collection", 10, number)
+            else:
+                await database.remove_trs_from_marketplace("seller", "Collection", number)
+        return raised.value, database.pool.statements
+
+    error, statements = asyncio.run(scenario())
+    assert error.status_code == 400
+    assert statements == []
+
+
+@pytest.mark.parametrize("use_holdings", [False, True])
+def test_coverage_is_checked_under_the_sellers_holdings_lock(use_holdings, monkeypatch):
+    monkeypatch.setattr(database_module, "USE_HOLDINGS", use_holdings)
+
+    async def scenario():
+        database = database_with_pool(1, listing_responder(3))
+        listed = await database.add_trs_to_marketplace("seller", "Collection", 10, 3)
+        refused = await database.add_trs_to_marketplace("seller", "Collection", 10, 4)
+        return listed, refused, database.pool.statements
+
+    listed, refused, statements = asyncio.run(scenario())
+    assert listed is not None
+    assert refused is None
+    queries = [query for query, _ in statements]
+    # The first statement of each listing locks the holdings row the concurrent writers also update.
+    assert queries[0].startswith("SELECT total - artisan - listed - reserved FROM holdings")
+    assert queries[0].endswith("FOR UPDATE")
+    assert statements[0][1] == ("seller", "Collection")
+    assert any(query.startswith("INSERT INTO listings") for query in queries)
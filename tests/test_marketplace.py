@@ -0,0 +1,55 @@
+"""
+Round trips of DatabaseManager.get_marketplace_all: one query however many price levels are listed.
+
+The stub pool adds a simulated round trip to every statement, so the time of a listing grows with
+the number of statements, not with the number of levels.
+"""
+import asyncio
+import time
+
+import pytest
+
+from tests.stubs import Result, database_with_pool
+
+ROUND_TRIP = 0.01
+
+
+def marketplace_responder(levels):
+    """Answers the marketplace query with `levels` price levels, three per collection."""
+    def respond(query, values):
+        if query.startswith("SELECT m.collection_name"):
+            rows = []
+            for level in range(levels):
+                collection_name = f"collection-{level // 3:04d}"
+                rows.append((collection_name, 10 + level % 3, 5, level // 3, collection_name, "creator@example.com"))
+            return Result(["collection_name", "bid_price", "number_of_trs", "id", "name", "creator"], rows)
+        return None
+    return respond
+
+
+def list_marketplace(levels):
+    async def scenario():
+        database = database_with_pool(2, marketplace_responder(levels), latency=ROUND_TRIP)
+        started = time.perf_counter()
+        marketplace = await database.get_marketplace_all()
+        return marketplace, database.pool.statements, time.perf_counter() - started
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("levels", [1, 10, 100, 1000])
+def test_listing_is_one_round_trip_for_any_number_of_levels(levels):
+    marketplace, statements, seconds = list_marketplace(levels)
+    assert len(marketplace) == levels
+    assert len(statements) == 1
+    # Per-level lookups would take `levels` round trips; building the rows of 1000 levels takes a few of its own.
+    assert seconds < ROUND_TRIP * max(10, levels / 10)
+
+
+def test_listing_keeps_the_response_shape():
+    marketplace, _, _ = list_marketplace(2)
+    assert marketplace[0] == {
+        'collection_name': "collection-0000",
+        'bid_price': 10,
+        'number_of_trs': 5,
+        'collection_data': [{'id': 0, 'name': "collection-0000", 'creator': "creator@example.com"}],
+    }
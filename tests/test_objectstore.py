@@ -0,0 +1,101 @@
+"""
+S3ObjectStore keeps boto3 off the event loop.
+
+SleepingClient stands in for a boto3 S3 client whose calls block their thread for a fixed time, like
+a large upload would. While one runs, a probe on the loop measures how late its timers fire.
+"""
+import asyncio
+import hashlib
+import io
+import threading
+import time
+
+import pytest
+from fastapi import UploadFile
+
+from app.core import storage
+from app.core.objectstore import S3ObjectStore
+from tests.stubs import database_with_pool
+
+UPLOAD_SECONDS = 0.5
+TICK = 0.01
+
+
+class SleepingClient:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.uploads = []
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.seconds)
+        with self.lock:
+            self.in_flight -= 1
+            self.uploads.append((bucket, key, fileobj.read()))
+
+    def head_object(self, Bucket, Key):
+        time.sleep(self.seconds)
+        return {'Metadata': {'cid': f"cid-of-{Key}"}}
+
+
+async def worst_lag(until):
+    """Sleeps TICK at a time until `until` is done and returns the latest a timer fired."""
+    lag = 0
+    while not until.done():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lag = max(lag, time.perf_counter() - started - TICK)
+    return lag
+
+
+def test_the_loop_keeps_running_during_an_upload(monkeypatch):
+    client = SleepingClient(UPLOAD_SECONDS)
+    store = S3ObjectStore(client, "bucket", name="test")
+    monkeypatch.setattr(storage, "filebase_store", store)
+
+    async def scenario():
+        monkeypatch.setattr(storage, "database_client", database_with_pool(1))
+        upload = asyncio.ensure_future(storage.upload_to_s3(UploadFile(filename="big.bin", file=io.BytesIO(b"data")), "trs_data/big.bin"))
+        lag = await worst_lag(upload)
+        return await upload, lag, storage.database_client.pool.statements
+
+    try:
+        url, lag, statements = asyncio.run(scenario())
+    finally:
+        store.close()
+    assert url.endswith("/trs_data/big.bin")
+    assert client.uploads == [("bucket", "trs_data/big.bin", b"data")]
+    # The CID was fetched after the upload and cached, off the loop as well.
+    assert [values for query, values in statements if query.startswith("INSERT INTO storage_objects")] == [[("trs_data/big.bin", "cid-of-trs_data/big.bin", None, hashlib.sha256(b"data").hexdigest())]]
+    # A blocking upload would hold every timer for the whole UPLOAD_SECONDS.
+    assert lag < UPLOAD_SECONDS / 5
+
+
+def test_calls_beyond_the_concurrency_wait_in_the_loop(monkeypatch):
+    client = SleepingClient(0.05)
+    store = S3ObjectStore(client, "bucket", concurrency=2, name="test")
+    monkeypatch.setattr(storage, "filebase_store", store)
+
+    async def scenario():
+        return await asyncio.gather(*(storage.get_file_cid(f"key-{number}") for number in range(8)))
+
+    try:
+        cids = asyncio.run(scenario())
+    finally:
+        store.close()
+    assert cids == [f"cid-of-key-{number}" for number in range(8)]
+    assert client.max_in_flight <= 2
+
+
+def test_a_call_over_its_timeout_raises():
+    store = S3ObjectStore(SleepingClient(0.2), "bucket", name="test")
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(store.head_object("key", timeout=0.05))
+    finally:
+        store.close()
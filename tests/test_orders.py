@@ -0,0 +1,63 @@
+"""
+Buy orders for a non-positive number of TRS or at a non-positive price are refused before they reach
+the order book or the database.
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from app.core import database as database_module
+from app.core.orderbook import OrderBook
+from app.utils.models import TradeCreateData
+from tests.stubs import database_with_pool
+
+
+@pytest.mark.parametrize("fields", [
+    {"number": 0, "cost": 10},
+    {"number": -5, "cost": 10},
+    {"number": 5, "cost": 0},
+    {"number": 5, "cost": -10},
+    {"number": 0, "order_type": "market"},
+    {"number": 5, "order_type": "market", "max_price": 0},
+])
+def test_the_order_is_validated(fields):
+    with pytest.raises(ValidationError):
+        TradeCreateData(collection_name="Collection", **fields)
+
+
+@pytest.mark.parametrize("number", [0, -5])
+def test_the_fill_planner_refuses_a_non_positive_number(number):
+    book = OrderBook()
+    book.add("Collection", 10, 5)
+    with pytest.raises(ValueError):
+        book.fill("Collection", number)
+
+
+@pytest.mark.parametrize("procedures", [False, True])
+@pytest.mark.parametrize("fills", [[(10, 0)], [(10, -5)], [(0, 5)], [(10, 2), (12, -1)], []])
+def test_a_reservation_of_nothing_runs_no_statement(fills, procedures, monkeypatch):
+    monkeypatch.setattr(database_module, "TRADE_PROCEDURES", procedures)
+
+    async def scenario():
+        database = database_with_pool(1)
+        with pytest.raises(HTTPException) as raised:
+            await database.trade_create_levels("trade-1", fills, "Collection", "buyer")
+        return raised.value, database.pool.statements
+
+    error, statements = asyncio.run(scenario())
+    assert error.status_code == 400
+    assert statements == []
+
+
+def test_reserve_trade_refuses_a_non_positive_number():
+    async def scenario():
+        database = database_with_pool(1)
+        async with database.transaction() as connection:
+            async with connection.cursor() as cursor:
+                with pytest.raises(ValueError):
+                    await database.reserve_trade(cursor, "trade-1", 10, -5, "Collection", "buyer")
+        return database.pool.statements
+
+    assert asyncio.run(scenario()) == []
@@ -0,0 +1,108 @@
+"""
+How PayoutWorker.process_batch handles PayPal's answers to a payout batch: transient failures are
+retried in the same batch after the backoff or Retry-After, invalid batches are bisected, and a batch
+PayPal reports as already sent is failed for manual reconciliation instead of being sent again.
+"""
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.fintech import paypal, payouts
+from app.fintech.payouts import PayoutWorker
+
+
+class OutboxDatabase:
+    """Records what the worker does to the payout_outbox rows."""
+    def __init__(self):
+        self.completed = []
+        self.retried = []
+        self.rebatched = []
+
+    async def complete_payouts(self, ids, payout_batch_id):
+        self.completed.append((sorted(ids), payout_batch_id))
+
+    async def retry_payouts(self, ids, error, delay_seconds=None, keep_batch=True):
+        self.retried.append((sorted(ids), delay_seconds, keep_batch))
+
+    async def rebatch_payouts(self, groups):
+        self.rebatched.append(groups)
+        return [f"batch-{len(self.rebatched)}-{index}" for index in range(len(groups))]
+
+
+def outbox(count, attempts=1):
+    return [
+        {'id': number, 'recipient_email': f"seller-{number}@example.com", 'amount': "10.00", 'currency': "USD",
+         'note': "Payout", 'idempotency_key': f"key-{number}", 'attempts': attempts}
+        for number in range(count)
+    ]
+
+
+def send(monkeypatch, answer, batch):
+    """Runs process_batch on `batch`, with PayPal answering every payout_batch call with answer(items)."""
+    sent = []
+
+    async def payout_batch(sender_batch_id, items):
+        sent.append((sender_batch_id, len(items)))
+        return answer(items)
+
+    monkeypatch.setattr(paypal, "payout_batch", payout_batch)
+    worker = PayoutWorker()
+    worker.database = database = OutboxDatabase()
+
+    async def scenario():
+        worker.semaphore = asyncio.Semaphore(4)
+        await worker.process_batch("batch-0", batch)
+    asyncio.run(scenario())
+    return database, sent
+
+
+@pytest.mark.parametrize("status, retry_after", [(429, 120), (429, None), (408, None), (500, None), (503, 30)])
+def test_transient_failures_are_retried_in_the_same_batch(monkeypatch, status, retry_after):
+    database, sent = send(monkeypatch, lambda items: (status, {"name": "ERROR", "message": "try again"}, retry_after), outbox(4))
+
+    assert sent == [("batch-0", 4)]
+    assert database.rebatched == []
+    [(ids, delay, keep_batch)] = database.retried
+    assert ids == [0, 1, 2, 3] and keep_batch
+    assert delay == max(payouts.PAYOUT_RETRY_BASE_SECONDS, retry_after or 0)
+
+
+def test_an_invalid_batch_is_bisected_down_to_the_bad_payout(monkeypatch):
+    def answer(items):
+        if any(item['recipient_email'] == "seller-2@example.com" for item in items):
+            return 422, {"name": "VALIDATION_ERROR", "message": "Invalid receiver"}, None
+        return 201, {"batch_header": {"payout_batch_id": f"PAYOUT-{items[0]['sender_item_id']}"}}, None
+
+    database, sent = send(monkeypatch, answer, outbox(4))
+
+    assert len(database.rebatched) == 2
+    assert sorted(database.completed) == [([0, 1], "PAYOUT-key-0"), ([3], "PAYOUT-key-3")]
+    assert database.retried == [([2], payouts.PAYOUT_RETRY_BASE_SECONDS, False)]
+
+
+def test_an_authorisation_failure_is_not_bisected(monkeypatch):
+    database, sent = send(monkeypatch, lambda items: (403, {"name": "NOT_AUTHORIZED", "message": "Authorization failed"}, None), outbox(4))
+
+    assert sent == [("batch-0", 4)]
+    assert database.rebatched == []
+    assert database.retried == [([0, 1, 2, 3], payouts.PAYOUT_RETRY_BASE_SECONDS, True)]
+
+
+def test_a_batch_already_sent_is_failed_for_reconciliation(monkeypatch):
+    duplicate = {"name": "USER_BUSINESS_ERROR", "message": "Batch with given sender_batch_id already exists"}
+    database, sent = send(monkeypatch, lambda items: (400, duplicate, None), outbox(4))
+
+    assert sent == [("batch-0", 4)]
+    assert database.rebatched == []
+    assert database.completed == []
+    assert database.retried == [([0, 1, 2, 3], None, True)]
+
+
+def test_retry_after_is_read_in_seconds_or_as_a_date():
+    assert paypal.retry_after_seconds("120") == 120
+    assert paypal.retry_after_seconds(None) is None
+    assert paypal.retry_after_seconds("soon") is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < paypal.retry_after_seconds(later) <= 60
@@ -0,0 +1,229 @@
+"""
+Concurrent reservations of DatabaseManager.trade_create at 1, 8 and 64 buyers of 5 TRS, and 32 buyers
+of 12, who need two listings each and buy the whole supply, so they wait for each other's listings.
+
+RowLockPool models the listings and trs rows the reservation touches, with InnoDB's row locks:
+a locking read takes the lock of every row it returns until its connection commits or rolls back,
+SKIP LOCKED leaves out rows locked by other connections, a plain FOR UPDATE waits for them row by
+row, and a wait that would close a cycle fails with error 1213 like InnoDB's deadlock detector.
+Writes are undone on rollback. Run with `-s` to see trades/s and the conflict rate per buyer count.
+"""
+import asyncio
+import time
+
+import pytest
+from asyncmy.errors import OperationalError
+from fastapi import HTTPException
+
+from app.core.database import DEADLOCK_RETRIES, DatabaseManager, is_deadlock
+from tests.stubs import Result, StubPool, database_with_pool
+
+ROUND_TRIP = 0.002
+PRICE = 10
+SELLERS = 64
+LISTED = 6
+BOUGHT = 5
+
+
+class RowLockPool(StubPool):
+    def __init__(self, size, latency, sellers, listed):
+        super().__init__(size, latency=latency)
+        self.listings = {}
+        self.trs = {}
+        for seller in range(sellers):
+            listing_id = seller + 1
+            self.listings[listing_id] = {
+                'seller_id': f"seller-{seller}", 'collection_name': "Collection", 'price': PRICE,
+                'quantity': listed, 'reserved': 0, 'created_at': listing_id,
+            }
+            for number in range(listed):
+                self.trs[seller * listed + number + 1] = {'user_id': f"seller-{seller}", 'collection_name': "Collection", 'in_trade': 0}
+        self.original = {listing_id: listing['quantity'] for listing_id, listing in self.listings.items()}
+        self.trades = {}
+        self.locks = {}
+        self.waiting = {}
+        self.undo = {}
+        self.released = asyncio.Event()
+        self.waits = 0
+        self.deadlocks = 0
+
+    def finish(self, connection, committed):
+        for undo in reversed(self.undo.pop(connection, [])):
+            if not committed:
+                undo()
+        for key in [key for key, holder in self.locks.items() if holder is connection]:
+            del self.locks[key]
+        self.released.set()
+        self.released = asyncio.Event()
+
+    def write(self, connection, apply, undo):
+        apply()
+        self.undo.setdefault(connection, []).append(undo)
+
+    def closes_cycle(self, connection, key):
+        holder = self.locks.get(key)
+        while holder is not None:
+            if holder is connection:
+                return True
+            holder = self.locks.get(self.waiting.get(holder))
+        return False
+
+    async def lock(self, connection, key):
+        while self.locks.get(key, connection) is not connection:
+            if self.closes_cycle(connection, key):
+                self.deadlocks += 1
+                raise OperationalError(1213, "Deadlock found when trying to get lock; try restarting transaction")
+            self.waiting[connection] = key
+            await self.released.wait()
+            del self.waiting[connection]
+        self.locks[key] = connection
+
+    def unlocked(self, connection, key):
+        return self.locks.get(key, connection) is connection
+
+    async def respond(self, connection, query, values):
+        if query.startswith("SELECT listing_id, seller_id, quantity, created_at FROM listings"):
+            collection_name, price = values[0], values[1]
+            after = tuple(values[3:5]) if "created_at >" in query else None
+            rows = sorted(
+                (listing['created_at'], listing_id) for listing_id, listing in self.listings.items()
+                if listing['collection_name'] == collection_name and listing['price'] == price
+            )
+            rows = [row for row in rows if after is None or row > after]
+            if "SKIP LOCKED" in query:
+                keys = [("listings", listing_id) for _, listing_id in rows if self.unlocked(connection, ("listings", listing_id))]
+                keys = [key for key in keys if self.listings[key[1]]['quantity'] > 0][:values[-1]]
+            else:
+                self.waits += 1
+                keys = [("listings", listing_id) for _, listing_id in rows]
+            for key in keys:
+                await self.lock(connection, key)
+            listings = [(key[1], self.listings[key[1]]) for key in keys if self.listings[key[1]]['quantity'] > 0]
+            return Result(
+                ["listing_id", "seller_id", "quantity", "created_at"],
+                [(listing_id, listing['seller_id'], listing['quantity'], listing['created_at']) for listing_id, listing in listings],
+            )
+        if query.startswith("UPDATE listings SET quantity = quantity - %s, reserved = reserved + %s"):
+            take, _, listing_id = values
+            assert self.locks.get(("listings", listing_id)) is connection
+            listing = self.listings[listing_id]
+            def apply(sign):
+                return lambda: listing.update(quantity=listing['quantity'] - sign * take, reserved=listing['reserved'] + sign * take)
+            self.write(connection, apply(1), apply(-1))
+            return None
+        if query.startswith("SELECT trs_id FROM trs"):
+            user_id, collection_name, size = values
+            keys = [
+                ("trs", trs_id) for trs_id, trs in sorted(self.trs.items())
+                if trs['user_id'] == user_id and trs['collection_name'] == collection_name and not trs['in_trade']
+                and self.unlocked(connection, ("trs", trs_id))
+            ][:size]
+            for key in keys:
+                await self.lock(connection, key)
+            return Result(["trs_id"], [(key[1],) for key in keys])
+        if query.startswith("INSERT INTO trades"):
+            rows = [values[index:index + 5] for index in range(0, len(values), 5)]
+            for trade_id, _, _, trs_id, _ in rows:
+                assert trs_id not in self.trades, f"TRS {trs_id} reserved twice"
+                self.write(connection, lambda trs_id=trs_id, trade_id=trade_id: self.trades.__setitem__(trs_id, trade_id), lambda trs_id=trs_id: self.trades.pop(trs_id))
+            return None
+        if query.startswith("UPDATE trs SET in_trade = 1"):
+            for trs_id in values:
+                assert self.locks.get(("trs", trs_id)) is connection
+                trs = self.trs[trs_id]
+                self.write(connection, lambda trs=trs: trs.update(in_trade=1), lambda trs=trs: trs.update(in_trade=0))
+            return None
+        return None
+
+
+def reserve(buyers, bought=BOUGHT):
+    async def scenario():
+        database = DatabaseManager()
+        database.pool = pool = RowLockPool(10, ROUND_TRIP, SELLERS, LISTED)
+
+        async def buy(buyer):
+            try:
+                await database.trade_create(f"trade-{buyer}", PRICE, bought, "Collection", f"buyer-{buyer}")
+                return True
+            except HTTPException:
+                return False
+
+        started = time.perf_counter()
+        reserved = await asyncio.wait_for(asyncio.gather(*(buy(buyer) for buyer in range(buyers))), timeout=30)
+        return pool, reserved, time.perf_counter() - started
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("buyers, bought", [(1, BOUGHT), (8, BOUGHT), (64, BOUGHT), (32, 2 * LISTED)])
+def test_concurrent_buyers_reserve_disjoint_trs(buyers, bought):
+    pool, reserved, seconds = reserve(buyers, bought)
+    trades = sum(reserved)
+    print(f"\n{buyers} buyers of {bought}: {trades / seconds:.0f} trades/s, conflict rate {pool.waits / buyers:.2f}, {pool.deadlocks} deadlocks (retried)")
+
+    # Every TRS belongs to at most one trade, and a trade holds exactly what it reserved or nothing.
+    per_trade = {}
+    for trade_id in pool.trades.values():
+        per_trade[trade_id] = per_trade.get(trade_id, 0) + 1
+    assert sorted(per_trade) == sorted(f"trade-{buyer}" for buyer in range(buyers) if reserved[buyer])
+    assert set(per_trade.values()) <= {bought}
+    assert sum(trs['in_trade'] for trs in pool.trs.values()) == trades * bought
+    for listing_id, listing in pool.listings.items():
+        assert listing['quantity'] + listing['reserved'] == pool.original[listing_id]
+    assert sum(listing['reserved'] for listing in pool.listings.values()) == trades * bought
+    assert not pool.locks
+    assert pool.freesize == pool.size
+    # The supply covers every buyer, and deadlock victims are retried.
+    assert all(reserved)
+    if bought <= LISTED:
+        # One listing covers a buyer, so buyers never wait for each other.
+        assert pool.waits == 0
+
+
+def test_a_deadlock_victim_is_retried():
+    deadlocks = []
+
+    def respond(query, values):
+        if query.startswith("SELECT listing_id, seller_id, quantity, created_at FROM listings"):
+            if not deadlocks:
+                deadlocks.append(query)
+                raise OperationalError(1213, "Deadlock found when trying to get lock; try restarting transaction")
+            return Result(["listing_id", "seller_id", "quantity", "created_at"], [(1, "seller-0", 10, 1)])
+        if query.startswith("SELECT trs_id FROM trs"):
+            return Result(["trs_id"], [(trs_id,) for trs_id in range(values[-1])])
+        return None
+
+    async def scenario():
+        database = database_with_pool(1, respond)
+        await database.trade_create("trade-1", PRICE, BOUGHT, "Collection", "buyer")
+        return database.pool
+
+    pool = asyncio.run(scenario())
+    [connection] = pool.connections
+    assert len(deadlocks) == 1
+    assert (connection.rollbacks, connection.commits) == (1, 1)
+    assert any(query.startswith("INSERT INTO trades") for query, _ in connection.statements)
+
+
+def test_a_deadlock_inside_an_enclosing_unit_of_work_is_left_to_its_owner():
+    def respond(query, values):
+        if query.startswith("SELECT listing_id"):
+            raise OperationalError(1213, "Deadlock found when trying to get lock; try restarting transaction")
+        return None
+
+    async def scenario():
+        database = database_with_pool(1, respond)
+        attempts = []
+
+        async def record():
+            attempts.append(1)
+            async with database.transaction():
+                await database.trade_create("trade-1", PRICE, BOUGHT, "Collection", "buyer")
+
+        with pytest.raises(HTTPException) as raised:
+            await database.retry_on_deadlock(record)
+        return attempts, raised.value
+
+    attempts, error = asyncio.run(scenario())
+    # trade_create did not retry on the enclosing connection; the owner ran the whole unit of work again.
+    assert len(attempts) == DEADLOCK_RETRIES + 1
+    assert is_deadlock(error)
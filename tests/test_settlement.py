@@ -0,0 +1,57 @@
+"""
+Statements of DatabaseManager.execute_trade: the same set-based statements whatever the number of
+TRS and sellers of the trade, up to a 10k-TRS, 50-seller trade.
+"""
+import asyncio
+
+import pytest
+
+from tests.stubs import Result, database_with_pool
+
+
+def settlement_responder(trs, sellers):
+    """Answers the reads of the settlement of one trade of `trs` TRS bought from `sellers` sellers."""
+    def respond(query, values):
+        if query.startswith("SELECT transaction_number, buyer_id, seller_id, number, cost, collection_name FROM transactions"):
+            rows = [
+                (f"transaction-{seller}", "buyer", f"seller-{seller}", trs // sellers + (seller < trs % sellers), 10, "Collection")
+                for seller in range(sellers)
+            ]
+            return Result(["transaction_number", "buyer_id", "seller_id", "number", "cost", "collection_name"], rows)
+        if query.startswith("UPDATE trs t JOIN trades tr"):
+            return Result(rowcount=trs)
+        if query.startswith("SELECT * FROM users"):
+            return Result(["user_id", "email"], [(user_id, f"{user_id}@example.com") for user_id in values])
+        if query.startswith("SELECT * FROM collection_data"):
+            return Result(["name", "creator"], [(name, "creator@example.com") for name in values])
+        return None
+    return respond
+
+
+def settle(trs, sellers):
+    async def scenario():
+        database = database_with_pool(2, settlement_responder(trs, sellers))
+        settled = await database.execute_trade("trade-1")
+        return settled, database.pool.statements
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("trs, sellers", [(1, 1), (100, 5), (10000, 50)])
+def test_settlement_statements_do_not_grow_with_the_trade(trs, sellers):
+    settled, statements = settle(trs, sellers)
+    baseline = [query for query, _ in settle(1, 1)[1]]
+    assert [query.split(" IN ")[0] for query, _ in statements] == [query.split(" IN ")[0] for query in baseline]
+    # Values grow with the sellers (holdings rows, user lookup) but no statement carries the TRS ids.
+    assert max(len(values) for _, values in statements if values) <= 2 * sellers + 1
+    assert len(settled) == sellers
+    assert sum(payout['number'] for payout in settled) == trs
+    assert settled[-1] == {
+        'seller_id': f"seller-{sellers - 1}",
+        'seller_email': f"seller-{sellers - 1}@example.com",
+        'number': trs // sellers,
+        'cost': 10,
+        'collection_name': "Collection",
+        'buyer_id': "buyer",
+        'buyer_email': "buyer@example.com",
+        'creator_email': "creator@example.com",
+    }
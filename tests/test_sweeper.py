@@ -0,0 +1,160 @@
+"""
+Trades left `executing` past their claim's lease: ReservationSweeper.reconcile_claims and
+transactions.reconcile_claimed_trade, which settles, refunds, cancels or releases them by PayPal's
+state of the payment.
+"""
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+
+from app.api import transactions
+from app.core.sweeper import ReservationSweeper
+from app.fintech import paypal
+from tests.stubs import Result, database_with_pool
+
+LEASE = 900
+
+
+class ClaimsDatabase:
+    """The claims of a DatabaseManager: `expired` trades past the lease, of which `taken` were taken over by another sweeper."""
+    def __init__(self, expired, taken=()):
+        self.expired = list(expired)
+        self.taken = set(taken)
+        self.calls = []
+
+    async def get_expired_claims(self, lease_seconds, limit):
+        return self.expired[:limit]
+
+    async def take_over_trade_claim(self, trade_id, lease_seconds):
+        self.calls.append(("take_over_trade_claim", trade_id))
+        if trade_id in self.taken:
+            return False
+        self.taken.add(trade_id)
+        self.expired.remove(trade_id)
+        return True
+
+    async def modify_paypal_transaction(self, trade_id, status):
+        self.calls.append(("modify_paypal_transaction", trade_id, status))
+
+    async def release_trade_claim(self, trade_id):
+        self.calls.append(("release_trade_claim", trade_id))
+        return True
+
+    async def cancel_trade(self, trade_id):
+        self.calls.append(("cancel_trade", trade_id))
+        return []
+
+
+def test_each_expired_claim_is_taken_over_before_it_is_reconciled():
+    database = ClaimsDatabase(["trade-1", "trade-2", "trade-3", "trade-4"], taken={"trade-2"})
+    reconciled = []
+
+    async def reconcile(trade_id):
+        reconciled.append(trade_id)
+        if trade_id == "trade-3":
+            raise RuntimeError("PayPal is down")
+        return 'settled'
+
+    sweeper = ReservationSweeper()
+    sweeper.database = database
+    sweeper.reconcile = reconcile
+    outcomes = asyncio.run(sweeper.reconcile_claims(LEASE, batch_size=2))
+
+    # trade-2 belongs to another sweeper; a failed reconcile is left for the next lease.
+    assert reconciled == ["trade-1", "trade-3", "trade-4"]
+    assert outcomes == {'settled': 2}
+
+
+def payment(state, sale_state=None):
+    resource = {"id": "PAYID-1", "state": state, "transactions": [{"amount": {"total": "50.00"}}]}
+    if sale_state is not None:
+        resource["transactions"][0]["related_resources"] = [{"sale": {"id": "SALE-1", "state": sale_state}}]
+    return resource
+
+
+@pytest.fixture
+def reconciling(monkeypatch):
+    """Runs reconcile_claimed_trade against a payment in the given state; returns the outcome, the database calls and the refunds."""
+    def run(resource, settles=True):
+        database = ClaimsDatabase([])
+        refunds = []
+
+        async def get_payment(payment_id):
+            return resource
+
+        async def refund_payment(refunded):
+            refunds.append(paypal.payment_sale(refunded)['id'])
+            return {"state": "completed"}
+
+        async def settle_paid_trade(payment_id):
+            if not settles:
+                raise RuntimeError("settlement failed")
+            database.calls.append(("settle_paid_trade", payment_id))
+            return {"message": "done"}, []
+
+        monkeypatch.setattr(paypal, "get_payment", get_payment)
+        monkeypatch.setattr(paypal, "refund_payment", refund_payment)
+        monkeypatch.setattr(transactions, "settle_paid_trade", settle_paid_trade)
+        monkeypatch.setattr(transactions, "database_client", database)
+        outcome = asyncio.run(transactions.reconcile_claimed_trade("PAYID-1"))
+        return outcome, database.calls, refunds
+    return run
+
+
+def test_a_paid_trade_is_settled(reconciling):
+    outcome, calls, refunds = reconciling(payment("approved", "completed"))
+    assert outcome == 'settled'
+    assert calls == [("settle_paid_trade", "PAYID-1")]
+    assert refunds == []
+
+
+def test_a_paid_trade_that_cannot_be_settled_is_refunded(reconciling):
+    outcome, calls, refunds = reconciling(payment("approved", "completed"), settles=False)
+    assert outcome == 'refunded'
+    assert refunds == ["SALE-1"]
+    assert calls == [
+        ("modify_paypal_transaction", "PAYID-1", "refunded"),
+        ("release_trade_claim", "PAYID-1"),
+        ("cancel_trade", "PAYID-1"),
+    ]
+
+
+def test_a_refunded_trade_is_cancelled(reconciling):
+    outcome, calls, refunds = reconciling(payment("approved", "refunded"))
+    assert outcome == 'cancelled'
+    assert refunds == []
+    assert calls == [
+        ("modify_paypal_transaction", "PAYID-1", "refunded"),
+        ("release_trade_claim", "PAYID-1"),
+        ("cancel_trade", "PAYID-1"),
+    ]
+
+
+@pytest.mark.parametrize("state", ["created", "failed"])
+def test_an_uncharged_trade_is_released(reconciling, state):
+    outcome, calls, refunds = reconciling(payment(state))
+    assert outcome == 'released'
+    assert calls == [("release_trade_claim", "PAYID-1")]
+    assert refunds == []
+
+
+@pytest.mark.parametrize("rowcount", [1, 0])
+def test_a_claim_is_taken_over_only_while_it_is_expired(rowcount):
+    def respond(query, values):
+        if query.startswith("UPDATE transactions"):
+            return Result(rowcount=rowcount)
+        return None
+
+    async def scenario():
+        database = database_with_pool(1, respond)
+        taken = await database.take_over_trade_claim("trade-1", LEASE)
+        return taken, database.pool.statements
+
+    taken, statements = asyncio.run(scenario())
+    assert taken is bool(rowcount)
+    [(query, values)] = statements
+    assert "status = 'executing'" in query and "claimed_at < NOW() - INTERVAL %s SECOND" in query
+    assert values == ("trade-1", LEASE)
@@ -0,0 +1,148 @@
+"""
+The trade procedures against the Python path they replace.
+
+The round-trip test runs on the stub pool at a simulated 2 ms and 10 ms round trip and always runs.
+The parity test runs both paths against MySQL and compares the tables they leave behind; it needs the
+DATABASE_* variables of the app and TEST_DATABASE_NAME, a scratch database it migrates and empties.
+"""
+import asyncio
+import os
+import time
+
+import pytest
+
+from app.core import database as database_module
+from app.core.database import DatabaseManager
+from tests.stubs import Result, database_with_pool
+
+SELLERS = ["seller-0", "seller-1", "seller-2"]
+
+
+def trade_responder(query, values):
+    """Answers a reservation of one seller's listing and its settlement, by either path."""
+    if query.startswith("SELECT listing_id, seller_id, quantity, created_at FROM listings"):
+        return Result(["listing_id", "seller_id", "quantity", "created_at"], [(1, "seller-0", 10, 1)])
+    if query.startswith("SELECT trs_id FROM trs"):
+        return Result(["trs_id"], [(trs_id,) for trs_id in range(values[-1])])
+    if query.startswith("SELECT transaction_number, buyer_id, seller_id, number, cost, collection_name FROM transactions"):
+        return Result(["transaction_number", "buyer_id", "seller_id", "number", "cost", "collection_name"], [("transaction-0", "buyer", "seller-0", 5, 10, "Collection")])
+    if query.startswith("SELECT * FROM users"):
+        return Result(["user_id", "email"], [(user_id, f"{user_id}@example.com") for user_id in values])
+    if query.startswith("SELECT * FROM collection_data"):
+        return Result(["name", "creator"], [(name, "creator@example.com") for name in values])
+    if query.startswith("CALL trade_settle"):
+        return Result(
+            ["seller_id", "seller_email", "number", "cost", "collection_name", "buyer_id", "buyer_email", "creator_email"],
+            [("seller-0", "seller-0@example.com", 5, 10, "Collection", "buyer", "buyer@example.com", "creator@example.com")],
+        )
+    return None
+
+
+def trade(procedures, round_trip, monkeypatch):
+    monkeypatch.setattr(database_module, "TRADE_PROCEDURES", procedures)
+
+    async def scenario():
+        database = database_with_pool(2, trade_responder, latency=round_trip)
+        started = time.perf_counter()
+        await database.trade_create("trade-1", 10, 5, "Collection", "buyer")
+        settled = await database.execute_trade("trade-1")
+        return settled, database.pool.statements, time.perf_counter() - started
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("round_trip", [0.002, 0.01])
+def test_procedures_take_one_round_trip_per_step(round_trip, monkeypatch):
+    settled, statements, seconds = trade(False, round_trip, monkeypatch)
+    settled_by_procedure, procedure_statements, procedure_seconds = trade(True, round_trip, monkeypatch)
+    print(f"\n{round_trip * 1000:.0f} ms round trip: reserve + settle {seconds * 1000:.0f} ms in Python ({len(statements)} statements), "
+          f"{procedure_seconds * 1000:.0f} ms by procedure ({len(procedure_statements)} statements)")
+
+    assert [query for query, _ in procedure_statements] == [
+        f"CALL trade_reserve_v{database_module.TRADE_PROCEDURE_VERSIONS['trade_reserve']}",
+        f"CALL trade_settle_v{database_module.TRADE_PROCEDURE_VERSIONS['trade_settle']}",
+    ]
+    assert len(statements) > len(procedure_statements)
+    assert procedure_seconds < seconds
+    assert settled_by_procedure == settled
+
+
+async def seed(database):
+    async with database.transaction() as connection:
+        async with connection.cursor() as cursor:
+            for table in ("users", "collection_data", "trs", "listings", "holdings", "trades", "transactions"):
+                await cursor.execute(f"TRUNCATE TABLE {table}")
+            await cursor.executemany(
+                "INSERT INTO users (user_id, email) VALUES (%s, %s)",
+                [(user_id, f"{user_id}@example.com") for user_id in ["buyer"] + SELLERS],
+            )
+            await cursor.execute("INSERT INTO collection_data (name, creator, number) VALUES ('Collection', 'creator@example.com', 18)")
+            await cursor.executemany(
+                "INSERT INTO trs (trs_id, user_id, collection_name, creator) VALUES (%s, %s, 'Collection', 'creator')",
+                [(index * 6 + number + 1, seller_id) for index, seller_id in enumerate(SELLERS) for number in range(6)],
+            )
+            await cursor.executemany(
+                "INSERT INTO listings (seller_id, collection_name, price, quantity, created_at) VALUES (%s, 'Collection', %s, 4, %s)",
+                [(seller_id, 10 if index < 2 else 12, f"2024-01-01 00:00:0{index}") for index, seller_id in enumerate(SELLERS)],
+            )
+            await cursor.executemany(
+                "INSERT INTO holdings (user_id, collection_name, total, listed) VALUES (%s, 'Collection', 6, 4)",
+                [(seller_id,) for seller_id in SELLERS],
+            )
+
+
+async def snapshot(database):
+    queries = [
+        "SELECT trs_id, user_id, in_trade FROM trs ORDER BY trs_id",
+        "SELECT listing_id, seller_id, price, quantity, reserved FROM listings ORDER BY listing_id",
+        "SELECT user_id, collection_name, total, artisan, listed, reserved FROM holdings ORDER BY user_id, collection_name",
+        "SELECT trade_id, buyer_id, seller_id, trs_id, listing_id, status FROM trades ORDER BY trade_id, trs_id",
+        "SELECT buyer_transaction_id, buyer_id, seller_id, collection_name, cost, number, status FROM transactions ORDER BY buyer_transaction_id, seller_id",
+    ]
+    async with database.transaction() as connection:
+        async with connection.cursor() as cursor:
+            tables = []
+            for query in queries:
+                await cursor.execute(query)
+                tables.append(await cursor.fetchall())
+            return tables
+
+
+async def run_trades(procedures, levels, monkeypatch):
+    monkeypatch.setattr(database_module, "TRADE_PROCEDURES", procedures)
+    database = DatabaseManager()
+    await database.init_pool()
+    try:
+        await seed(database)
+        steps = []
+        await database.trade_create("trade-1", 10, 7, "Collection", "buyer")
+        steps.append(await snapshot(database))
+        assert await database.claim_trade("trade-1")
+        settled = await database.execute_trade("trade-1")
+        steps.append(sorted(settled, key=lambda payout: payout['seller_id']))
+        steps.append(await snapshot(database))
+        await database.trade_create("trade-2", 10, 1, "Collection", "buyer")
+        await database.cancel_trade("trade-2")
+        steps.append(await snapshot(database))
+        if levels:
+            await database.trade_create_levels("trade-3", [(10, 1), (12, 2)], "Collection", "buyer")
+            steps.append(await snapshot(database))
+            assert await database.claim_trade("trade-3")
+            settled = await database.execute_trade("trade-3")
+            steps.append(sorted(settled, key=lambda payout: (payout['seller_id'], payout['cost'])))
+            steps.append(await snapshot(database))
+        return steps
+    finally:
+        await database.close_pool()
+
+
+@pytest.mark.skipif(not os.getenv("TEST_DATABASE_NAME"), reason="needs a scratch MySQL database in TEST_DATABASE_NAME")
+@pytest.mark.parametrize("reserve_version, levels", [(1, False), (2, True)])
+def test_procedures_leave_the_same_state_as_the_python_path(reserve_version, levels, monkeypatch):
+    from app.core.migrate import migrate
+    monkeypatch.setenv("DATABASE_NAME", os.environ["TEST_DATABASE_NAME"])
+    monkeypatch.setitem(database_module.TRADE_PROCEDURE_VERSIONS, 'trade_reserve', reserve_version)
+    asyncio.run(migrate())
+
+    python_steps = asyncio.run(run_trades(False, levels, monkeypatch))
+    procedure_steps = asyncio.run(run_trades(True, levels, monkeypatch))
+    assert procedure_steps == python_steps
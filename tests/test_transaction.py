@@ -0,0 +1,136 @@
+"""
+Tests for the unit of work of DatabaseManager.transaction().
+
+The pool has two connections, so a nested call that acquired a connection of its own (instead of
+reusing the one of the unit of work) would deadlock as soon as two approvals run at once.
+"""
+import asyncio
+
+import pytest
+
+from app.core import storage
+from app.core.database import SharedConnection
+from tests.stubs import Result, database_with_pool
+
+
+def approval_responder(query, values):
+    """Answers the reads of a TRS approval."""
+    if query.startswith("SELECT * FROM trs_creation_requests"):
+        return Result(["id", "title", "description", "file_url_header"], [(values[0], "Collection", "A collection", "trs_data/Collection/")])
+    if query.startswith("SELECT * FROM users"):
+        return Result(["user_id", "email"], [("user-1", values[0])])
+    if query.startswith("INSERT INTO id_blocks"):
+        return Result(lastrowid=1)
+    return None
+
+
+@pytest.fixture(autouse=True)
+def no_storage(monkeypatch):
+    async def get_file_cid(key):
+        return "cid"
+    monkeypatch.setattr(storage, "get_file_cid", get_file_cid)
+
+
+def approve(database, id):
+    return database.approve_trs_creation_request(id, "creator@example.com", 10, "mint", "Collection", "account", "ipfs://image")
+
+
+def test_concurrent_approvals_do_not_deadlock_on_a_small_pool():
+    async def scenario():
+        database = database_with_pool(2, approval_responder)
+        approvals = 8
+        await asyncio.wait_for(asyncio.gather(*(approve(database, id) for id in range(approvals))), timeout=5)
+        return database.pool, approvals
+
+    pool, approvals = asyncio.run(scenario())
+    # Every approval ran on one pooled connection, nested calls included.
+    assert pool.acquires == approvals
+    assert pool.max_in_use <= 2
+    assert pool.freesize == 2
+    assert sum(connection.commits for connection in pool.connections) == approvals
+
+
+def test_nested_calls_reuse_the_shared_connection():
+    async def scenario():
+        database = database_with_pool(2, approval_responder)
+        async with database.transaction() as connection:
+            nested_connection = await database.get_connection()
+            async with database.transaction() as nested_transaction:
+                pass
+            await nested_connection.commit()
+            await database.release_connection(nested_connection)
+            await approve(database, 1)
+        return database.pool, connection, nested_connection, nested_transaction
+
+    pool, connection, nested_connection, nested_transaction = asyncio.run(scenario())
+    assert isinstance(nested_connection, SharedConnection)
+    assert nested_connection.connection is connection
+    assert isinstance(nested_transaction, SharedConnection)
+    assert nested_transaction.connection is connection
+    # Nested commits are left to the owner, which commits once at the end.
+    assert connection.commits == 1
+    assert pool.acquires == 1
+    assert pool.freesize == 2
+
+
+def test_a_failing_nested_call_rolls_back_the_whole_unit_of_work():
+    async def scenario():
+        database = database_with_pool(2, approval_responder)
+        with pytest.raises(RuntimeError):
+            async with database.transaction() as connection:
+                await database.add_trs(10, "mint", "Collection", "account", "user-1")
+                raise RuntimeError("approval failed")
+        return database.pool, connection
+
+    pool, connection = asyncio.run(scenario())
+    assert connection.commits == 0
+    assert connection.rollbacks == 1
+    assert pool.freesize == 2
+
+
+def test_commit_callbacks_run_after_the_outermost_commit_only():
+    async def scenario():
+        database = database_with_pool(2)
+        calls = []
+        async with database.transaction() as connection:
+            async with database.transaction():
+                database.on_commit(lambda: calls.append(connection.commits))
+            assert calls == []
+        with pytest.raises(RuntimeError):
+            async with database.transaction():
+                database.on_commit(lambda: calls.append("rolled back"))
+                raise RuntimeError("write failed")
+        database.on_commit(lambda: calls.append("no unit of work"))
+        return calls
+
+    # The callback saw the commit, the rolled back one never ran, and outside a unit of work it runs at once.
+    assert asyncio.run(scenario()) == [1, "no unit of work"]
+
+
+def test_ids_are_allocated_and_committed_outside_the_unit_of_work():
+    async def scenario():
+        database = database_with_pool(2, approval_responder)
+        with pytest.raises(RuntimeError):
+            async with database.transaction() as connection:
+                await database.add_trs(10, "mint", "Collection", "account", "user-1")
+                raise RuntimeError("approval failed")
+        return database, connection
+
+    database, connection = asyncio.run(scenario())
+    [id_connection] = database.id_pool.connections
+    # The id block was reserved and committed on the id pool, and survives the rolled back mint.
+    assert [query for query, _ in id_connection.statements] == ["INSERT INTO id_blocks (sequence_name) VALUES (%s)"]
+    assert id_connection.commits == 1
+    assert not any(query.startswith("INSERT INTO id_blocks") for query, _ in connection.statements)
+    assert database.id_blocks['trs'][0] == 10000 + 10
+
+
+def test_concurrent_allocations_reserve_blocks_once():
+    async def scenario():
+        database = database_with_pool(2, approval_responder, latency=0.001)
+        return database, await asyncio.gather(*(database.allocate_ids(10) for _ in range(8)))
+
+    database, ranges = asyncio.run(scenario())
+    assert database.id_pool.acquires == 1
+    ids = [id for allocated in ranges for id in allocated]
+    assert len(set(ids)) == len(ids) == 80
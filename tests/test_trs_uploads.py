@@ -0,0 +1,56 @@
+"""
+Object keys of TRS creation requests: every request uploads under a prefix of its own, and titles that
+could be read as a path are rejected.
+"""
+import os
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+
+from app.api.trs import upload_files, validate_title
+from app.utils.models import TrsFinalizeRequest, TrsUploadRequest
+
+
+def upload_request(title="Collection"):
+    return TrsUploadRequest(
+        title=title,
+        files=[{"filename": "model.glb", "size": 10}],
+        image={"filename": "thumbnail.png", "size": 5},
+    )
+
+
+@pytest.mark.parametrize("title", ["", "  ", "a/b", "../Collection", "Collection..", "a\\b", "x" * 256])
+def test_a_title_that_could_be_read_as_a_path_is_rejected(title):
+    with pytest.raises(HTTPException) as raised:
+        validate_title(title)
+    assert raised.value.status_code == 400
+
+
+@pytest.mark.parametrize("title", ["Collection", "My Collection 2", "Café.v2"])
+def test_a_plain_title_is_accepted(title):
+    validate_title(title)
+
+
+def test_requests_for_the_same_title_upload_under_their_own_prefix():
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+    first_keys = [key for _, key in upload_files(upload_request(), first)]
+    second_keys = [key for _, key in upload_files(upload_request(), second)]
+
+    assert first_keys == [f"trs_data/{first}/model.glb", f"trs_data/{first}/thumbnail.png"]
+    assert not set(first_keys) & set(second_keys)
+
+
+def test_finalize_takes_the_keys_of_the_issued_uuid():
+    upload_uuid = uuid.uuid4()
+    request = TrsFinalizeRequest(
+        model_name="model", title="Collection", description="A collection", number=10, upload_uuid=str(upload_uuid),
+        files=[{"filename": "model.glb", "size": 10}], image={"filename": "thumbnail.png", "size": 5},
+    )
+    assert [key for _, key in upload_files(request, request.upload_uuid)] == [
+        f"trs_data/{upload_uuid}/model.glb", f"trs_data/{upload_uuid}/thumbnail.png",
+    ]
+    with pytest.raises(ValueError):
+        TrsFinalizeRequest(**{**request.model_dump(), "upload_uuid": "../Collection"})